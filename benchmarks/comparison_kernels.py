@@ -0,0 +1,64 @@
+"""
+Regression check and micro-benchmark of the comparison kernels. The float kernel (float32 matrix) and the integer SAD
+kernel (quantized matrix, see FeatureTable) have to give the same pairs and bit identical scores as compare_two_images.
+Run from the repository root: python -m benchmarks.comparison_kernels [number of images]
+Features are random histograms rounded to 4 decimals like the ones of get_img_features. Many pairs have a feature mean
+exactly on a rounding tie, so the tie detection of the integer kernel is covered
+"""
+import sys
+import time
+import numpy as np
+from image_comparison import compare_two_images
+from comparison_engine import build_feature_matrix, compare_all_pairs, quantize_features
+
+
+def random_features(count=400, bins=6, seed=0):
+    rng = np.random.default_rng(seed)
+    all_imgs_features = {}
+    for i in range(count):
+        # Few distinct histograms with small variations, so there are pairs above high thresholds
+        base = rng.dirichlet(np.ones(bins * 4))[:, None] if i % 8 == 0 else base
+        histograms = np.round(np.clip(base[:, 0] + rng.normal(0, 0.003, bins * 4), 0, 1), 4)
+        all_imgs_features[f"img_{i}"] = {"color": histograms[:bins * 3], "edge_orientation": histograms[bins * 3:]}
+
+    return all_imgs_features
+
+
+def check(all_imgs_features, thresholds=(0.0, 0.97, 0.99)):
+    paths, matrix, feature_slices = build_feature_matrix(all_imgs_features)
+    quantized = quantize_features(matrix)
+
+    # Reference scores of every pair in nested loop order
+    reference = np.array([[compare_two_images(all_imgs_features[paths[a]], all_imgs_features[paths[b]])
+                           if b > a else -1.0 for b in range(len(paths))] for a in range(len(paths))])
+
+    for threshold in thresholds:
+        expected_rows, expected_cols = np.nonzero(reference >= threshold)
+        expected_similarities = reference[expected_rows, expected_cols]
+
+        for name, kernel_matrix in (("float", matrix), ("quantized", quantized)):
+            rows, cols, similarities = compare_all_pairs(kernel_matrix, feature_slices, threshold=threshold)
+            if not (np.array_equal(rows, expected_rows) and np.array_equal(cols, expected_cols) and
+                    np.array_equal(similarities, expected_similarities)):
+                raise Exception(f"{name} kernel does not match compare_two_images at threshold {threshold}.")
+
+    print(f"(i) {len(paths) * (len(paths) - 1) // 2} pairs match compare_two_images "
+          f"(thresholds {', '.join(str(threshold) for threshold in thresholds)})")
+
+    return matrix, quantized, feature_slices
+
+
+def run(all_imgs_features, repeats=3):
+    matrix, quantized, feature_slices = check(all_imgs_features)
+
+    for name, kernel_matrix in (("float", matrix), ("quantized", quantized)):
+        best = float("inf")
+        for _ in range(repeats):
+            timer_start = time.perf_counter()
+            compare_all_pairs(kernel_matrix, feature_slices, threshold=0.99)
+            best = min(best, time.perf_counter() - timer_start)
+        print(f"{name:<10} {best:7.3f}s | {len(matrix) * (len(matrix) - 1) / 2 / best:12.0f} pairs/s")
+
+
+if __name__ == '__main__':
+    run(random_features(int(sys.argv[1]) if len(sys.argv) > 1 else 400))
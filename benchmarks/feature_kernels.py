@@ -0,0 +1,68 @@
+"""
+Micro-benchmark of the default and the fast histogram kernels on images of the default 250px feature size.
+Run from the repository root: python -m benchmarks.feature_kernels [image folder]
+Without a folder, random images are used
+"""
+import os
+import sys
+import time
+import cv2
+import numpy as np
+from image_comparison import load_img, color_histogram, edge_histogram, color_histogram_fast, edge_histogram_fast
+
+
+def load_images(folder_path, resize=250, limit=50):
+    images = []
+    for path, _, file_names in os.walk(folder_path):
+        for file_name in file_names:
+            if file_name.lower().endswith((".jpg", ".jpeg", ".png", ".webp", ".jfif")) and len(images) < limit:
+                images.append(cv2.resize(load_img(os.path.join(path, file_name)), (resize, resize)))
+
+    return images
+
+
+def random_images(resize=250, count=50, seed=0):
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        # Smooth random images, so the edge orientations are not uniformly distributed
+        noise = rng.integers(0, 256, (resize // 10, resize // 10, 3), dtype=np.uint8)
+        images.append(cv2.resize(noise, (resize, resize), interpolation=cv2.INTER_CUBIC))
+
+    return images
+
+
+def time_per_image(function, images, bins, repeats=5):
+    best = float("inf")
+    for _ in range(repeats):
+        timer_start = time.perf_counter()
+        for img in images:
+            function(img, bins=bins)
+        best = min(best, (time.perf_counter() - timer_start) / len(images))
+
+    return best
+
+
+def run(images, bins=6):
+    # Build the orientation lookup table before timing
+    edge_histogram_fast(images[0], bins=bins)
+
+    for img in images:
+        for default_kernel, fast_kernel in ((color_histogram, color_histogram_fast),
+                                            (edge_histogram, edge_histogram_fast)):
+            if not np.array_equal(np.round(fast_kernel(img, bins=bins).astype(np.float64), 4),
+                                  default_kernel(img, bins=bins)):
+                raise Exception(f"{fast_kernel.__name__} does not match {default_kernel.__name__}.")
+
+    print(f"(i) {len(images)} images, {images[0].shape[1]}x{images[0].shape[0]}px, {bins} bins")
+    for name, default_kernel, fast_kernel in (("color_histogram", color_histogram, color_histogram_fast),
+                                              ("edge_histogram", edge_histogram, edge_histogram_fast)):
+        default_time = time_per_image(default_kernel, images, bins)
+        fast_time = time_per_image(fast_kernel, images, bins)
+        print(f"{name:<16} default: {default_time * 1000:7.3f}ms | fast: {fast_time * 1000:7.3f}ms | "
+              f"speedup: {default_time / fast_time:5.1f}x")
+
+
+if __name__ == '__main__':
+    benchmark_images = load_images(sys.argv[1]) if len(sys.argv) > 1 else random_images()
+    run(benchmark_images)
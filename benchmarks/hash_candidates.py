@@ -0,0 +1,78 @@
+"""
+Regression check and benchmark of the dhash prefilter (see hash_candidate_pairs and compare_hash_candidates).
+Run from the repository root: python -m benchmarks.hash_candidates [number of hashes]
+Hashes are random with groups of near duplicates. Large max distances split the hashes into small blocks with large
+groups of equal block values, which used to make the prefilter much slower than comparing every pair. Each distance is
+timed against the comparison of all pairs, a prefilter that is clearly slower than it fails the run
+"""
+import sys
+import time
+import numpy as np
+from comparison_engine import build_feature_matrix, compare_hash_candidates, hamming_distances, hash_candidate_pairs
+from benchmarks.comparison_kernels import random_features
+
+
+def random_hashes(count, group_size=4, max_flips=3, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 2 ** 64, (count + group_size - 1) // group_size, dtype=np.uint64)
+    hashes = np.repeat(base, group_size)[:count]
+
+    # Flip up to max_flips random bits of every hash
+    bits = np.uint64(1) << rng.integers(0, 64, (count, max_flips)).astype(np.uint64)
+    flips = np.where(rng.random((count, max_flips)) < 0.5, bits, np.uint64(0))
+
+    return hashes ^ np.bitwise_xor.reduce(flips, axis=1)
+
+
+def all_pairs(hashes_a, max_distance, hashes_b=None, chunk_rows=256):
+    # Reference: hamming distance of every pair, rows in chunks
+    rows, cols = [], []
+    for start in range(0, len(hashes_a), chunk_rows):
+        other = hashes_a if hashes_b is None else hashes_b
+        distances = hamming_distances(hashes_a[start:start + chunk_rows, None], other[None, :])
+        if hashes_b is None:
+            distances[np.arange(distances.shape[1]) <= np.arange(start, start + len(distances))[:, None]] = 65
+        chunk_rows_found, chunk_cols_found = np.nonzero(distances <= max_distance)
+        rows.append(chunk_rows_found + start)
+        cols.append(chunk_cols_found)
+
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def best_time(function, repeats=3):
+    best, result = float("inf"), None
+    for _ in range(repeats):
+        timer_start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - timer_start)
+
+    return best, result
+
+
+def run(count=20000, distances=(4, 10), num_new=10, max_slowdown=2.0):
+    hashes = random_hashes(count)
+
+    for max_distance in distances:
+        seconds, (a, b) = best_time(lambda: hash_candidate_pairs(hashes, max_distance))
+        reference_seconds, (expected_a, expected_b) = best_time(lambda: all_pairs(hashes, max_distance), repeats=1)
+        if not (np.array_equal(a, expected_a) and np.array_equal(b, expected_b)):
+            raise Exception(f"hash_candidate_pairs does not find all pairs within distance {max_distance}.")
+
+        print(f"d={max_distance:<3} {count} hashes {seconds:7.3f}s | all pairs {reference_seconds:7.3f}s | "
+              f"{len(a)} pairs")
+        if seconds > max_slowdown * reference_seconds:
+            raise Exception(f"hash_candidate_pairs is {seconds / reference_seconds:.1f}x slower than comparing all "
+                            f"pairs at distance {max_distance}.")
+
+    # Few new images against a large library. Has to scale with the new images, not with the library
+    paths, matrix, feature_slices = build_feature_matrix(random_features(count))
+    hash_list = [int(img_hash) for img_hash in hashes]
+    for max_distance in distances:
+        seconds, _ = best_time(lambda: compare_hash_candidates(
+            matrix[:num_new], hash_list[:num_new], feature_slices, threshold=0.99, max_hash_distance=max_distance,
+            matrix_b=matrix[num_new:], hashes_b=hash_list[num_new:]))
+        print(f"d={max_distance:<3} {num_new} new vs {count - num_new} compared {seconds:7.3f}s")
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,217 @@
+"""
+Benchmark suite for image loading, feature extraction, comparison and save file I/O on generated image corpora.
+Run from the repository root: python -m benchmarks.suite [--sizes 50 200] [--formats jpg png] [--output results.json]
+Results are written as json, a previous result file can be passed with --baseline to print the change per benchmark
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from PIL import Image
+from image_comparison import load_img, decode_img, get_img_features, compare_two_images
+from main import ImageCompare
+from save_file_handling import SaveFileHandler
+
+
+def generate_corpus(folder_path, count, file_format="jpg", img_size=(1024, 768), duplicate_ratio=0.25, seed=0):
+    """
+    Write smooth random images to a folder. Some images are slightly changed copies of others, so comparisons find
+    matches
+    :param folder_path: folder to write the images to
+    :param count: number of images
+    :param file_format: file extension of the images (format is taken from it)
+    :param img_size: size of the images (width, height)
+    :param duplicate_ratio: share of images that are near duplicates of an earlier image
+    :param seed: seed of the random images. Same seed, same corpus
+    :return: list of image paths
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder_path, exist_ok=True)
+    img_paths = []
+    images = []
+
+    for i in range(count):
+        if images and rng.random() < duplicate_ratio:
+            # Near duplicate: brightness change and some noise
+            source = images[rng.integers(len(images))].astype(np.int16)
+            img = np.clip(source + rng.integers(-8, 9) + rng.integers(-3, 4, source.shape), 0, 255).astype(np.uint8)
+        else:
+            noise = rng.integers(0, 256, (img_size[1] // 32, img_size[0] // 32, 3), dtype=np.uint8)
+            img = cv2.resize(noise, img_size, interpolation=cv2.INTER_CUBIC)
+        images.append(img)
+
+        img_path = os.path.join(folder_path, f"img_{i:06d}.{file_format}").replace("\\", "/")
+        Image.fromarray(img).save(img_path)
+        img_paths.append(img_path)
+
+    return img_paths
+
+
+def best_time(function, repeats=3):
+    """
+    Run a function several times and get the fastest run
+    :param function: function without arguments
+    :param repeats: number of runs
+    :return: fastest time in seconds
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        # Progress prints of the save file handlers are not part of the output
+        with contextlib.redirect_stdout(io.StringIO()):
+            timer_start = time.perf_counter()
+            function()
+            best = min(best, time.perf_counter() - timer_start)
+
+    return best
+
+
+def write_save_file(save_file_path, root_path):
+    with open(save_file_path, "w") as json_file:
+        json.dump({"meta": {"root": root_path, "created": int(time.time()), "lifetime_matches": 0,
+                            "lifetime_comparisons": 0}, "data": {}}, json_file)
+
+
+def run_corpus(work_dir, count, file_format, repeats=3, bins=6, resize=250):
+    """
+    Time every benchmark on one generated corpus
+    :return: list of result dicts
+    """
+    corpus_path = os.path.join(work_dir, f"corpus_{file_format}_{count}").replace("\\", "/")
+    img_paths = generate_corpus(corpus_path, count, file_format)
+    results = []
+
+    def add_result(benchmark, seconds, items):
+        results.append({"benchmark": benchmark, "corpus_size": count, "format": file_format, "items": items,
+                        "seconds": seconds, "seconds_per_item": seconds / max(items, 1)})
+        print(f"{benchmark:<22} {file_format:<5} {count:>7} images | {seconds:9.4f}s | "
+              f"{seconds / max(items, 1) * 1000:9.4f}ms per item ({items} items)")
+
+    # Loading and feature extraction, per image
+    add_result("load_img", best_time(lambda: [load_img(img_path) for img_path in img_paths], repeats), count)
+    add_result("decode_img_fast",
+               best_time(lambda: [decode_img(img_path, fast_ingest=True) for img_path in img_paths], repeats), count)
+    images = [load_img(img_path) for img_path in img_paths]
+    add_result("get_img_features",
+               best_time(lambda: [get_img_features(img, bins=bins, resize=resize) for img in images], repeats), count)
+    features = [get_img_features(img, bins=bins, resize=resize) for img in images]
+
+    # Pairwise comparison of single pairs (every image with the next one)
+    pairs = list(zip(features, features[1:] + features[:1]))
+    add_result("compare_two_images", best_time(lambda: [compare_two_images(a, b) for a, b in pairs], repeats),
+               len(pairs))
+
+    # Save file: first scan of the corpus, features and full comparison
+    save_file_path = os.path.join(work_dir, f"savefile_{file_format}_{count}.json")
+    write_save_file(save_file_path, corpus_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        save_file_handler = SaveFileHandler(save_file_path, incremental_scan=False)
+
+    def update_save_file():
+        save_file_handler.data_dict["data"] = {}
+        save_file_handler.update_save_file(write_to_file=False)
+
+    add_result("update_save_file", best_time(update_save_file, repeats), count)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        comparer = ImageCompare(savefile_path=save_file_path, bins=bins, resize=resize)
+
+    add_result("write_to_save_file", best_time(comparer.save_file_handler.write_to_save_file, repeats), count)
+
+    # Feature memory per image: quantized feature table and similarity index against the lists of floats json save files
+    # held and the float64 index
+    features_json = json.dumps([{feature: np.asarray(values, dtype=np.float64).round(4).tolist()
+                                 for feature, values in img_features.items()} for img_features in features])
+    tracemalloc.start()
+    float_lists = json.loads(features_json)
+    float_list_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del float_lists
+    table_bytes = comparer.feature_table.matrix[:len(comparer.feature_table)].nbytes
+    index_bytes = comparer.similarity_index.matrix[:comparer.similarity_index.num_rows].nbytes
+    float_index_bytes = comparer.similarity_index.matrix.shape[1] * np.dtype(np.float64).itemsize * count
+    before_bytes, after_bytes = float_list_bytes + float_index_bytes, table_bytes + index_bytes
+    print(f"{'feature_memory':<22} {file_format:<5} {count:>7} images | {after_bytes // count} bytes per image "
+          f"(table {table_bytes // count} + index {index_bytes // count}) | lists of floats and float64 index "
+          f"{before_bytes // count} bytes per image | {before_bytes / max(after_bytes, 1):.1f}x less")
+    add_result("compare_all_images",
+               best_time(lambda: comparer.compare_all_images(threshold=0.9, skip_compared=False), repeats),
+               count * (count - 1) // 2)
+
+    # Same comparison on LSH candidates only. Recall is the share of the exhaustive matches it finds
+    exhaustive_matches = comparer.compare_all_images(threshold=0.9, skip_compared=False)
+    comparer.lsh_tables = 16
+    comparer.update_lsh_index(threshold=0.9)
+    add_result("compare_all_images_lsh",
+               best_time(lambda: comparer.compare_all_images(threshold=0.9, skip_compared=False), repeats),
+               count * (count - 1) // 2)
+    lsh_matches = comparer.compare_all_images(threshold=0.9, skip_compared=False)
+    print(f"{'lsh_recall':<22} {file_format:<5} {count:>7} images | {len(lsh_matches)} of {len(exhaustive_matches)} "
+          f"matches")
+
+    return results
+
+
+def environment_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {"timestamp": int(time.time()), "commit": commit, "python": platform.python_version(),
+            "numpy": np.__version__, "opencv": cv2.__version__, "platform": platform.platform(),
+            "cpu_count": os.cpu_count()}
+
+
+def print_baseline_comparison(results, baseline_results):
+    baseline = {(r["benchmark"], r["corpus_size"], r["format"]): r["seconds_per_item"] for r in baseline_results}
+
+    print("(i) Change to baseline (time per item, negative is faster)")
+    for result in results:
+        baseline_time = baseline.get((result["benchmark"], result["corpus_size"], result["format"]))
+        if baseline_time:
+            change = (result["seconds_per_item"] - baseline_time) / baseline_time * 100
+            print(f"{result['benchmark']:<20} {result['format']:<5} {result['corpus_size']:>7} images | "
+                  f"{change:+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite on generated image corpora")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200], help="number of images per corpus")
+    parser.add_argument("--formats", nargs="+", default=["jpg", "png"], help="image file formats")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per benchmark, the fastest run is kept")
+    parser.add_argument("--output", default="benchmark_results.json", help="json file for the results")
+    parser.add_argument("--baseline", help="json result file of an earlier run to compare to")
+    parser.add_argument("--work-dir", help="folder for the corpora and save files. Temporary if not defined")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="image_comparison_benchmark_")
+    results = []
+    try:
+        for file_format in args.formats:
+            for count in args.sizes:
+                results += run_corpus(work_dir, count, file_format, repeats=args.repeats)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as json_file:
+        json.dump({"environment": environment_info(), "results": results}, json_file, indent=4)
+    print(f"(i) Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as json_file:
+            print_baseline_comparison(results, json.load(json_file)["results"])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+import copy
+import json
+import os
+import time
+import numpy as np
+from instrumentation import instrumentation, logger
+from feature_table import table_file_path_for
+from save_file_handling import SaveFileHandler
+
+
+class BinarySaveFileHandler(SaveFileHandler):
+    """
+    Save file handler that stores the save file as a directory of binary files instead of one json file:
+    - meta.json: root path, creation time and lifetime stats
+    - table.npz: one row per image with path, last modified time, compared flag, dhash, file size and content hash
+    Features are kept in the feature table next to the save file like with the json save file (see SaveFileHandler).
+    Save files written before the feature table have a float64 features.npy matrix. Its features are moved into the
+    table when the save file is read and the matrix file is removed once the save file is written again
+    """
+    meta_file_name = "meta.json"
+    table_file_name = "table.npz"
+    features_file_name = "features.npy"
+
+    def __init__(self, save_file_path="savefile.bin", json_save_file_path=None, incremental_scan=True,
+                 update_on_init=True):
+        """
+        :param save_file_path: path of the save file directory
+        :param json_save_file_path: json save file that is migrated once if the binary save file does not exist yet.
+        Defaults to the save file path with a .json ending
+        :param incremental_scan: see SaveFileHandler
+        :param update_on_init: see SaveFileHandler
+        """
+        if os.path.isfile(save_file_path):
+            raise ValueError(f"Binary save file path {save_file_path} is a file, not a save file directory.")
+
+        # {image_path: [last_modified, compared, dhash or None, file_size or None, content_hash or None], ...}
+        self.entries = {}
+
+        if json_save_file_path is None:
+            json_save_file_path = os.path.splitext(save_file_path)[0] + ".json"
+
+        # One time migration of an existing json save file
+        if not os.path.exists(os.path.join(save_file_path, BinarySaveFileHandler.meta_file_name)) and \
+                os.path.isfile(json_save_file_path):
+            migrate_json_save_file(json_save_file_path, save_file_path)
+
+        super().__init__(save_file_path=save_file_path, incremental_scan=incremental_scan,
+                         update_on_init=update_on_init)
+
+    def _file(self, file_name):
+        return os.path.join(self.save_file_path, file_name)
+
+    def read_from_save_file(self):
+        timer_start = time.perf_counter()
+
+        with open(self._file(BinarySaveFileHandler.meta_file_name), 'r') as meta_file:
+            data = json.load(meta_file)
+
+        with np.load(self._file(BinarySaveFileHandler.table_file_name)) as table:
+            # Hashes are missing in tables written before hashes were added
+            hashes = table["hashes"] if "hashes" in table else np.zeros(len(table["paths"]), dtype=np.uint64)
+            has_hash = table["has_hash"] if "has_hash" in table else np.zeros(len(table["paths"]), dtype=bool)
+            # Same for file sizes and content hashes
+            file_sizes = table["file_sizes"] if "file_sizes" in table else np.full(len(table["paths"]), -1)
+            content_hashes = table["content_hashes"] if "content_hashes" in table else [""] * len(table["paths"])
+            # Rows of the features.npy matrix of save files written before the feature table
+            feature_rows = table["feature_rows"] if "feature_rows" in table else np.full(len(table["paths"]), -1)
+
+            self.entries = {str(path): [float(last_modified), bool(compared),
+                                        int(image_hash) if image_has_hash else None,
+                                        int(file_size) if file_size != -1 else None, str(content_hash) or None]
+                            for path, last_modified, compared, image_hash, image_has_hash, file_size, content_hash in
+                            zip(table["paths"], table["last_modified"], table["compared"], hashes, has_hash,
+                                file_sizes, content_hashes)}
+
+        # Move the features of an older save file into the feature table
+        feature_layout = data["meta"].pop("feature_layout", [])
+        data["meta"].pop("feature_rows", None)
+        if os.path.exists(self._file(BinarySaveFileHandler.features_file_name)) and feature_layout:
+            features = np.load(self._file(BinarySaveFileHandler.features_file_name), mmap_mode="r")
+            for path, feature_row in zip(self.entries, feature_rows):
+                if feature_row != -1:
+                    row, start = features[feature_row], 0
+                    img_features = {}
+                    for feature, length in feature_layout:
+                        img_features[feature] = row[start:start + length]
+                        start += length
+                    self.set_table_features(path, img_features)
+            del features
+
+        seconds = time.perf_counter() - timer_start
+        instrumentation.add_time("io.read_save_file", seconds)
+        logger.info("Read save file (%.2fs)", seconds)
+        return data
+
+    def create_save_file(self):
+        logger.info("Creating new savefile.")
+
+        # Create new data structure
+        self.data_dict = copy.deepcopy(SaveFileHandler.base_save_file_structure)
+        del self.data_dict["data"]  # Image data is stored in the table
+        self.data_dict["meta"]["root"] = os.path.dirname(os.path.abspath(__file__))
+        self.data_dict["meta"]["created"] = int(time.time())
+        self.root_path = self.data_dict["meta"]["root"]
+
+        self.entries = {}
+
+        self.write_to_save_file()
+
+    def write_to_save_file(self):
+        timer_start = time.perf_counter()
+
+        os.makedirs(self.save_file_path, exist_ok=True)
+        self.save_feature_table()
+
+        # Write to temporary files first, so a crash while writing does not corrupt the save file
+        table_path = self._file(BinarySaveFileHandler.table_file_name)
+        with open(table_path + ".tmp", 'wb') as table_file:
+            np.savez(table_file, paths=np.array(list(self.entries.keys()), dtype=str),
+                     last_modified=np.array([entry[0] for entry in self.entries.values()], dtype=np.float64),
+                     compared=np.array([entry[1] for entry in self.entries.values()], dtype=bool),
+                     hashes=np.array([entry[2] or 0 for entry in self.entries.values()], dtype=np.uint64),
+                     has_hash=np.array([entry[2] is not None for entry in self.entries.values()], dtype=bool),
+                     file_sizes=np.array([-1 if entry[3] is None else entry[3] for entry in self.entries.values()],
+                                         dtype=np.int64),
+                     content_hashes=np.array([entry[4] or "" for entry in self.entries.values()], dtype=str))
+        os.replace(table_path + ".tmp", table_path)
+
+        self.write_meta()
+
+        # Features of an older save file are in the feature table now
+        try:
+            os.remove(self._file(BinarySaveFileHandler.features_file_name))
+        except FileNotFoundError:
+            pass
+
+        seconds = time.perf_counter() - timer_start
+        instrumentation.add_time("io.write_save_file", seconds)
+        logger.info("Wrote save file (%.2fs)", seconds)
+
+    def write_meta(self):
+        """
+        Write only the meta data (root, lifetime stats). Much faster than write_to_save_file
+        """
+        os.makedirs(self.save_file_path, exist_ok=True)
+        meta_path = self._file(BinarySaveFileHandler.meta_file_name)
+
+        with open(meta_path + ".tmp", 'w') as meta_file:
+            json.dump(self.data_dict, meta_file, indent=4)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def update_save_file(self, write_to_file=True):
+        timer_start = time.perf_counter()
+
+        deletions_missing_file, deletions_modified_file, additions = self.find_file_changes(
+            lambda: {file_path: entry[0] for file_path, entry in self.entries.items()})
+
+        # Remove deleted and modified files
+        for file_path in deletions_missing_file + deletions_modified_file:
+            self.entries.pop(file_path, None)
+            self.feature_table.delete(file_path)
+
+        # Add new files
+        for file_path, last_modified in additions.items():
+            if file_path not in self.entries:
+                self.entries[file_path] = [last_modified, False, None, None, None]
+
+        seconds = time.perf_counter() - timer_start
+        instrumentation.add_time("io.update_save_file", seconds)
+        instrumentation.count("files_added", len(additions))
+        instrumentation.count("files_removed", len(deletions_missing_file + deletions_modified_file))
+        logger.info("Updated saved image paths. Removed: %d (%d missing files, %d modified files) | Added: %d (%.2fs)",
+                    len(deletions_missing_file + deletions_modified_file), len(deletions_missing_file),
+                    len(deletions_modified_file), len(additions), seconds)
+
+        # Update savefile with new data
+        if (len(deletions_missing_file + deletions_modified_file) != 0 or len(additions) != 0) and write_to_file:
+            self.write_to_save_file()
+
+        return {"additions": list(additions), "deletions": deletions_missing_file + deletions_modified_file}
+
+    def edit_image_features(self, file_path, new_features_dict):
+        if file_path in self.entries:
+            self.set_table_features(file_path, new_features_dict)
+        else:
+            print(f"(!) Can not update features for {file_path}. File path not in save file.")
+
+    def edit_image_hash(self, file_path, image_hash):
+        if file_path in self.entries:
+            self.entries[file_path][2] = image_hash
+        else:
+            print(f"(!) Can not update hash for {file_path}. File path not in save file.")
+
+    def get_all_images_hashes(self):
+        return {key: entry[2] for key, entry in self.entries.items()}
+
+    def edit_image_content_hash(self, file_path, file_size, image_content_hash=None):
+        if file_path in self.entries:
+            self.entries[file_path][3:5] = [file_size, image_content_hash]
+        else:
+            print(f"(!) Can not update content hash for {file_path}. File path not in save file.")
+
+    def get_all_images_content_hashes(self):
+        return {key: (entry[3], entry[4]) for key, entry in self.entries.items()}
+
+    def get_all_images_compared(self):
+        return {key: entry[1] for key, entry in self.entries.items()}
+
+    def mark_all_as_compared(self, write_to_file=True, unmark_all=False):
+        new_completions = 0
+
+        for entry in self.entries.values():
+            if entry[1] == unmark_all:
+                entry[1] = not unmark_all
+                new_completions += 1
+
+        # Update savefile with new data
+        if new_completions != 0 and write_to_file:
+            self.write_to_save_file()
+
+        return new_completions
+
+    def get_number_of_files(self):
+        return len(self.entries)
+
+    def add_to_lifetime_stats(self, matches=0, comparisons=0, write_to_file=True):
+
+        self.data_dict["meta"]["lifetime_matches"] += matches
+        self.data_dict["meta"]["lifetime_comparisons"] += comparisons
+
+        # Only the meta data changed, no need to write the image table
+        if write_to_file:
+            self.write_meta()
+
+
+def migrate_json_save_file(json_save_file_path, save_file_path):
+    """
+    Convert a json save file (see SaveFileHandler) to a binary save file. The json save file is not changed
+    :param json_save_file_path: path of the existing json save file
+    :param save_file_path: path of the new binary save file directory
+    """
+    timer_start = time.perf_counter()
+    logger.info("Migrating %s to binary save file %s...", json_save_file_path, save_file_path)
+
+    with open(json_save_file_path, 'r') as json_file:
+        json_data = json.load(json_file)
+
+    handler = BinarySaveFileHandler.__new__(BinarySaveFileHandler)
+    handler.save_file_path = save_file_path
+    handler.entries = {}
+    handler.data_dict = {"meta": copy.deepcopy(SaveFileHandler.base_save_file_structure["meta"])}
+    handler.data_dict["meta"].update(json_data["meta"])
+    handler.root_path = handler.data_dict["meta"]["root"]
+
+    # Features of the json save file are in its feature table (older json save files hold them as lists)
+    handler.feature_table_path = table_file_path_for(json_save_file_path)
+    handler.feature_table = handler.load_feature_table()
+    handler.feature_table_path = table_file_path_for(save_file_path)
+    handler.feature_table.changed = True
+
+    os.makedirs(save_file_path, exist_ok=True)
+
+    for file_path, value in json_data["data"].items():
+        handler.entries[file_path] = [value["info"]["last_modified"], value["info"]["compared"],
+                                      value["info"].get("dhash"), value["info"].get("file_size"),
+                                      value["info"].get("content_hash")]
+        if value.get("features"):
+            handler.edit_image_features(file_path, value["features"])
+
+    handler.write_to_save_file()
+    logger.info("Migration DONE. %d entries (%.2fs)", len(handler.entries), time.perf_counter() - timer_start)
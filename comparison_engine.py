@@ -0,0 +1,744 @@
+import collections
+import contextlib
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+import numpy as np
+
+FEATURE_DECIMALS = 4  # Feature values and similarity scores are rounded to 4 decimals (see image_comparison.py)
+FEATURE_SCALE = 10 ** FEATURE_DECIMALS  # Quantized features are the feature values times this (see quantize_features)
+QUANTIZED_DTYPE = np.uint16  # Feature values are histogram shares in [0, 1], quantized values fit 16 bits
+DEFAULT_BLOCK_SIZE = 256  # Rows per tile. A 256x256 tile with 24 features needs roughly 12MB of scratch memory
+DEFAULT_SHARD_TILES = 4  # Tiles per task of the sharded comparison
+# Similarity scores are built from rounded per-feature MAEs. The rounding can move a score by at most 0.0001 compared
+# to the unrounded weighted L1 distance, so distance bounds are widened by this slack before exact scoring
+SCORE_ROUNDING_SLACK = 1.5 * 10 ** -FEATURE_DECIMALS
+POPCOUNT_TABLE = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int64)  # Set bits per byte value
+
+
+def build_feature_matrix(all_imgs_features, feature_slices=None, dtype=np.float32):
+    """
+    Pack the features of many images into one contiguous matrix (one row per image)
+    :param all_imgs_features: dictionary of image features: {image_path: {feature_name: feature_values, ...}, ...}
+    :param feature_slices: optional column layout to enforce: {feature_name: slice, ...}. Taken from the first image
+    with features if not defined
+    :param dtype: dtype of the packed matrix
+    :return: tuple of (list of image paths, 2d feature matrix, feature slices). Images without features or with a
+    feature layout that does not match are left out
+    """
+    paths, rows = [], []
+    num_columns = 0 if feature_slices is None else sum(s.stop - s.start for s in feature_slices.values())
+
+    for img_path, img_features in all_imgs_features.items():
+        if not img_features:
+            continue
+
+        # Take the column layout from the first image that has features
+        if feature_slices is None:
+            feature_slices = {}
+            for feature, values in img_features.items():
+                feature_slices[feature] = slice(num_columns, num_columns + len(values))
+                num_columns += len(values)
+
+        if img_features.keys() != feature_slices.keys():
+            continue
+
+        row = np.concatenate([np.asarray(img_features[feature], dtype=np.float64).ravel()
+                              for feature in feature_slices])
+        if len(row) != num_columns:
+            continue
+
+        paths.append(img_path)
+        rows.append(row)
+
+    matrix = np.array(rows, dtype=np.float64).reshape(len(rows), num_columns)
+    matrix = np.ascontiguousarray(quantize_features(matrix) if dtype == QUANTIZED_DTYPE else matrix.astype(dtype))
+
+    return paths, matrix, feature_slices
+
+
+def quantize_features(values):
+    """
+    Store feature values rounded to 4 decimals as integers (value * FEATURE_SCALE). Lossless for the rounded values and
+    a quarter of the memory of float64
+    :param values: array of feature values in [0, 1]
+    :return: array of QUANTIZED_DTYPE
+    """
+    return np.rint(np.asarray(values, dtype=np.float64) * FEATURE_SCALE).astype(QUANTIZED_DTYPE)
+
+
+def restore_precision(block):
+    """
+    Convert a block of packed features back to the float64 values the features were originally rounded to. Float32
+    can not hold 4 decimal values exactly, re-rounding makes the similarity scores bit identical to compare_two_images.
+    Quantized features (see quantize_features) are scaled back, which gives the same values
+    :param block: 2d array of packed features
+    :return: 2d float64 array
+    """
+    if np.issubdtype(block.dtype, np.integer):
+        return block / FEATURE_SCALE
+
+    return np.round(block.astype(np.float64), FEATURE_DECIMALS)
+
+
+def block_similarities(block_a, block_b, feature_slices):
+    """
+    Calculate the similarity of every image in block a to every image in block b. Same score as compare_two_images:
+    mean absolute difference per feature, averaged over all features and flipped to a similarity
+    :param block_a: 2d float64 array of features (see restore_precision)
+    :param block_b: 2d float64 array of features (see restore_precision)
+    :param feature_slices: column layout of the features: {feature_name: slice, ...}
+    :return: 2d array of similarities with shape (len(block_a), len(block_b))
+    """
+    diff = np.absolute(block_a[:, None, :] - block_b[None, :, :])
+
+    features_diffs = 0
+    for feature_slice in feature_slices.values():
+        features_diffs = features_diffs + np.round(np.mean(diff[:, :, feature_slice], axis=-1), FEATURE_DECIMALS)
+
+    total_diff = np.round(features_diffs / len(feature_slices), FEATURE_DECIMALS)
+
+    return 1 - total_diff
+
+
+def compare_all_pairs(matrix_a, feature_slices, threshold=0.99, matrix_b=None, block_size=DEFAULT_BLOCK_SIZE,
+                      progress=None):
+    """
+    Compare images in tiles of block_size x block_size and keep all pairs above the threshold. Without matrix_b every
+    image of matrix_a is compared to every following image of matrix_a (upper triangle). With matrix_b every image of
+    matrix_a is compared to every image of matrix_b
+    :param matrix_a: 2d feature matrix (see build_feature_matrix)
+    :param feature_slices: column layout of the features: {feature_name: slice, ...}
+    :param threshold: threshold for minimum similarity score for the comparison to be saved
+    :param matrix_b: optional second 2d feature matrix
+    :param block_size: number of images per tile side
+    :param progress: optional callback, called after every tile with (row indices, column indices, similarities,
+    number of compared pairs) of that tile. If it returns True, the comparison stops and the pairs found so far are
+    returned
+    :return: tuple of (row indices, column indices, similarities) in the same order as a nested loop would produce
+    """
+    rows, cols, similarities = [], [], []
+    num_rows = len(matrix_a)
+    num_cols = num_rows if matrix_b is None else len(matrix_b)
+    other_matrix = matrix_a if matrix_b is None else matrix_b
+
+    if num_rows == 0 or num_cols == 0 or not feature_slices:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    for row_start in range(0, num_rows, block_size):
+        row_block = matrix_a[row_start:row_start + block_size]
+
+        # Skip tiles below the diagonal when comparing a matrix with itself
+        first_col = row_start if matrix_b is None else 0
+
+        for col_start in range(first_col, num_cols, block_size):
+            col_block = other_matrix[col_start:col_start + block_size]
+            diagonal = matrix_b is None and col_start == row_start
+            tile_rows, tile_cols, tile_similarities = _tile_matches(row_block, col_block, feature_slices, threshold,
+                                                                    diagonal=diagonal)
+            rows.append(tile_rows + row_start)
+            cols.append(tile_cols + col_start)
+            similarities.append(tile_similarities)
+
+            if progress is not None and progress(rows[-1], cols[-1], similarities[-1],
+                                                 _tile_num_pairs(len(row_block), len(col_block), diagonal)):
+                return _merge_matches(rows, cols, similarities)
+
+    return _merge_matches(rows, cols, similarities)
+
+
+def _tile_num_pairs(num_rows, num_cols, diagonal=False):
+    # Number of pairs a tile compares. Diagonal tiles of a matrix compared with itself only compare the upper half
+    return num_rows * (num_rows - 1) // 2 if diagonal else num_rows * num_cols
+
+
+def quantized_block_similarities(block_a, block_b, feature_slices):
+    """
+    Same scores as block_similarities for quantized features, computed from integer sums of absolute differences (SAD)
+    per feature. Much less memory traffic than the float64 differences.
+    The integer sums are exact, so the rounded feature means are the same as the ones of block_similarities, unless a
+    mean lies exactly between two 4 decimal values. block_similarities can round these either way, so their scores
+    can differ by up to 2 * 0.0001 and are marked as not exact
+    :param block_a: 2d array of quantized features (see quantize_features)
+    :param block_b: 2d array of quantized features
+    :param feature_slices: column layout of the features: {feature_name: slice, ...}. Slices have to cover all columns
+    :return: tuple of (2d array of similarities with shape (len(block_a), len(block_b)), 2d bool array that is False
+    for scores that are not exact)
+    """
+    # Quantized values are at most FEATURE_SCALE, differences fit 16 bit signed integers
+    diff = np.subtract(block_a.astype(np.int16)[:, None, :], block_b.astype(np.int16)[None, :, :])
+    np.absolute(diff, out=diff)
+
+    slice_starts = sorted(feature_slice.start for feature_slice in feature_slices.values())
+    sads = np.add.reduceat(diff, slice_starts, axis=-1, dtype=np.int32)
+
+    # Same operations in the same feature order as block_similarities, so the floats are bit identical
+    features_diffs = 0
+    exact = np.ones(sads.shape[:2], dtype=bool)
+    for feature_slice in feature_slices.values():
+        feature_sads = sads[:, :, slice_starts.index(feature_slice.start)]
+        num_values = feature_slice.stop - feature_slice.start
+        features_diffs = features_diffs + np.round(feature_sads * (1 / (num_values * FEATURE_SCALE)), FEATURE_DECIMALS)
+
+        # Mean is exactly halfway between two 4 decimal values: sad / num_values = x.5
+        if num_values % 2 == 0:
+            exact &= (2 * feature_sads) % (2 * num_values) != num_values
+
+    return 1 - np.round(features_diffs / len(feature_slices), FEATURE_DECIMALS), exact
+
+
+def _tile_matches(row_block, col_block, feature_slices, threshold, diagonal=False):
+    # Pairs of one tile above the threshold. Diagonal tiles of a matrix compared with itself only keep the upper half
+    if np.issubdtype(row_block.dtype, np.integer):
+        tile, exact = quantized_block_similarities(row_block, col_block, feature_slices)
+        # Scores that are not exact can be up to 2 * 0.0001 too low
+        mask = (tile >= threshold) | (~exact & (tile >= threshold - 2 * 10 ** -FEATURE_DECIMALS - SCORE_ROUNDING_SLACK))
+    else:
+        tile = block_similarities(restore_precision(row_block), restore_precision(col_block), feature_slices)
+        exact = None
+        mask = tile >= threshold
+
+    if diagonal:
+        mask &= np.triu(np.ones(tile.shape, dtype=bool), k=1)  # Only pairs above the diagonal
+
+    tile_rows, tile_cols = np.nonzero(mask)
+    similarities = tile[tile_rows, tile_cols]
+
+    if exact is not None:
+        # Score the pairs without exact score like block_similarities would
+        inexact = np.flatnonzero(~exact[tile_rows, tile_cols])
+        if len(inexact) != 0:
+            similarities[inexact] = pair_similarities(restore_precision(row_block[tile_rows[inexact]]),
+                                                      restore_precision(col_block[tile_cols[inexact]]),
+                                                      feature_slices)
+            above_threshold = similarities >= threshold
+            tile_rows, tile_cols, similarities = (tile_rows[above_threshold], tile_cols[above_threshold],
+                                                  similarities[above_threshold])
+
+    return tile_rows, tile_cols, similarities
+
+
+def _merge_matches(rows, cols, similarities):
+    # Concatenate the matches of all tiles and restore nested loop order (row by row, then column by column). The
+    # order does not depend on the order the tiles were computed in
+    rows, cols, similarities = np.concatenate(rows), np.concatenate(cols), np.concatenate(similarities)
+    order = np.lexsort((cols, rows))
+
+    return rows[order], cols[order], similarities[order]
+
+
+# Feature matrices of a sharded comparison, attached once per worker process: {name: (shared memory, matrix), ...}
+_shard_matrices = {}
+
+
+def _init_shard_worker(matrix_specs):
+    for name, (shm_name, shape, dtype) in matrix_specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shard_matrices[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _compare_shard(task):
+    tiles, feature_slices, threshold, block_size, self_comparison = task
+    matrix_a = _shard_matrices["a"][1]
+    other_matrix = matrix_a if self_comparison else _shard_matrices["b"][1]
+    rows, cols, similarities = [], [], []
+
+    num_pairs = 0
+
+    for row_start, col_start in tiles:
+        row_block = matrix_a[row_start:row_start + block_size]
+        col_block = other_matrix[col_start:col_start + block_size]
+        diagonal = self_comparison and col_start == row_start
+        tile_rows, tile_cols, tile_similarities = _tile_matches(row_block, col_block, feature_slices, threshold,
+                                                                diagonal=diagonal)
+        rows.append(tile_rows + row_start)
+        cols.append(tile_cols + col_start)
+        similarities.append(tile_similarities)
+        num_pairs += _tile_num_pairs(len(row_block), len(col_block), diagonal)
+
+    return rows, cols, similarities, num_pairs
+
+
+def compare_all_pairs_sharded(matrix_a, feature_slices, threshold=0.99, matrix_b=None, workers=None,
+                              block_size=DEFAULT_BLOCK_SIZE, shard_tiles=DEFAULT_SHARD_TILES, progress=None):
+    """
+    Same comparison and result as compare_all_pairs, but the tiles are scored by a pool of worker processes. The
+    feature matrices are copied into shared memory once, so the tasks only contain tile offsets
+    :param matrix_a: 2d feature matrix (see build_feature_matrix)
+    :param feature_slices: column layout of the features: {feature_name: slice, ...}
+    :param threshold: threshold for minimum similarity score for the comparison to be saved
+    :param matrix_b: optional second 2d feature matrix
+    :param workers: number of worker processes. 1 compares in this process, None uses all cpu cores
+    :param block_size: number of images per tile side
+    :param shard_tiles: number of tiles per task
+    :param progress: optional callback, called after every finished task with (row indices, column indices,
+    similarities, number of compared pairs) of that task. If it returns True, the workers are stopped and the pairs
+    found so far are returned
+    :return: tuple of (row indices, column indices, similarities) in the same order as a nested loop would produce
+    """
+    num_rows = len(matrix_a)
+    num_cols = num_rows if matrix_b is None else len(matrix_b)
+
+    # Upper triangle tiles when comparing a matrix with itself, else the full rectangle
+    tiles = [(row_start, col_start) for row_start in range(0, num_rows, block_size)
+             for col_start in range(row_start if matrix_b is None else 0, num_cols, block_size)]
+
+    if workers == 1 or len(tiles) <= 1 or not feature_slices:
+        return compare_all_pairs(matrix_a, feature_slices, threshold=threshold, matrix_b=matrix_b,
+                                 block_size=block_size, progress=progress)
+
+    tasks = [(tiles[start:start + shard_tiles], feature_slices, threshold, block_size, matrix_b is None)
+             for start in range(0, len(tiles), shard_tiles)]
+    rows, cols, similarities = [], [], []
+    with _shard_pool(matrix_a, matrix_b, workers) as pool:
+        for shard_rows, shard_cols, shard_similarities, num_pairs in pool.imap_unordered(_compare_shard, tasks):
+            rows += shard_rows
+            cols += shard_cols
+            similarities += shard_similarities
+
+            if progress is not None and progress(np.concatenate(shard_rows), np.concatenate(shard_cols),
+                                                 np.concatenate(shard_similarities), num_pairs):
+                break  # Leaving the pool terminates the remaining tasks
+
+    return _merge_matches(rows, cols, similarities)
+
+
+@contextlib.contextmanager
+def _shard_pool(matrix_a, matrix_b, workers):
+    # Pool of worker processes with the feature matrices attached (see _init_shard_worker). The matrices are copied
+    # into shared memory once, so tasks only contain indices
+    matrices = {"a": matrix_a} if matrix_b is None else {"a": matrix_a, "b": matrix_b}
+    shared_blocks = []
+    try:
+        matrix_specs = {}
+        for name, matrix in matrices.items():
+            matrix = np.ascontiguousarray(matrix)
+            shm = shared_memory.SharedMemory(create=True, size=matrix.nbytes)
+            shared_blocks.append(shm)
+            np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shm.buf)[:] = matrix
+            matrix_specs[name] = (shm.name, matrix.shape, matrix.dtype.str)
+
+        with multiprocessing.Pool(processes=workers, initializer=_init_shard_worker,
+                                  initargs=(matrix_specs,)) as pool:
+            yield pool
+    finally:
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
+
+
+def hamming_distances(hashes_a, hashes_b):
+    """
+    Count the differing bits of 64 bit hashes
+    :param hashes_a: uint64 array
+    :param hashes_b: uint64 array (broadcast against hashes_a)
+    :return: array of bit counts
+    """
+    xor = np.bitwise_xor(np.asarray(hashes_a, dtype=np.uint64), np.asarray(hashes_b, dtype=np.uint64))
+
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(xor).astype(np.int64)
+
+    # Numpy < 2.0: count bits per byte with a lookup table
+    bytes_view = np.ascontiguousarray(xor).reshape(-1).view(np.uint8).reshape(-1, 8)
+    return POPCOUNT_TABLE[bytes_view].sum(axis=1).reshape(xor.shape)
+
+
+def hash_candidate_pairs(hashes, max_distance, hashes_b=None, chunk_size=1 << 20):
+    """
+    Find all pairs of 64 bit hashes with a hamming distance of at most max_distance without comparing every pair. The
+    hashes are split into max_distance + 1 blocks of bits. Two hashes within max_distance bits of each other are equal
+    in at least one block (pigeonhole principle), so only hashes that share a block value are compared.
+    Large distances give small blocks and large groups of hashes with the same block value. If the groups add up to
+    more pairs than a comparison of all pairs, all pairs are compared instead
+    :param hashes: 1d uint64 array
+    :param max_distance: max number of differing bits
+    :param hashes_b: optional second 1d uint64 array. Pairs of hashes with hashes_b are returned instead of the pairs
+    within hashes
+    :param chunk_size: max number of pairs that are compared at once
+    :return: tuple of (index array a, index array b), sorted by a and then b. b indexes hashes_b if defined, otherwise
+    a < b
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    hashes_b = hashes if hashes_b is None else np.asarray(hashes_b, dtype=np.uint64)
+    within = hashes_b is hashes
+    num_blocks = min(max_distance + 1, 64)
+
+    # Every candidate pair is described as an owner row of hashes and a range of partners in a row order of hashes_b
+    plans = []
+    for block in range(num_blocks):
+        # Blocks of (almost) equal size. Exactly num_blocks blocks are needed for the pigeonhole argument
+        shift = block * 64 // num_blocks
+        block_mask = np.uint64((1 << ((block + 1) * 64 // num_blocks - shift)) - 1)
+        values_b = (hashes_b >> np.uint64(shift)) & block_mask
+        order = np.argsort(values_b, kind="stable")
+        sorted_values = values_b[order]
+
+        if within:
+            # Owners are sorted positions, partners are the later positions with the same block value
+            owners = order
+            starts = np.arange(1, len(hashes) + 1)
+            counts = np.searchsorted(sorted_values, sorted_values, side="right") - starts
+        else:
+            values_a = (hashes >> np.uint64(shift)) & block_mask
+            owners = np.arange(len(hashes))
+            starts = np.searchsorted(sorted_values, values_a, side="left")
+            counts = np.searchsorted(sorted_values, values_a, side="right") - starts
+        plans.append((owners, order, starts, counts))
+
+    num_pairs = len(hashes) * (len(hashes) - 1) // 2 if within else len(hashes) * len(hashes_b)
+    if sum(int(counts.sum()) for _, _, _, counts in plans) > num_pairs:
+        # Every row of hashes with all (later) rows of hashes_b. No pair is found twice
+        starts = np.arange(1, len(hashes) + 1) if within else np.zeros(len(hashes), dtype=np.int64)
+        plans = [(np.arange(len(hashes)), np.arange(len(hashes_b)), starts, len(hashes_b) - starts)]
+
+    pair_keys = [np.empty(0, dtype=np.int64)]
+    for owners, order, starts, counts in plans:
+        for a, b in _range_pairs(owners, order, starts, counts, chunk_size):
+            within_distance = hamming_distances(hashes[a], hashes_b[b]) <= max_distance
+            a, b = a[within_distance], b[within_distance]
+            if within:
+                a, b = np.minimum(a, b), np.maximum(a, b)
+            pair_keys.append(a.astype(np.int64) * len(hashes_b) + b)
+
+    pair_keys = np.unique(np.concatenate(pair_keys))  # Sorted by a, then b. Pairs can share several blocks
+
+    return pair_keys // len(hashes_b), pair_keys % len(hashes_b)
+
+
+def _range_pairs(owners, order, starts, counts, chunk_size):
+    # Pairs (owners[i], order[starts[i] + offset]) for every offset in range(counts[i]). Yielded in chunks of about
+    # chunk_size pairs, so large groups do not need all their pairs in memory at once
+    ends = np.cumsum(counts)
+    first = 0
+    while first < len(counts):
+        done = ends[first - 1] if first != 0 else 0
+        last = max(int(np.searchsorted(ends, done + chunk_size, side="right")), first + 1)
+
+        chunk_counts = counts[first:last]
+        num_chunk_pairs = int(chunk_counts.sum())
+        if num_chunk_pairs != 0:
+            chunk_starts = np.cumsum(chunk_counts) - chunk_counts
+            offsets = np.arange(num_chunk_pairs) - np.repeat(chunk_starts, chunk_counts)
+            yield (np.repeat(owners[first:last], chunk_counts),
+                   order[np.repeat(starts[first:last], chunk_counts) + offsets])
+        first = last
+
+
+def pair_similarities(rows_a, rows_b, feature_slices):
+    """
+    Calculate the similarity of pairs of images. Same score as block_similarities, but only for the given pairs
+    :param rows_a: 2d float64 array of features (see restore_precision)
+    :param rows_b: 2d float64 array of features with the same shape as rows_a
+    :param feature_slices: column layout of the features: {feature_name: slice, ...}
+    :return: 1d array of similarities
+    """
+    diff = np.absolute(rows_a - rows_b)
+
+    features_diffs = 0
+    for feature_slice in feature_slices.values():
+        features_diffs = features_diffs + np.round(np.mean(diff[:, feature_slice], axis=-1), FEATURE_DECIMALS)
+
+    total_diff = np.round(features_diffs / len(feature_slices), FEATURE_DECIMALS)
+
+    return 1 - total_diff
+
+
+def compare_hash_candidates(matrix_a, hashes_a, feature_slices, threshold=0.99, max_hash_distance=4, matrix_b=None,
+                            hashes_b=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Same as compare_all_pairs, but only pairs whose dhashes differ in at most max_hash_distance bits are scored (see
+    hash_candidate_pairs). Pairs with an image without hash are always scored. Finds (near) duplicates only
+    :param matrix_a: 2d feature matrix (see build_feature_matrix)
+    :param hashes_a: list of dhashes (int or None) for every row of matrix_a
+    :param feature_slices: column layout of the features: {feature_name: slice, ...}
+    :param threshold: threshold for minimum similarity score for the comparison to be saved
+    :param max_hash_distance: max number of differing hash bits for a pair to be scored
+    :param matrix_b: optional second 2d feature matrix
+    :param hashes_b: list of dhashes for every row of matrix_b
+    :param block_size: pairs are scored in chunks of block_size * block_size pairs
+    :return: tuple of (row indices, column indices, similarities) in the same order as a nested loop would produce
+    """
+    within = matrix_b is None
+    num_a = len(matrix_a)
+    num_b = num_a if within else len(matrix_b)
+    hashes_b = hashes_a if within else hashes_b
+
+    if num_a == 0 or num_b == 0 or not feature_slices:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    has_hash_a = np.array([img_hash is not None for img_hash in hashes_a], dtype=bool)
+    hash_values_a = np.array([img_hash if img_hash is not None else 0 for img_hash in hashes_a], dtype=np.uint64)
+    has_hash_b = np.array([img_hash is not None for img_hash in hashes_b], dtype=bool)
+    hash_values_b = np.array([img_hash if img_hash is not None else 0 for img_hash in hashes_b], dtype=np.uint64)
+
+    # Candidate pairs among images with hash. Indices of hashed_rows are sorted, so a < b stays true. Only pairs of the
+    # requested comparison are generated, so the work scales with the rows of matrix_a
+    hashed_rows_a, hashed_rows_b = np.flatnonzero(has_hash_a), np.flatnonzero(has_hash_b)
+    a, b = hash_candidate_pairs(hash_values_a[hashed_rows_a], max_hash_distance,
+                                hashes_b=None if within else hash_values_b[hashed_rows_b])
+    a, b = hashed_rows_a[a], hashed_rows_b[b]
+
+    # Images without hash can not be filtered and are paired with every image of the other side
+    unhashed_rows_a, unhashed_rows_b = np.flatnonzero(~has_hash_a), np.flatnonzero(~has_hash_b)
+    if len(unhashed_rows_a) != 0 or len(unhashed_rows_b) != 0:
+        unhashed_a, other_b = np.meshgrid(unhashed_rows_a, np.arange(num_b), indexing="ij")
+        other_a, unhashed_b = np.meshgrid(np.arange(num_a), unhashed_rows_b, indexing="ij")
+        a = np.concatenate([a, unhashed_a.ravel(), other_a.ravel()])
+        b = np.concatenate([b, other_b.ravel(), unhashed_b.ravel()])
+        if within:
+            a, b = np.minimum(a, b), np.maximum(a, b)
+            a, b = a[a != b], b[a != b]
+        pair_keys = np.unique(a * num_b + b)
+        a, b = pair_keys // num_b, pair_keys % num_b
+
+    return compare_candidate_pairs(matrix_a, a, b, feature_slices, threshold=threshold, matrix_b=matrix_b,
+                                   block_size=block_size)
+
+
+def compare_candidate_pairs(matrix_a, rows, cols, feature_slices, threshold=0.99, matrix_b=None,
+                            block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Score candidate pairs (eg. of a prefilter) and keep the ones above the threshold
+    :param matrix_a: 2d feature matrix (see build_feature_matrix)
+    :param rows: 1d array of row indices of matrix_a
+    :param cols: 1d array of row indices of matrix_b (of matrix_a if matrix_b is not defined)
+    :param feature_slices: column layout of the features: {feature_name: slice, ...}
+    :param threshold: threshold for minimum similarity score for the comparison to be saved
+    :param matrix_b: optional second 2d feature matrix
+    :param block_size: pairs are scored in chunks of block_size * block_size pairs
+    :return: tuple of (row indices, column indices, similarities) in the same order as a nested loop would produce
+    """
+    matrix_b = matrix_a if matrix_b is None else matrix_b
+
+    similarities = np.empty(len(rows))
+    chunk_size = block_size * block_size
+    for start in range(0, len(rows), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        similarities[chunk] = pair_similarities(restore_precision(matrix_a[rows[chunk]]),
+                                                restore_precision(matrix_b[cols[chunk]]), feature_slices)
+
+    above_threshold = similarities >= threshold
+    rows, cols, similarities = rows[above_threshold], cols[above_threshold], similarities[above_threshold]
+
+    # Restore nested loop order (row by row, then column by column)
+    order = np.lexsort((cols, rows))
+
+    return rows[order], cols[order], similarities[order]
+
+
+def select_top_k(similarities, k, *keys):
+    """
+    Find the k highest similarities. Ties are broken by the keys, smallest first (eg. row and column index for nested
+    loop order)
+    :param similarities: 1d array of similarities
+    :param k: max number of results
+    :param keys: 1d arrays with the same length as similarities. The first key is compared first
+    :return: index array of the selected similarities, highest first
+    """
+    return np.lexsort(tuple(reversed(keys)) + (-similarities,))[:k]
+
+
+def feature_weights(feature_slices):
+    """
+    Column weights that turn the L1 distance of two rows into the average of the per-feature mean absolute differences
+    (the unrounded difference score of compare_two_images)
+    :param feature_slices: column layout of the features: {feature_name: slice, ...}
+    :return: 1d array of column weights
+    """
+    weights = np.zeros(max(s.stop for s in feature_slices.values()))
+    for feature_slice in feature_slices.values():
+        weights[feature_slice] = 1 / ((feature_slice.stop - feature_slice.start) * len(feature_slices))
+
+    return weights
+
+
+def _sorted_by_reference_distance(matrix, reference, weights, block_size):
+    # Distance of every row to the reference point. By the triangle inequality, two rows can not be closer to each
+    # other than the difference of their reference distances
+    distances = np.concatenate([np.absolute(restore_precision(matrix[start:start + block_size]) - reference) @ weights
+                                for start in range(0, len(matrix), block_size)])
+    order = np.argsort(distances, kind="stable")
+
+    return order, distances[order]
+
+
+def top_k_pairs(matrix_a, feature_slices, k, threshold=0.0, matrix_b=None, block_size=DEFAULT_BLOCK_SIZE,
+                progress=None):
+    """
+    Same comparison as compare_all_pairs, but only the k most similar pairs above the threshold are kept. Memory stays
+    O(k + block_size^2).
+    Rows are sorted by their distance to a reference point, so every tile has a lower bound for the distance of its
+    pairs. Tiles are scored from the closest bound on, and scoring stops once no remaining tile can beat the k-th best
+    pair found so far
+    :param matrix_a: 2d feature matrix (see build_feature_matrix)
+    :param feature_slices: column layout of the features: {feature_name: slice, ...}
+    :param k: max number of pairs
+    :param threshold: threshold for minimum similarity score
+    :param matrix_b: optional second 2d feature matrix
+    :param block_size: number of images per tile side
+    :param progress: optional callback, called after every scored tile with (row indices, column indices,
+    similarities, number of compared pairs). The pairs are the ones of the tile that are among the best k pairs so far
+    (later tiles can replace them). If it returns True, the comparison stops and the best pairs so far are returned
+    :return: tuple of (row indices, column indices, similarities) sorted by similarity (highest first). Ties are in the
+    same order as a nested loop would produce them
+    """
+    best_rows, best_cols, best_similarities = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                                               np.empty(0, dtype=np.float64))
+    num_cols = len(matrix_a) if matrix_b is None else len(matrix_b)
+
+    if len(matrix_a) == 0 or num_cols == 0 or not feature_slices or k <= 0:
+        return best_rows, best_cols, best_similarities
+
+    for tile_bound, rows, cols, diagonal in _top_k_tiles(matrix_a, feature_slices, matrix_b, block_size):
+        # Best possible similarity of any pair in this or any later tile
+        cutoff = best_similarities[-1] if len(best_similarities) == k else threshold
+        if 1 - tile_bound + SCORE_ROUNDING_SLACK < max(cutoff, threshold):
+            break
+
+        new_rows, new_cols, tile_similarities = _score_top_k_tile(matrix_a, matrix_b, rows, cols, diagonal,
+                                                                   feature_slices, max(cutoff, threshold))
+        (best_rows, best_cols, best_similarities), kept = _merge_top_k((best_rows, best_cols, best_similarities),
+                                                                       new_rows, new_cols, tile_similarities, k)
+
+        if progress is not None:
+            if progress(best_rows[kept], best_cols[kept], best_similarities[kept],
+                        _tile_num_pairs(len(rows), len(cols), diagonal)):
+                break
+
+    return best_rows, best_cols, best_similarities
+
+
+def _top_k_tiles(matrix_a, feature_slices, matrix_b, block_size):
+    # Tiles of a top k search as (distance bound, row indices, column indices, diagonal), closest bound first
+    weights = feature_weights(feature_slices)
+    reference = np.mean(matrix_a, axis=0, dtype=np.float64)
+    if np.issubdtype(matrix_a.dtype, np.integer):
+        reference = reference / FEATURE_SCALE
+    reference = np.round(reference, FEATURE_DECIMALS)
+    order_a, distances_a = _sorted_by_reference_distance(matrix_a, reference, weights, block_size)
+    if matrix_b is None:
+        order_b, distances_b = order_a, distances_a
+    else:
+        order_b, distances_b = _sorted_by_reference_distance(matrix_b, reference, weights, block_size)
+
+    # Distance bound of every tile: gap between the reference distance ranges of its rows and columns
+    row_starts, col_starts = np.arange(0, len(order_a), block_size), np.arange(0, len(order_b), block_size)
+    row_low, row_high = distances_a[row_starts], distances_a[np.minimum(row_starts + block_size, len(order_a)) - 1]
+    col_low, col_high = distances_b[col_starts], distances_b[np.minimum(col_starts + block_size, len(order_b)) - 1]
+    tile_bounds = np.maximum(0, np.maximum(col_low[None, :] - row_high[:, None], row_low[:, None] - col_high[None, :]))
+
+    tile_rows, tile_cols = np.nonzero(np.ones(tile_bounds.shape, dtype=bool))
+    if matrix_b is None:
+        upper = tile_cols >= tile_rows  # Skip tiles below the diagonal when comparing a matrix with itself
+        tile_rows, tile_cols = tile_rows[upper], tile_cols[upper]
+    tile_order = np.argsort(tile_bounds[tile_rows, tile_cols], kind="stable")
+
+    return [(tile_bounds[tile_row, tile_col], order_a[row_starts[tile_row]:row_starts[tile_row] + block_size],
+             order_b[col_starts[tile_col]:col_starts[tile_col] + block_size], matrix_b is None and tile_row == tile_col)
+            for tile_row, tile_col in zip(tile_rows[tile_order], tile_cols[tile_order])]
+
+
+def _score_top_k_tile(matrix_a, matrix_b, rows, cols, diagonal, feature_slices, cutoff):
+    # Pairs of one tile of a top k search above the cutoff, as indices into matrix_a and matrix_b
+    pair_rows, pair_cols, similarities = _tile_matches(
+        matrix_a[rows], matrix_a[cols] if matrix_b is None else matrix_b[cols], feature_slices, cutoff,
+        diagonal=diagonal)
+    new_rows, new_cols = rows[pair_rows], cols[pair_cols]
+    if matrix_b is None:
+        new_rows, new_cols = np.minimum(new_rows, new_cols), np.maximum(new_rows, new_cols)
+
+    return new_rows, new_cols, similarities
+
+
+def _merge_top_k(best, new_rows, new_cols, new_similarities, k):
+    # Merge new pairs into the best pairs. Returns the new best pairs and a mask of the ones that are new
+    best_rows, best_cols, best_similarities = best
+    if len(new_rows) == 0:
+        return best, np.zeros(len(best_similarities), dtype=bool)
+
+    num_best = len(best_similarities)
+    best_rows = np.concatenate([best_rows, new_rows])
+    best_cols = np.concatenate([best_cols, new_cols])
+    best_similarities = np.concatenate([best_similarities, new_similarities])
+
+    selected = select_top_k(best_similarities, k, best_rows, best_cols)
+
+    return (best_rows[selected], best_cols[selected], best_similarities[selected]), selected >= num_best
+
+
+def _score_top_k_shard(task):
+    tiles, feature_slices, cutoff, self_comparison = task
+    matrix_a = _shard_matrices["a"][1]
+    matrix_b = None if self_comparison else _shard_matrices["b"][1]
+    rows, cols, similarities = [], [], []
+    num_pairs = 0
+
+    for tile_rows, tile_cols, diagonal in tiles:
+        new_rows, new_cols, tile_similarities = _score_top_k_tile(matrix_a, matrix_b, tile_rows, tile_cols, diagonal,
+                                                                  feature_slices, cutoff)
+        rows.append(new_rows)
+        cols.append(new_cols)
+        similarities.append(tile_similarities)
+        num_pairs += _tile_num_pairs(len(tile_rows), len(tile_cols), diagonal)
+
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(similarities), num_pairs
+
+
+def top_k_pairs_sharded(matrix_a, feature_slices, k, threshold=0.0, matrix_b=None, workers=None,
+                        block_size=DEFAULT_BLOCK_SIZE, shard_tiles=DEFAULT_SHARD_TILES, progress=None):
+    """
+    Same comparison and result as top_k_pairs, but the tiles are scored by a pool of worker processes. Tiles are sent
+    in the same order (closest bound first) in tasks of shard_tiles tiles, with the k-th best similarity known when the
+    task is sent as cutoff. Only two tasks per worker are pending at a time, so once no remaining tile can beat the k-th
+    best pair, at most these tasks are scored on top of the tiles top_k_pairs scores
+    :param matrix_a: 2d feature matrix (see build_feature_matrix)
+    :param feature_slices: column layout of the features: {feature_name: slice, ...}
+    :param k: max number of pairs
+    :param threshold: threshold for minimum similarity score
+    :param matrix_b: optional second 2d feature matrix
+    :param workers: number of worker processes. 1 compares in this process, None uses all cpu cores
+    :param block_size: number of images per tile side
+    :param shard_tiles: number of tiles per task
+    :param progress: optional callback, called after every finished task with (row indices, column indices,
+    similarities, number of compared pairs). The pairs are the ones of the task that are among the best k pairs so far
+    (later tasks can replace them). If it returns True, the workers are stopped and the best pairs so far are returned
+    :return: tuple of (row indices, column indices, similarities) sorted by similarity (highest first). Ties are in the
+    same order as a nested loop would produce them
+    """
+    num_rows = len(matrix_a)
+    num_cols = num_rows if matrix_b is None else len(matrix_b)
+    num_tiles = -(-num_rows // block_size) * -(-num_cols // block_size)
+
+    if workers == 1 or num_tiles <= 1 or not feature_slices or k <= 0:
+        return top_k_pairs(matrix_a, feature_slices, k, threshold=threshold, matrix_b=matrix_b, block_size=block_size,
+                           progress=progress)
+
+    best = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+    tiles = collections.deque(_top_k_tiles(matrix_a, feature_slices, matrix_b, block_size))
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+
+    with _shard_pool(matrix_a, matrix_b, workers) as pool:
+        pending = collections.deque()
+        while True:
+            # Send the next tiles that can still beat the k-th best pair
+            cutoff = max(best[2][-1] if len(best[2]) == k else threshold, threshold)
+            while tiles and len(pending) < max_pending and 1 - tiles[0][0] + SCORE_ROUNDING_SLACK >= cutoff:
+                task_tiles = []
+                while tiles and len(task_tiles) < shard_tiles and 1 - tiles[0][0] + SCORE_ROUNDING_SLACK >= cutoff:
+                    _, tile_rows, tile_cols, diagonal = tiles.popleft()
+                    task_tiles.append((tile_rows, tile_cols, diagonal))
+                pending.append(pool.apply_async(_score_top_k_shard,
+                                                ((task_tiles, feature_slices, cutoff, matrix_b is None),)))
+
+            if not pending:
+                break
+
+            # Oldest task first, its tiles have the closest bounds
+            new_rows, new_cols, new_similarities, num_pairs = pending.popleft().get()
+            best, kept = _merge_top_k(best, new_rows, new_cols, new_similarities, k)
+
+            if progress is not None and progress(best[0][kept], best[1][kept], best[2][kept], num_pairs):
+                break  # Leaving the pool terminates the remaining tasks
+
+    return best
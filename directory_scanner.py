@@ -0,0 +1,150 @@
+import os
+
+
+class DirectoryScanner:
+    """
+    Incremental scanner for image files below a root folder. Keeps a snapshot of every directory (mtime, files and
+    sub folders). Later scans only list the content of directories whose mtime changed.
+    A directory mtime only changes if files are added, removed or renamed. Files that are modified in place keep it, so
+    the known files of unchanged directories are checked with one stat call each (see check_files). That is still much
+    cheaper than listing and filtering the directory. Everything is listed again by the full scan that runs every
+    full_scan_interval scans
+    """
+
+    def __init__(self, root_path, file_filter, full_scan_interval=100, check_files=True):
+        """
+        :param root_path: folder to scan
+        :param file_filter: function that gets a file name and returns True if the file should be included
+        :param full_scan_interval: list and stat every file again after this many incremental scans
+        :param check_files: stat the known files of unchanged directories to find files that were modified in place.
+        If False, a scan without changes costs one stat call per directory, but files modified in place are only found
+        by the full scan or after invalidate
+        """
+        self.root_path = root_path
+        self.file_filter = file_filter
+        self.full_scan_interval = full_scan_interval
+        self.check_files = check_files
+
+        self.directories = {}  # {dir_path: (mtime_ns, {file_path: last_modified, ...}, [sub_dir_path, ...]), ...}
+        self.scans_since_full_scan = 0
+
+    @property
+    def has_snapshot(self):
+        return len(self.directories) != 0
+
+    def get_files(self):
+        """
+        Get all files of the current snapshot in the same order as os.walk would return them
+        :return: dictionary {file_path: last_modified, ...}
+        """
+        files = {}
+        stack = [self.root_path] if self.root_path in self.directories else []
+
+        while stack:
+            _, dir_files, sub_dirs = self.directories[stack.pop()]
+            files.update(dir_files)
+            stack.extend(reversed([sub_dir for sub_dir in sub_dirs if sub_dir in self.directories]))
+
+        return files
+
+    def invalidate(self, dir_path):
+        """
+        List a directory again on the next scan, even if its mtime did not change (eg. a file was modified in place)
+        :param dir_path: path of the directory
+        """
+        if dir_path in self.directories:
+            _, files, sub_dirs = self.directories[dir_path]
+            self.directories[dir_path] = (None, files, sub_dirs)
+
+    def scan(self, full=False):
+        """
+        Update the snapshot and return the changes since the last scan. The first scan returns all files as added
+        :param full: list every directory, even if its mtime did not change
+        :return: tuple of (added files {file_path: last_modified}, removed file paths [file_path, ...],
+        modified files {file_path: last_modified})
+        """
+        full = full or not self.has_snapshot or self.scans_since_full_scan >= self.full_scan_interval
+        self.scans_since_full_scan = 0 if full else self.scans_since_full_scan + 1
+
+        added, removed, modified = {}, [], {}
+        self._scan_directory(self.root_path, full, added, removed, modified)
+
+        return added, removed, modified
+
+    def _scan_directory(self, dir_path, full, added, removed, modified):
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            self._forget_directory(dir_path, removed)
+            return
+
+        snapshot = self.directories.get(dir_path)
+
+        # Content of this directory did not change. Sub folders still have to be checked, their changes do not update
+        # the mtime of this directory
+        if snapshot is not None and not full and snapshot[0] == mtime_ns:
+            if self.check_files:
+                self._check_files(snapshot[1], removed, modified)
+            for sub_dir in snapshot[2]:
+                self._scan_directory(sub_dir, full, added, removed, modified)
+            return
+
+        old_files = snapshot[1] if snapshot is not None else {}
+        old_sub_dirs = snapshot[2] if snapshot is not None else []
+        files, sub_dirs = {}, []
+
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    # Same split as os.walk: symlinked folders are not followed
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            sub_dirs.append(os.path.join(dir_path, entry.name))
+                    elif self.file_filter(entry.name):
+                        try:
+                            files[os.path.join(dir_path, entry.name).replace("\\", "/")] = entry.stat().st_mtime
+                        except OSError:
+                            pass
+        except OSError:
+            self._forget_directory(dir_path, removed)
+            return
+
+        for file_path, last_modified in files.items():
+            if file_path not in old_files:
+                added[file_path] = last_modified
+            elif old_files[file_path] != last_modified:
+                modified[file_path] = last_modified
+
+        removed.extend(file_path for file_path in old_files if file_path not in files)
+
+        for sub_dir in old_sub_dirs:
+            if sub_dir not in sub_dirs:
+                self._forget_directory(sub_dir, removed)
+
+        self.directories[dir_path] = (mtime_ns, files, sub_dirs)
+
+        for sub_dir in sub_dirs:
+            self._scan_directory(sub_dir, full, added, removed, modified)
+
+    def _check_files(self, files, removed, modified):
+        for file_path, last_modified in list(files.items()):
+            try:
+                current_modified = os.stat(file_path).st_mtime
+            except OSError:
+                # Removed after the mtime of its directory was checked. The next scan lists the directory again
+                del files[file_path]
+                removed.append(file_path)
+                continue
+
+            if current_modified != last_modified:
+                files[file_path] = current_modified
+                modified[file_path] = current_modified
+
+    def _forget_directory(self, dir_path, removed):
+        snapshot = self.directories.pop(dir_path, None)
+        if snapshot is None:
+            return
+
+        removed.extend(snapshot[1])
+        for sub_dir in snapshot[2]:
+            self._forget_directory(sub_dir, removed)
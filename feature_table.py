@@ -0,0 +1,197 @@
+import glob
+import os
+import uuid
+import numpy as np
+from comparison_engine import FEATURE_SCALE, QUANTIZED_DTYPE, quantize_features
+
+
+class FeatureTable:
+    """
+    Features of all images as quantized rows of one array (see quantize_features). Feature values are rounded to 4
+    decimals, so they are stored as exact uint16 multiples of 0.0001 (2 bytes per value). Comparisons on the rows use
+    the integer kernels of the comparison engine and do not rebuild matrices from the save file.
+    The table is the feature store of the save file handlers (see SaveFileHandler). Save files only hold the image info,
+    so an image takes 48 bytes of features with the default 6 bins instead of a list of Python floats per feature.
+    Saved tables are loaded as a read-only memory map, so processes that load the same table share one copy in the page
+    cache. The array is copied into memory on the first change
+    """
+
+    def __init__(self, feature_slices=None, growth=1.5):
+        """
+        :param feature_slices: column layout of the features: {feature_name: slice, ...}. Taken from the first image
+        if not defined
+        :param growth: factor the array grows by once it is full
+        """
+        self.growth = growth
+
+        self.feature_slices = None
+        self.matrix = np.empty((0, 0), dtype=QUANTIZED_DTYPE)
+        self.paths = []  # Row index -> image path
+        self.rows = {}  # Image path -> row index
+        self.changed = False  # Set on every change. Used to decide if the table has to be saved
+        self.matrix_file_path = None  # Memory mapped matrix file of a loaded or saved table
+
+        if feature_slices is not None:
+            self._set_feature_slices(feature_slices)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, img_path):
+        return img_path in self.rows
+
+    def _set_feature_slices(self, feature_slices):
+        self.feature_slices = dict(feature_slices)
+        num_columns = sum(s.stop - s.start for s in self.feature_slices.values())
+        self.matrix = np.empty((0, num_columns), dtype=QUANTIZED_DTYPE)
+
+    def _features_to_row(self, img_features):
+        if self.feature_slices is None:
+            feature_slices, start = {}, 0
+            for feature, values in img_features.items():
+                feature_slices[feature] = slice(start, start + len(values))
+                start += len(values)
+            self._set_feature_slices(feature_slices)
+
+        if img_features.keys() != self.feature_slices.keys():
+            raise ValueError(f"Feature names do not match the table ({list(self.feature_slices)}).")
+
+        row = np.concatenate([np.asarray(img_features[feature], dtype=np.float64).ravel()
+                              for feature in self.feature_slices])
+        if len(row) != self.matrix.shape[1]:
+            raise ValueError(f"Feature length {len(row)} does not match the table ({self.matrix.shape[1]}).")
+
+        return quantize_features(row)
+
+    def set(self, img_path, img_features):
+        """
+        Add or replace the features of an image
+        :param img_path: path of the image
+        :param img_features: dictionary of image features: {feature_name: feature_values, ...}
+        """
+        row = self._features_to_row(img_features)
+        self._make_writeable()
+        self.changed = True
+
+        if img_path in self.rows:
+            self.matrix[self.rows[img_path]] = row
+            return
+
+        if len(self.paths) == len(self.matrix):
+            grown = np.empty((max(16, int(len(self.matrix) * self.growth)), self.matrix.shape[1]),
+                             dtype=QUANTIZED_DTYPE)
+            grown[:len(self.paths)] = self.matrix[:len(self.paths)]
+            self.matrix = grown
+
+        self.matrix[len(self.paths)] = row
+        self.rows[img_path] = len(self.paths)
+        self.paths.append(img_path)
+
+    def delete(self, img_path):
+        """
+        Remove an image. The last row takes its place, so the rows stay contiguous
+        :param img_path: path of the image
+        """
+        row = self.rows.pop(img_path, None)
+        if row is None:
+            return
+        self._make_writeable()
+        self.changed = True
+
+        last_path = self.paths.pop()
+        if last_path != img_path:
+            self.matrix[row] = self.matrix[len(self.paths)]
+            self.paths[row] = last_path
+            self.rows[last_path] = row
+
+    def _make_writeable(self):
+        if not self.matrix.flags.writeable:
+            self.matrix = np.array(self.matrix)  # Memory mapped matrix of a loaded table
+
+    def get_features(self, img_path):
+        """
+        :return: dictionary of the image features: {feature_name: feature_values, ...} (float64 arrays)
+        """
+        row = self.matrix[self.rows[img_path]] / FEATURE_SCALE
+        return {feature: row[feature_slice] for feature, feature_slice in self.feature_slices.items()}
+
+    def matrix_for(self, img_paths):
+        """
+        Get the quantized rows of several images as one contiguous matrix
+        :param img_paths: iterable of image paths. Images that are not in the table are left out
+        :return: tuple of (list of image paths, 2d uint16 feature matrix). The matrix is a view without copy if the
+        images are consecutive rows of the table
+        """
+        paths = [img_path for img_path in img_paths if img_path in self.rows]
+        rows = np.array([self.rows[img_path] for img_path in paths], dtype=np.int64)
+
+        if len(rows) != 0 and rows[-1] - rows[0] == len(rows) - 1 and np.all(np.diff(rows) == 1):
+            return paths, self.matrix[rows[0]:rows[-1] + 1]
+
+        return paths, self.matrix[rows].reshape(len(paths), self.matrix.shape[1])
+
+    def save(self, table_file_path):
+        """
+        Save the table as an index file (paths and feature layout) and a matrix file next to it. Every save writes a new
+        matrix file and removes the previous ones, so processes that still have a previous file mapped are not affected
+        :param table_file_path: path of the index file (see table_file_path_for)
+        """
+        matrix_file_prefix = os.path.splitext(table_file_path)[0]
+        matrix_file_path = f"{matrix_file_prefix}.{uuid.uuid4().hex[:12]}.npy"
+        np.save(matrix_file_path, self.matrix[:len(self.paths)])
+
+        feature_names = list(self.feature_slices) if self.feature_slices else []
+        feature_bounds = [(s.start, s.stop) for s in self.feature_slices.values()] if self.feature_slices else []
+        with open(table_file_path + ".tmp", "wb") as table_file:
+            np.savez(table_file, paths=np.array(self.paths, dtype=str),
+                     feature_names=np.array(feature_names, dtype=str),
+                     feature_bounds=np.array(feature_bounds, dtype=np.int64).reshape(-1, 2),
+                     matrix_file=np.array(os.path.basename(matrix_file_path)))
+        os.replace(table_file_path + ".tmp", table_file_path)
+
+        # Open memory maps keep a removed file readable until they are closed (not removable on Windows then)
+        for previous_file_path in glob.glob(glob.escape(matrix_file_prefix) + "." + "[0-9a-f]" * 12 + ".npy"):
+            if os.path.abspath(previous_file_path) != os.path.abspath(matrix_file_path):
+                try:
+                    os.remove(previous_file_path)
+                except OSError:
+                    pass
+
+        self.matrix_file_path = matrix_file_path
+        self.changed = False
+
+    @classmethod
+    def load(cls, table_file_path, **kwargs):
+        """
+        Load a table saved with save(). The matrix is memory mapped read-only
+        :param table_file_path: path of the index file
+        :param kwargs: parameters passed to the constructor
+        :return: FeatureTable
+        """
+        table = cls(**kwargs)
+
+        with np.load(table_file_path) as data:
+            if len(data["feature_names"]) != 0:
+                table._set_feature_slices({str(name): slice(int(start), int(stop)) for name, (start, stop) in
+                                           zip(data["feature_names"], data["feature_bounds"])})
+            table.paths = [str(img_path) for img_path in data["paths"]]
+            matrix_file_path = os.path.join(os.path.dirname(table_file_path), str(data["matrix_file"]))
+
+        matrix = np.load(matrix_file_path, mmap_mode="r")
+        if matrix.dtype != QUANTIZED_DTYPE or matrix.shape != (len(table.paths), table.matrix.shape[1]):
+            raise ValueError(f"Matrix {matrix.shape} does not match the table ({len(table.paths)} images).")
+
+        table.matrix = matrix
+        table.matrix_file_path = matrix_file_path
+        table.rows = {img_path: row for row, img_path in enumerate(table.paths)}
+
+        return table
+
+
+def table_file_path_for(save_file_path):
+    """
+    Get the path of the feature table file that belongs to a save file
+    :param save_file_path: path of the save file
+    :return: path of the table file (eg. savefile.json -> savefile.features.npz)
+    """
+    return os.path.splitext(save_file_path)[0] + ".features.npz"
@@ -0,0 +1,180 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+# inotify constants (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class PollingWatcher:
+    """
+    Fallback watcher. Reports a change every interval seconds, the receiver has to find out what changed
+    """
+    name = "polling"
+
+    def __init__(self, root_path, on_change, interval=3.0):
+        """
+        :param root_path: folder to watch
+        :param on_change: function called from the watcher thread with a set of changed directories (always empty)
+        :param interval: seconds between two reports
+        """
+        self.root_path = root_path
+        self.on_change = on_change
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.on_change(set())
+
+
+class InotifyWatcher:
+    """
+    Linux watcher based on inotify. Watches the root folder and all sub folders and reports the directories with changed
+    image files. Events are debounced: a report is sent once no new event arrived for debounce seconds, but at the
+    latest max_delay seconds after the first event. The thread blocks while nothing happens, so an idle watcher does not
+    use any cpu time
+    """
+    name = "inotify"
+
+    def __init__(self, root_path, on_change, file_filter=None, debounce=0.25, max_delay=0.75):
+        """
+        :param root_path: folder to watch
+        :param on_change: function called from the watcher thread with a set of changed directory paths
+        :param file_filter: function that gets a file name and returns True if changes of the file should be reported
+        :param debounce: seconds without new events before changes are reported
+        :param max_delay: max seconds between the first event and the report during a continuous stream of events
+        """
+        self.root_path = root_path
+        self.on_change = on_change
+        self.file_filter = file_filter
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.watches = {}  # {watch descriptor: dir_path}
+        self.stop_read, self.stop_write = os.pipe()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+        self._watch_tree(root_path)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        os.write(self.stop_write, b"x")
+
+    def _watch_tree(self, dir_path):
+        for path, sub_folders, _ in os.walk(dir_path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                print(f"(!) Can not watch {path} (errno {ctypes.get_errno()}).")
+                continue
+            self.watches[wd] = path
+
+    def _read_events(self, changed_dirs):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + name_length
+
+            dir_path = self.watches.get(wd)
+            if dir_path is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+
+            if mask & IN_ISDIR:
+                # New folders have to be watched too. Their content is found by rescanning the parent folder
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(os.path.join(dir_path, name))
+                changed_dirs.add(dir_path)
+            elif mask & IN_DELETE_SELF or self.file_filter is None or self.file_filter(name):
+                changed_dirs.add(dir_path)
+
+    def _run(self):
+        changed_dirs = set()
+        first_event_time = None
+
+        while True:
+            # Block until an event arrives. With pending changes, only wait until the debounce time is over
+            timeout = None
+            if changed_dirs:
+                timeout = max(0.0, min(self.debounce, first_event_time + self.max_delay - time.monotonic()))
+
+            readable, _, _ = select.select([self.fd, self.stop_read], [], [], timeout)
+
+            if self.stop_read in readable:
+                break
+
+            if self.fd in readable:
+                self._read_events(changed_dirs)
+                if changed_dirs and first_event_time is None:
+                    first_event_time = time.monotonic()
+
+            if changed_dirs and (self.fd not in readable or time.monotonic() - first_event_time >= self.max_delay):
+                self.on_change(changed_dirs)
+                changed_dirs = set()
+                first_event_time = None
+
+        os.close(self.fd)
+        os.close(self.stop_read)
+        os.close(self.stop_write)
+
+
+def create_watcher(root_path, on_change, file_filter=None, mode="auto", interval=3.0):
+    """
+    Create a watcher for a folder. Uses inotify on Linux and polling everywhere else
+    :param root_path: folder to watch
+    :param on_change: function called from the watcher thread with a set of changed directory paths. The set is empty
+    for the polling watcher
+    :param file_filter: function that gets a file name and returns True if changes of the file should be reported
+    :param mode: "auto", "inotify" or "polling"
+    :param interval: seconds between two reports of the polling watcher
+    :return: watcher. Call start() to start watching and stop() to stop
+    """
+    if mode in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root_path, on_change, file_filter=file_filter)
+        except (OSError, AttributeError) as e:
+            if mode == "inotify":
+                raise
+            print("(!) inotify not available, falling back to polling:", e)
+
+    return PollingWatcher(root_path, on_change, interval=interval)
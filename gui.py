@@ -1,9 +1,11 @@
 import tkinter as tk
-from main import ImageCompare
+from thumbnail_cache import ThumbnailLoader
 from tkinter.font import Font
+import logging
 import threading
+import time
 import os
-from PIL import Image, ImageTk
+from PIL import ImageTk
 
 
 class App(tk.Tk):
@@ -20,19 +22,34 @@ class App(tk.Tk):
         "match_list_hover_bg": "white",
         "match_list_active_bg": "sea green"
     }
-
-    def __init__(self, save_file_path="savefile.json"):
+    prefetch_matches = 3  # Thumbnails of this many following matches are loaded in the background
+
+    def __init__(self, save_file_path="savefile.json", max_matches=None, thumbnail_cache_dir=None, lazy_startup=True):
+        """
+        :param save_file_path: path of the save file
+        :param max_matches: only the most similar matches are listed. None lists all matches. Images are not marked as
+        compared while the cap is reached (see ImageCompare.compare_all_images), so a cap keeps later runs from skipping
+        compared images in libraries with more matches
+        :param thumbnail_cache_dir: optional folder to save thumbnails in
+        :param lazy_startup: show the window right away. The comparison modules are imported and the save file is
+        loaded, scanned and its features are updated on a background thread, the stages are shown in the header
+        """
         super().__init__()
 
         """INITIALIZE COMPARE"""
         self.save_file_path = save_file_path
-        self.comparer = ImageCompare(savefile_path=save_file_path)
+        self.comparer = None  # ImageCompare, set once the startup is done (see on_startup_complete)
+        self.max_matches = max_matches  # Only the most similar matches are listed. None lists all matches
+        self.thumbnail_loader = ThumbnailLoader(cache_dir=thumbnail_cache_dir)  # Saves thumbnails if dir is defined
 
         """SESSION VARIABLES"""
         self.running_analysis = False
-        self.matches = {}
-        self.session_next_match_id = 0
-        self.selected_match_id = None
+        self.cancel_analysis_event = threading.Event()
+        self.analysis_start_time = None
+        self.analysis_first_match_id = 0  # Matches from this id on were streamed in by the running analysis
+        self.startup_start_time = time.time()
+        self.cancel_startup_event = threading.Event()
+        self.closing = False
 
         """METADATA"""
         self.title("Image Comparison")
@@ -60,7 +77,17 @@ class App(tk.Tk):
         self.num_files_label = tk.Label(self.info_frame, text="0", bg=self.info_frame.cget("bg"))
         self.num_files_label.grid(row=1, column=1, sticky="w")
 
-        self.update_info()
+        # Analysis Progress Label
+        tk.Label(self.info_frame, text="Progress", bg=self.info_frame.cget("bg"), font=Font(weight="bold", size=9),
+                 fg=App.colors["info_type"]).grid(row=2, column=0, sticky="e")
+        self.progress_label = tk.Label(self.info_frame, text="", bg=self.info_frame.cget("bg"))
+        self.progress_label.grid(row=2, column=1, sticky="w")
+
+        # Startup Status Label
+        tk.Label(self.info_frame, text="Status", bg=self.info_frame.cget("bg"), font=Font(weight="bold", size=9),
+                 fg=App.colors["info_type"]).grid(row=3, column=0, sticky="e")
+        self.status_label = tk.Label(self.info_frame, text="", bg=self.info_frame.cget("bg"))
+        self.status_label.grid(row=3, column=1, sticky="w")
 
         """ANALYSE USER OPTIONS"""
 
@@ -92,13 +119,73 @@ class App(tk.Tk):
         self.overview_frame.pack(side="left", fill="y")
         self.overview_frame.pack_propagate(False)
 
-        self.matches_frame = ScrollableFrame(self.overview_frame)
-        self.matches_frame.pack(fill="both", expand=True)
+        self.match_list = MatchList(self.overview_frame, on_select=self.on_select_match)
+        self.match_list.pack(fill="both", expand=True)
 
         # Match Detail
         self.detail_frame = tk.Frame(self.body_frame, bg=App.colors["match_details"])
         self.detail_frame.pack(side="right", fill="both", expand=True)
 
+        """STARTUP"""
+
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        if lazy_startup:
+            # Analysis can be started once the startup thread is done
+            self.analyze_button.configure(state="disabled", cursor="")
+            self.include_compared_checkbox.configure(state="disabled", cursor="")
+            self.status_label.configure(text="Starting")
+            threading.Thread(target=self.run_startup_thread).start()
+        else:
+            from main import ImageCompare
+            self.on_startup_complete(ImageCompare(savefile_path=save_file_path, comparison_workers=None))
+
+    def run_startup_thread(self):
+        # Heavy modules (cv2, numpy, the comparison engine) are imported here, so they do not delay the window
+        try:
+            from main import ImageCompare
+
+            comparer = ImageCompare(savefile_path=self.save_file_path, comparison_workers=None, lazy=True)
+            comparer.load(status_callback=self.on_startup_status, progress_callback=self.on_startup_progress,
+                          cancel_event=self.cancel_startup_event)
+        except Exception as e:
+            self.call_in_main_thread(self.status_label.configure, {"text": f"Startup failed: {e}"})
+            return
+
+        self.call_in_main_thread(self.on_startup_complete, comparer)
+
+    def on_startup_status(self, status):
+        self.call_in_main_thread(self.status_label.configure, {"text": status})
+
+    def on_startup_progress(self, completed_images, total_images):
+        self.call_in_main_thread(self.status_label.configure,
+                                 {"text": f"Updating features ({completed_images}/{total_images})"})
+
+    def on_startup_complete(self, comparer):
+        self.comparer = comparer
+        self.update_info()
+        self.status_label.configure(text=f"Ready ({round(time.time() - self.startup_start_time, 1)}s)")
+
+        self.analyze_button.configure(state="normal", cursor="hand2")
+        self.include_compared_checkbox.configure(state="normal", cursor="hand2")
+
+    def call_in_main_thread(self, function, *args):
+        # Called from background threads. Tk widgets are only updated from the main thread
+        if self.closing:
+            return
+        try:
+            self.after(0, function, *args)
+        except (RuntimeError, tk.TclError):
+            pass  # Window was closed in the meantime
+
+    def on_close(self):
+        # Background threads stop early. The startup thread still saves the features computed so far
+        self.closing = True
+        self.cancel_startup_event.set()
+        self.cancel_analysis_event.set()
+        self.thumbnail_loader.close()
+        self.destroy()
+
     def update_info(self):
         self.root_directory_label.configure(text=self.data["meta"]["root"])
         self.num_files_label.configure(text=self.data_handler.get_number_of_files())
@@ -112,12 +199,20 @@ class App(tk.Tk):
         return self.comparer.save_file_handler
 
     def on_start_analysis(self):
+        if self.running_analysis:
+            # The button cancels the running analysis. Matches found so far are kept
+            self.cancel_analysis_event.set()
+            self.analyze_button.configure(text="Cancelling", state="disabled", cursor="", bg="light grey")
+            return
+
         self.running_analysis = True
+        self.cancel_analysis_event.clear()
+        self.analysis_start_time = time.time()
+        self.analysis_first_match_id = len(self.match_list.matches)
 
-        self.analyze_button.configure(text="Analysing", state="disabled", cursor="", bg="light grey")
-        self.analyze_button.unbind("<Enter>")
-        self.analyze_button.unbind("<Leave>")
+        self.analyze_button.configure(text="Cancel Analysis")
         self.include_compared_checkbox.configure(state="disabled", cursor="")
+        self.progress_label.configure(text="Starting")
 
         # Create a new thread to run the compare_all_images method
         thread = threading.Thread(target=self.run_analysis_thread)
@@ -125,28 +220,49 @@ class App(tk.Tk):
 
     def run_analysis_thread(self):
         # Run the compare_all_images method in a separate thread
-        results = self.comparer.compare_all_images(skip_compared=not self.include_compared_var.get())
-        self.populate_matches(results)
+        results = self.comparer.compare_all_images(skip_compared=not self.include_compared_var.get(),
+                                                   top_k=self.max_matches,
+                                                   progress_callback=self.on_analysis_progress,
+                                                   cancel_event=self.cancel_analysis_event)
 
         # Use the after method to update the GUI from the main thread
-        self.after(0, self.on_analysis_complete, results)
+        self.call_in_main_thread(self.on_analysis_complete, results)
+
+    def on_analysis_progress(self, new_results, completed_pairs, total_pairs):
+        # Called from the analysis thread
+        self.call_in_main_thread(self.update_analysis_progress, new_results, completed_pairs, total_pairs)
+
+    def update_analysis_progress(self, new_results, completed_pairs, total_pairs):
+        self.populate_matches(new_results)
+
+        elapsed_time = time.time() - self.analysis_start_time
+        pairs_per_second = completed_pairs / max(elapsed_time, 1e-9)
+        remaining_time = (total_pairs - completed_pairs) / pairs_per_second if completed_pairs != 0 else 0
+        self.progress_label.configure(text=f"{completed_pairs * 100 // max(total_pairs, 1)}% | "
+                                           f"{round(pairs_per_second)} pairs/s | "
+                                           f"ETA {int(remaining_time // 60)}:{int(remaining_time % 60):02d}")
+
+    def on_analysis_complete(self, results):
+        # Replace the streamed matches with the final, sorted results
+        if self.match_list.selected_match_id is not None and \
+                self.match_list.selected_match_id >= self.analysis_first_match_id:
+            self.match_list.selected_match_id = None
+            for child in self.detail_frame.winfo_children():
+                child.destroy()
+        self.match_list.set_matches(self.match_list.matches[:self.analysis_first_match_id] + list(results))
+
+        self.running_analysis = False
+        self.progress_label.configure(text=f"{'Cancelled' if self.cancel_analysis_event.is_set() else 'Finished'} "
+                                           f"({len(results)} match{'es' if len(results) != 1 else ''}, "
+                                           f"{round(time.time() - self.analysis_start_time, 1)}s)")
 
-    def on_analysis_complete(self, e):
         self.analyze_button.configure(text="Start Analysis", state="normal", cursor="hand2",
                                       bg=App.colors["analysis_button_base"])
-        self.analyze_button.bind("<Enter>", self._on_analyse_button_enter)
-        self.analyze_button.bind("<Leave>", self._on_analyse_button_leave)
         self.include_compared_checkbox.configure(state="normal", cursor="hand2")
 
     def populate_matches(self, results):
-
-        for match in results:
-            match_frame = MatchFrame(master=self.matches_frame.scrollable_frame, match=match,
-                                     match_id=self.session_next_match_id)
-            match_frame.pack(fill="x")
-
-            self.matches[self.session_next_match_id] = match_frame
-            self.session_next_match_id += 1
+        # Only the visible rows of the match list are widgets, adding matches does not create any
+        self.match_list.add_matches(results)
 
     def _on_analyse_button_enter(self, e):
         self.analyze_button.configure(bg=App.colors["analysis_button_hover"])
@@ -155,15 +271,13 @@ class App(tk.Tk):
         self.analyze_button.configure(bg=App.colors["analysis_button_base"])
 
     def on_select_match(self, match_id):
+        img_1_path, img_2_path, score = self.match_list.matches[match_id]
 
-        if self.selected_match_id is not None and self.selected_match_id != match_id:
-            self.matches[self.selected_match_id].on_deselect()
-
-        self.selected_match_id = match_id
+        self.display_match_detail(images=(img_1_path, img_2_path), score=score)
 
-        self.display_match_detail(images=(self.matches[self.selected_match_id].img_1_path,
-                                          self.matches[self.selected_match_id].img_2_path),
-                                  score=self.matches[self.selected_match_id].score)
+        # Load the images of the next matches in the background, so clicking through the list does not wait for them
+        next_matches = self.match_list.matches[match_id + 1:match_id + 1 + App.prefetch_matches]
+        self.thumbnail_loader.prefetch([img_path for match in next_matches for img_path in match[:2]])
 
     def display_match_detail(self, images, score):
 
@@ -174,38 +288,37 @@ class App(tk.Tk):
         score_label.pack()
 
         for image in images:
-            new_img_frame = ImageDetailFrame(master=self.detail_frame, img_path=image)
+            new_img_frame = ImageDetailFrame(master=self.detail_frame, img_path=image,
+                                             thumbnail_loader=self.thumbnail_loader)
             new_img_frame.pack(side="left")
 
 
 
 
 class MatchFrame(tk.Frame):
-    def __init__(self, match, match_id, *args, **kwargs):
+    """
+    Row of the match list. Rows are recycled while scrolling, show() fills a row with another match
+    """
+    def __init__(self, on_click, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.configure(relief="groove", bd=1, cursor="hand2", bg=App.colors["match_list_base_bg"])
-        self.base_tk = self._get_base_tk()
+        self.on_click = on_click
         self.selected = False
-
-        self.img_1_path = match[0]
-        self.img_2_path = match[1]
-        self.score = match[2]
-        self.id = match_id
+        self.match = None
+        self.id = None
 
         self.img_names_frame = tk.Frame(self)
         self.img_names_frame.pack(side="left")
 
-        self.img_1_label = tk.Label(self.img_names_frame, text=os.path.basename(self.img_1_path), width=18, anchor="w",
-                                    bg=App.colors["match_list_base_bg"])
+        self.img_1_label = tk.Label(self.img_names_frame, width=18, anchor="w", bg=App.colors["match_list_base_bg"])
         self.img_1_label.grid(row=0, column=0, sticky="w")
 
-        self.img_2_label = tk.Label(self.img_names_frame, text=os.path.basename(self.img_2_path), width=18, anchor="w",
-                                    bg=App.colors["match_list_base_bg"])
+        self.img_2_label = tk.Label(self.img_names_frame, width=18, anchor="w", bg=App.colors["match_list_base_bg"])
         self.img_2_label.grid(row=1, column=0, sticky="w")
 
-        self.score_label = tk.Label(self, text=str(int(self.score*100)) + "%", fg=App.colors["comparison_score"],
-                                    font=Font(size=11, weight="bold"), anchor="e", bg=App.colors["match_list_base_bg"])
+        self.score_label = tk.Label(self, fg=App.colors["comparison_score"], font=Font(size=11, weight="bold"),
+                                    anchor="e", bg=App.colors["match_list_base_bg"])
         self.score_label.pack(side="right")
 
         self.bg_widgets = (self, self.img_1_label, self.img_2_label, self.score_label)
@@ -215,6 +328,19 @@ class MatchFrame(tk.Frame):
         for widget in self.bg_widgets:
             widget.bind("<Button-1>", self._on_click)
 
+    def show(self, match, match_id, selected=False):
+        self.id = match_id
+        if match != self.match:
+            self.match = match
+            self.img_1_label.configure(text=os.path.basename(match[0]))
+            self.img_2_label.configure(text=os.path.basename(match[1]))
+            self.score_label.configure(text=str(int(match[2]*100)) + "%")
+
+        if selected:
+            self.on_select()
+        else:
+            self.on_deselect()
+
     def _on_enter(self, e):
         if not self.selected:
             for widget in self.bg_widgets:
@@ -226,14 +352,15 @@ class MatchFrame(tk.Frame):
                 widget.configure(bg=App.colors["match_list_base_bg"])
 
     def _on_click(self, e):
+        self.on_click(self.id)
+
+    def on_select(self):
         self.selected = True
         for widget in self.bg_widgets:
             widget.configure(bg=App.colors["match_list_active_bg"])
 
         self.score_label.configure(fg=App.colors["match_list_hover_bg"])
 
-        self.base_tk.on_select_match(match_id=self.id)
-
     def on_deselect(self):
         self.selected = False
         for widget in self.bg_widgets:
@@ -241,77 +368,132 @@ class MatchFrame(tk.Frame):
 
         self.score_label.configure(fg=App.colors["comparison_score"])
 
-    def _get_base_tk(self):
-        master = self.master
-        while not isinstance(master, tk.Tk):
-            master = master.master
-        return master
-
 
 class ImageDetailFrame(tk.Frame):
-    def __init__(self, img_path, *args, **kwargs):
+    def __init__(self, img_path, thumbnail_loader, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.img_path = img_path
-        self.pil_img = Image.open(img_path).resize((300, 300))
-        self.img_dims = self.pil_img.size
+        self.pil_img = None
+        self.img_dims = None
         self.img_size = os.path.getsize(img_path)
 
-        self.tk_img = ImageTk.PhotoImage(self.pil_img)
+        # Empty image with the thumbnail size until the thumbnail is loaded
+        self.tk_img = tk.PhotoImage(width=thumbnail_loader.size[0], height=thumbnail_loader.size[1])
 
-        self.image_display = tk.Label(self, image=self.tk_img)
+        self.image_display = tk.Label(self, image=self.tk_img, text="Loading", compound="center")
         self.image_display.pack()
 
+        thumbnail = thumbnail_loader.get(img_path, callback=self._on_thumbnail_loaded)
+        if thumbnail is not None:
+            self.show_thumbnail(thumbnail)
+
+    def _on_thumbnail_loaded(self, img_path, thumbnail):
+        # Called from a loading thread. Tk widgets are only updated from the main thread
+        self.after(0, self.show_thumbnail, thumbnail)
 
+    def show_thumbnail(self, thumbnail):
+        if not self.winfo_exists():
+            return  # Another match was selected in the meantime
 
+        if thumbnail is None:
+            self.image_display.configure(text="Can not load image")
+            return
 
-class ScrollableFrame(tk.Frame):
-    def __init__(self, *args, **kwargs):
+        self.pil_img = thumbnail
+        self.img_dims = self.pil_img.size
+        self.tk_img = ImageTk.PhotoImage(self.pil_img)
+        self.image_display.configure(image=self.tk_img, text="")
+
+
+
+
+class MatchList(tk.Frame):
+    """
+    Scrollable list of matches. Only the rows in the visible area are widgets, they are recycled while scrolling. The
+    matches are kept in a list, so adding matches costs no widgets. Only use from the main thread
+    """
+    row_height = 40
+
+    def __init__(self, *args, on_select=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.resize_timer = None  # Prevents lagging by only rezizing content once mouse is let go after rezizing
+        self.on_select = on_select  # Called with the id (index) of the clicked match
 
-        self.scrollable_canvas = tk.Canvas(self, bg=self.cget("bg"), highlightthickness=0, relief='ridge')
+        self.matches = []  # [(img_1_path, img_2_path, score), ...]
+        self.selected_match_id = None
+        self.scroll_offset = 0  # Pixels scrolled from the top of the list
+        self.rows = []  # Recycled MatchFrame widgets
 
-        # Frame inside canvas
-        self.scrollable_frame = tk.Frame(self.scrollable_canvas, bg=self.scrollable_canvas.cget("bg"))
-        self.scrollable_frame.pack(side="left")
-        self.scrollable_frame.bind("<Configure>", lambda e: self.scrollable_canvas.configure(scrollregion=self.scrollable_canvas.bbox("all")))
+        self.rows_frame = tk.Frame(self, bg=self.cget("bg"))
+        self.rows_frame.pack(side="left", fill="both", expand=True)
 
-        # Scrollbar for canvas
-        self.scrollbar = tk.Scrollbar(self, orient="vertical", command=self.scrollable_canvas.yview, troughcolor=self.scrollable_canvas.cget("bg"))
+        # Scrollbar for the list
+        self.scrollbar = tk.Scrollbar(self, orient="vertical", command=self.yview, troughcolor=self.cget("bg"))
         self.scrollbar.pack(side="right", fill="y")
 
-        # Add a window with inner frame inside canvas. Link scrollbar to canvas
-        self.scrollable_canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
-        self.scrollable_canvas.configure(yscrollcommand=self.scrollbar.set)
-        self.scrollable_canvas.pack(side="bottom", fill="both", expand=True)
+        # Bind scrollwheel to the list to enable scrolling with mouse
+        self.rows_frame.bind("<Enter>", lambda x: self.rows_frame.bind_all("<MouseWheel>", self._on_mousewheel))
+        self.rows_frame.bind("<Leave>", lambda x: self.rows_frame.unbind_all("<MouseWheel>"))
 
-        # Bind scrollwheel to canvas to enable scrolling with mouse
-        self.scrollable_frame.bind("<Enter>", lambda x: self.bind_canvas_to_mousewheel(self.scrollable_canvas))
-        self.scrollable_frame.bind("<Leave>", lambda x: self.unbind_canvas_from_mousewheel(self.scrollable_canvas))
+        # Show more or less rows when the list is resized
+        self.rows_frame.bind("<Configure>", lambda e: self.refresh())
 
-        # Bind canvas resize event to update the scrollable frame width
-        self.scrollable_canvas.bind("<Configure>", self.on_canvas_configure)
+    def set_matches(self, matches):
+        self.matches = list(matches)
+        if self.selected_match_id is not None and self.selected_match_id >= len(self.matches):
+            self.selected_match_id = None
+        self.refresh()
 
-    def bind_canvas_to_mousewheel(self, canvas):
-        canvas.bind_all("<MouseWheel>", self._on_mousewheel)
+    def add_matches(self, matches):
+        self.matches.extend(matches)
+        self.refresh()
 
-    def unbind_canvas_from_mousewheel(self, canvas):
-        canvas.unbind_all("<MouseWheel>")
+    def yview(self, *args):
+        # Scrollbar command: ("moveto", fraction) or ("scroll", number, "units" / "pages")
+        if args[0] == "moveto":
+            self.scroll_offset = int(float(args[1]) * len(self.matches) * MatchList.row_height)
+        elif args[0] == "scroll":
+            step = MatchList.row_height if args[2] == "units" else self.rows_frame.winfo_height()
+            self.scroll_offset += int(args[1]) * step
+        self.refresh()
 
     def _on_mousewheel(self, event):
-        self.scrollable_canvas.yview_scroll(int(-1*(event.delta/120)), "units")
+        self.yview("scroll", int(-1*(event.delta/120)), "units")
+
+    def _on_row_click(self, match_id):
+        self.selected_match_id = match_id
+        self.refresh()
+
+        if self.on_select is not None:
+            self.on_select(match_id)
+
+    def refresh(self):
+        view_height = self.rows_frame.winfo_height()
+        list_height = len(self.matches) * MatchList.row_height
+        self.scroll_offset = max(0, min(self.scroll_offset, list_height - view_height))
+
+        # Create rows for the visible area. Partly visible rows at the top and bottom need one row more
+        first_visible = self.scroll_offset // MatchList.row_height
+        num_visible = view_height // MatchList.row_height + 2
+        while len(self.rows) < num_visible:
+            self.rows.append(MatchFrame(master=self.rows_frame, on_click=self._on_row_click))
 
-    def on_canvas_configure(self, event):
-        if self.resize_timer is not None:
-            self.after_cancel(self.resize_timer)
-        self.resize_timer = self.after(200, self.update_scrollable_frame_width, event.width)
+        for row_index, row in enumerate(self.rows):
+            match_id = first_visible + row_index
+            if row_index < num_visible and match_id < len(self.matches):
+                row.show(self.matches[match_id], match_id, selected=match_id == self.selected_match_id)
+                row.place(x=0, y=match_id * MatchList.row_height - self.scroll_offset, relwidth=1,
+                          height=MatchList.row_height)
+            else:
+                row.place_forget()
 
-    def update_scrollable_frame_width(self, width):
-        self.scrollable_canvas.itemconfig(self.scrollable_canvas.create_window((0, 0), window=self.scrollable_frame,
-                                                                               anchor="nw"), width=width)
+        if list_height > view_height:
+            self.scrollbar.set(self.scroll_offset / list_height, (self.scroll_offset + view_height) / list_height)
+        else:
+            self.scrollbar.set(0, 1)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="(i) %(message)s")
     app = App()
     app.mainloop()
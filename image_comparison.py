@@ -3,18 +3,75 @@ import os
 import cv2
 import time
 import numpy as np
-from PIL import Image
+from PIL import Image, ExifTags
 from typing import Union
 import base64
 import io
+import multiprocessing
+import functools
+import hashlib
+from instrumentation import instrumentation
+
+EDGE_BLOCK_SIZE = 8  # Images per block in edge_histograms
+
+DECODE_PATHS = ("exif_thumbnail", "dct_scaled", "full")  # See decode_img
 
 
 def load_img(path, load_size=250):
-    pil_img = Image.open(path)
-    pil_img.draft('RGB', (load_size, load_size))  # Using shrink-on-load to speed up image load times significantly
-    img = np.array(pil_img, dtype=np.uint8)
+    return decode_img(path, load_size)[0]
 
-    return img
+
+def decode_img(path, load_size=250, fast_ingest=False, min_thumbnail_size=120):
+    """
+    Load an image with as little decoding as possible. Returns the first possible decode path:
+    - "exif_thumbnail": only with fast_ingest. JPEG thumbnail embedded in the EXIF data, if its shorter side has at
+    least min_thumbnail_size pixels and it has the aspect ratio of the image. Only the file header is read. Features
+    of the thumbnail differ slightly from the ones of the decoded image
+    - "dct_scaled": JPEG decoded at the smallest DCT scale (1/2, 1/4 or 1/8) that keeps load_size pixels per side
+    - "full": all other images. PIL can not decode other formats at a reduced size
+    :param path: path of the image
+    :param load_size: min size of JPEG images that are decoded at a reduced scale
+    :param fast_ingest: try the EXIF thumbnail first
+    :param min_thumbnail_size: min size of the EXIF thumbnail (shorter side)
+    :return: tuple of (3d numpy array of image pixel values, decode path)
+    """
+    with Image.open(path) as pil_img:
+        if fast_ingest and pil_img.format in ("JPEG", "MPO"):
+            thumbnail = exif_thumbnail(pil_img)
+            if thumbnail is not None and min(thumbnail.size) >= min_thumbnail_size and \
+                    abs(thumbnail.width * pil_img.height / (thumbnail.height * pil_img.width) - 1) < 0.05:
+                return np.array(thumbnail.convert("RGB"), dtype=np.uint8), "exif_thumbnail"
+
+        full_size = pil_img.size
+        pil_img.draft('RGB', (load_size, load_size))  # Using shrink-on-load to speed up image load times significantly
+        img = np.array(pil_img, dtype=np.uint8)
+
+        return img, "dct_scaled" if pil_img.size != full_size else "full"
+
+
+def exif_thumbnail(pil_img):
+    """
+    Get the JPEG thumbnail embedded in the EXIF data of an opened image. EXIF data is part of the file header, so no
+    image data is read
+    :param pil_img: opened PIL image
+    :return: PIL image of the thumbnail or None if the image has no (valid) thumbnail
+    """
+    exif_data = pil_img.info.get("exif")
+    if not exif_data:
+        return None
+
+    try:
+        thumbnail_ifd = pil_img.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = thumbnail_ifd[ExifTags.Base.JpegIFOffset], thumbnail_ifd[ExifTags.Base.JpegIFByteCount]
+
+        # Offsets are relative to the TIFF header after the "Exif\0\0" marker
+        start = offset + (6 if exif_data.startswith(b"Exif\x00\x00") else 0)
+        thumbnail = Image.open(io.BytesIO(exif_data[start:start + length]))
+        thumbnail.load()
+    except Exception:
+        return None
+
+    return thumbnail
 
 
 def load_img_from_b64(b64_string, load_size=250):
@@ -80,12 +137,228 @@ def edge_histogram(img_data, bins=8):
     return hist_data_norm
 
 
-def get_img_features(img_data, bins=8, resize: Union[bool, int] = False):
+def color_histogram_fast(img_data, bins=8):
+    """
+    Same features as color_histogram, computed from the value counts of each channel (one counting pass). The counts
+    are binned with the same bin edges as np.histogram (range from the darkest to the brightest value of the channel)
+    :param img_data: 3d numpy array of image pixel values
+    :param bins: number of bins (features) per color
+    :return: 1d float32 array of feature values. Length based on the bins (bins times 3 because of 3 colors)
+    """
+    # Verify image shape
+    if len(img_data.shape) != 3:
+        raise Exception(f"Image has wrong channel dimensions (Needs to be 3, image has {len(img_data.shape)}).")
+
+    if img_data.dtype != np.uint8:
+        return color_histogram(img_data, bins=bins).astype(np.float32)
+
+    num_of_pixels = img_data.shape[0] * img_data.shape[1]
+
+    # Count every value of every channel. calcHist counts in float32, which is only exact up to 2**24 pixels
+    if num_of_pixels < 2 ** 24:
+        value_counts = np.stack([cv2.calcHist([img_data], [i], None, [256], [0, 256]).ravel().astype(np.int64)
+                                 for i in range(3)])
+    else:
+        # One pass over all channels. Channel i uses the counters i*256 to i*256+255
+        pixels = img_data[:, :, :3].reshape(-1, 3) + np.array([0, 256, 512], dtype=np.uint16)
+        value_counts = np.bincount(pixels.ravel(), minlength=3 * 256).reshape(3, 256)
+
+    # Bin the 256 value counts instead of the pixels
+    return_data = np.empty(3 * bins, dtype=np.float32)
+    for i, channel_counts in enumerate(value_counts):
+        values = np.flatnonzero(channel_counts)
+        hist_data, _ = np.histogram(values, bins=bins, range=(values[0], values[-1]), weights=channel_counts[values])
+        return_data[i * bins:(i + 1) * bins] = np.round(hist_data / num_of_pixels, 4)  # Normalize
+
+    return return_data
+
+
+@functools.lru_cache(maxsize=None)
+def _orientation_bins(bins):
+    # np.gradient of an uint8 image only has multiples of 0.5 between -255 and 255. Bin the orientation of every
+    # possible (gx, gy) pair once, with the same bin edges as the histogram in edge_histogram
+    gradient_values = np.arange(-2 * 255, 2 * 255 + 1) / 2
+    eo = np.arctan2(gradient_values[None, :], gradient_values[:, None])  # [gx, gy]
+    bin_edges = np.linspace(-np.pi, np.pi, bins + 1)
+    orientation_bins = np.clip(np.searchsorted(bin_edges, eo.ravel(), side="right") - 1, 0, bins - 1)
+
+    return orientation_bins.astype(np.min_scalar_type(bins - 1))
+
+
+def edge_histogram_fast(img_data, bins=8):
+    """
+    Same features as edge_histogram. The orientation bin of every pixel is looked up from its doubled integer
+    gradients, so no float gradient or arctan arrays are computed
+    :param img_data:  3d numpy array of image pixel values
+    :param bins: number of bins (features)
+    :return: 1d float32 array of feature values. Length equal to the bins
+    """
+    greyscale_img = cv2.cvtColor(img_data, cv2.COLOR_BGR2GRAY)
+
+    if greyscale_img.dtype != np.uint8 or min(greyscale_img.shape) < 2:
+        return edge_histogram(img_data, bins=bins).astype(np.float32)
+
+    # Doubled gradients of np.gradient (central differences inside, one sided differences at the borders)
+    grey = greyscale_img.astype(np.int16)
+    gx2 = np.empty_like(grey)
+    gx2[1:-1] = grey[2:] - grey[:-2]
+    gx2[0] = 2 * (grey[1] - grey[0])
+    gx2[-1] = 2 * (grey[-1] - grey[-2])
+    gy2 = np.empty_like(grey)
+    gy2[:, 1:-1] = grey[:, 2:] - grey[:, :-2]
+    gy2[:, 0] = 2 * (grey[:, 1] - grey[:, 0])
+    gy2[:, -1] = 2 * (grey[:, -1] - grey[:, -2])
+
+    # Calculate histogram values and normalize
+    lookup_index = (gx2.astype(np.int32) + 2 * 255) * (4 * 255 + 1) + (gy2 + 2 * 255)
+    hist_data = np.bincount(_orientation_bins(bins)[lookup_index.ravel()], minlength=bins)
+    total_edges = lookup_index.size
+
+    return np.round(hist_data / total_edges, 4).astype(np.float32)
+
+
+def color_histograms(img_stack, bins=8):
+    """
+    Batched color_histogram_fast. Calculate the color features of a stack of equally sized images
+    :param img_stack: 4d uint8 array of shape (number of images, height, width, 3)
+    :param bins: number of bins (features) per color
+    :return: 2d float32 array of shape (number of images, bins * 3)
+    """
+    num_images, height, width, _ = img_stack.shape
+
+    # Value counts of every channel of every image. Rows are (image, channel) pairs
+    value_counts = np.empty((num_images * 3, 256), dtype=np.int64)
+    for i, img_data in enumerate(img_stack):
+        for channel in range(3):
+            value_counts[i * 3 + channel] = cv2.calcHist([img_data], [channel], None, [256], [0, 256]).ravel()
+
+    # Same bin edges as np.histogram: range from the darkest to the brightest value of the channel, widened by 0.5 on
+    # both sides if all values are equal
+    present = value_counts > 0
+    first_edges = np.argmax(present, axis=1).astype(np.float64)
+    last_edges = 255 - np.argmax(present[:, ::-1], axis=1).astype(np.float64)
+    equal = first_edges == last_edges
+    first_edges[equal] -= 0.5
+    last_edges[equal] += 0.5
+    bin_edges = np.linspace(first_edges, last_edges, bins + 1, axis=1)
+
+    # A value belongs to the bin of the last inner edge that is not above it (the last bin includes its upper edge)
+    value_bins = np.sum(np.arange(256)[None, :, None] >= bin_edges[:, None, 1:-1], axis=2)
+    row_offsets = np.arange(num_images * 3)[:, None] * bins
+    hist_data = np.bincount((value_bins + row_offsets).ravel(), weights=value_counts.ravel(),
+                            minlength=num_images * 3 * bins)
+
+    return np.round(hist_data / (height * width), 4).astype(np.float32).reshape(num_images, 3 * bins)
+
+
+def edge_histograms(img_stack, bins=8):
+    """
+    Batched edge_histogram_fast. Calculate the edge orientation features of a stack of equally sized images
+    :param img_stack: 4d uint8 array of shape (number of images, height, width, 3)
+    :param bins: number of bins (features)
+    :return: 2d float32 array of shape (number of images, bins)
+    """
+    num_images, height, width, _ = img_stack.shape
+    hist_data = np.empty((num_images, bins), dtype=np.int64)
+
+    # Work on blocks of a few images. Keeps the temporary arrays small enough to stay in the cpu cache
+    for block_start in range(0, num_images, EDGE_BLOCK_SIZE):
+        block = np.ascontiguousarray(img_stack[block_start:block_start + EDGE_BLOCK_SIZE])
+        block_size = len(block)
+
+        # Convert all images of the block at once by treating them as one tall image
+        grey = cv2.cvtColor(block.reshape(block_size * height, width, 3), cv2.COLOR_BGR2GRAY)
+        grey = grey.reshape(block_size, height, width).astype(np.int16)
+
+        # Doubled gradients of np.gradient (central differences inside, one sided differences at the borders)
+        gx2 = np.empty_like(grey)
+        gx2[:, 1:-1] = grey[:, 2:] - grey[:, :-2]
+        gx2[:, 0] = 2 * (grey[:, 1] - grey[:, 0])
+        gx2[:, -1] = 2 * (grey[:, -1] - grey[:, -2])
+        gy2 = np.empty_like(grey)
+        gy2[:, :, 1:-1] = grey[:, :, 2:] - grey[:, :, :-2]
+        gy2[:, :, 0] = 2 * (grey[:, :, 1] - grey[:, :, 0])
+        gy2[:, :, -1] = 2 * (grey[:, :, -1] - grey[:, :, -2])
+
+        # Look up the orientation bins of all images of the block at once
+        lookup_index = gx2.astype(np.int32)
+        lookup_index *= 4 * 255 + 1
+        lookup_index += gy2
+        lookup_index += 2 * 255 * (4 * 255 + 1) + 2 * 255
+        orientation_bins = _orientation_bins(bins)[lookup_index]
+
+        # Counting per image is faster than one bincount over offset bins of the whole block
+        for i, img_bins in enumerate(orientation_bins):
+            hist_data[block_start + i] = np.bincount(img_bins.ravel(), minlength=bins)
+
+    return np.round(hist_data / (height * width), 4).astype(np.float32)
+
+
+def get_batch_features(img_stack, bins=8):
+    """
+    Calculate the image features for a stack of equally sized images. Same values as get_img_features
+    :param img_stack: 4d uint8 array of shape (number of images, height, width, 3)
+    :param bins: number of features per feature type (eg. color green or edge orientation)
+    :return: 2d float32 feature matrix of shape (number of images, bins * 4). Columns are laid out as described by
+    batch_feature_slices
+    """
+    if len(img_stack.shape) != 4 or img_stack.shape[3] != 3 or img_stack.dtype != np.uint8:
+        raise Exception(f"Image stack has wrong shape (Needs to be N x H x W x 3 uint8, is {img_stack.shape} "
+                        f"{img_stack.dtype}).")
+
+    if min(img_stack.shape[1:3]) < 2:
+        raise Exception(f"Images are too small ({img_stack.shape[2]}x{img_stack.shape[1]}px).")
+
+    return np.hstack([color_histograms(img_stack, bins=bins), edge_histograms(img_stack, bins=bins)])
+
+
+def batch_feature_slices(bins=8):
+    """
+    Column layout of the matrix returned by get_batch_features
+    :param bins: number of features per feature type
+    :return: dictionary {feature_name: slice, ...}
+    """
+    return {"color": slice(0, 3 * bins), "edge_orientation": slice(3 * bins, 4 * bins)}
+
+
+def dhash(img_data, hash_size=8):
+    """
+    Calculate the difference hash (dHash) of an image. Each bit tells if a pixel of a tiny greyscale version of the
+    image is brighter than its right neighbour. Exact and near-exact duplicates have (almost) the same hash
+    :param img_data: 3d numpy array of image pixel values (or 2d for greyscale images)
+    :param hash_size: hash has hash_size * hash_size bits
+    :return: int of hash_size * hash_size bits
+    """
+    greyscale_img = cv2.cvtColor(img_data, cv2.COLOR_BGR2GRAY) if len(img_data.shape) == 3 else img_data
+    small_img = cv2.resize(greyscale_img, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small_img[:, 1:] > small_img[:, :-1]
+
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def content_hash(file_path, chunk_size=2 ** 20):
+    """
+    Calculate the BLAKE2 hash of the file content. Byte identical copies have the same hash. The file is read in chunks,
+    so large files are never loaded at once
+    :param file_path: path of the file
+    :param chunk_size: number of bytes read at once
+    :return: hex string of the hash (32 characters)
+    """
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def get_img_features(img_data, bins=8, resize: Union[bool, int] = False, fast_histograms=False):
     """
     Calculate the image features for one image
     :param img_data: 3d numpy array of image pixel values
     :param bins: number of features per feature type (eg. color green or edge orientation)
     :param resize: False or int. resize image data before computing features (saves a lot of feature compute time)
+    :param fast_histograms: use color_histogram_fast and edge_histogram_fast. Same values, returned as float32 arrays
     :return: dictionary of features
     """
     return_data = {}
@@ -96,11 +369,11 @@ def get_img_features(img_data, bins=8, resize: Union[bool, int] = False):
 
     try:
         # Get color features
-        hist_data = color_histogram(img_data, bins=bins)
+        hist_data = (color_histogram_fast if fast_histograms else color_histogram)(img_data, bins=bins)
         return_data["color"] = hist_data
 
         # Get edge normal orientation features
-        edge_data = edge_histogram(img_data, bins=bins)
+        edge_data = (edge_histogram_fast if fast_histograms else edge_histogram)(img_data, bins=bins)
         return_data["edge_orientation"] = edge_data
     except Exception as e:
         # print("(!) Could not calculate features for image:", e)
@@ -109,6 +382,119 @@ def get_img_features(img_data, bins=8, resize: Union[bool, int] = False):
     return return_data
 
 
+def _file_features(task):
+    file_path, bins, resize, fast_histograms, fast_ingest = task
+    decode_path = None
+    try:
+        with instrumentation.span("decode"):
+            img_data, decode_path = decode_img(file_path, fast_ingest=fast_ingest)
+        with instrumentation.span("extract"):
+            img_features = get_img_features(img_data, bins=bins, resize=resize, fast_histograms=fast_histograms)
+    except Exception as e:
+        return file_path, None, None, decode_path
+
+    try:
+        img_hash = dhash(img_data)
+    except Exception as e:
+        img_hash = None
+
+    return file_path, img_features, img_hash, decode_path
+
+
+def _files_batch_features(task):
+    file_paths, bins, resize, fast_ingest = task
+    results = {}
+    batches = {}  # {image shape: [(file_path, img_data, img_hash), ...]}
+    decode_paths = {}
+
+    # Decode all images. Images of the same shape are stacked and computed at once
+    for file_path in file_paths:
+        try:
+            with instrumentation.span("decode"):
+                img_data, decode_paths[file_path] = decode_img(file_path, fast_ingest=fast_ingest)
+        except Exception as e:
+            results[file_path] = (file_path, None, None, None)
+            continue
+
+        try:
+            img_hash = dhash(img_data)
+        except Exception as e:
+            img_hash = None
+
+        if resize:
+            img_data = cv2.resize(img_data, (resize, resize))
+
+        if img_data.dtype == np.uint8 and len(img_data.shape) == 3 and img_data.shape[2] in (3, 4) and \
+                min(img_data.shape[:2]) >= 2:
+            batches.setdefault(img_data.shape[:2], []).append((file_path, img_data[:, :, :3], img_hash))
+            continue
+
+        # Image can not be stacked (eg. greyscale images). Fails the same way as in get_img_features
+        try:
+            results[file_path] = (file_path, get_img_features(img_data, bins=bins, fast_histograms=True), img_hash,
+                                  decode_paths[file_path])
+        except Exception as e:
+            results[file_path] = (file_path, None, None, decode_paths[file_path])
+
+    feature_slices = batch_feature_slices(bins)
+    for batch in batches.values():
+        with instrumentation.span("extract"):
+            feature_matrix = get_batch_features(np.stack([img_data for _, img_data, _ in batch]), bins=bins)
+        for (file_path, _, img_hash), img_features in zip(batch, feature_matrix):
+            results[file_path] = (file_path, {feature: img_features[feature_slice]
+                                              for feature, feature_slice in feature_slices.items()}, img_hash,
+                                  decode_paths[file_path])
+
+    return [results[file_path] for file_path in file_paths]
+
+
+def get_files_features(file_paths, bins=8, resize: Union[bool, int] = False, workers=1, chunksize=16,
+                       fast_histograms=False, batch_size=None, fast_ingest=False):
+    """
+    Calculate the image features for many image files. Optionally on a pool of worker processes
+    :param file_paths: list of image file paths
+    :param bins: number of features per feature type (eg. color green or edge orientation)
+    :param resize: False or int. resize image data before computing features (saves a lot of feature compute time)
+    :param workers: number of worker processes. 1 computes the features in this process, None uses all cpu cores
+    :param chunksize: number of files sent to a worker at once
+    :param fast_histograms: use the fast histogram kernels (see get_img_features)
+    :param batch_size: None computes the features image by image. Otherwise the images are decoded in chunks of this
+    many files and their features are computed with get_batch_features (same values as the fast histogram kernels).
+    Each chunk is one task for the worker processes, chunksize is not used
+    :param fast_ingest: compute the features of JPEG images from their EXIF thumbnail if they have one (see decode_img)
+    :return: generator of tuples (file_path, dictionary of features, dhash of the image, decode path). Features and hash
+    are None if they could not be computed, the decode path (see decode_img) is None if the image could not be loaded.
+    With more than one worker the results are yielded in order of completion
+    """
+    if batch_size:
+        batch_tasks = [(file_paths[i:i + batch_size], bins, resize, fast_ingest)
+                       for i in range(0, len(file_paths), batch_size)]
+
+        if workers == 1 or len(batch_tasks) <= 1:
+            for task in batch_tasks:
+                yield from _files_batch_features(task)
+            return
+
+        # Decode and extract spans of the workers are merged into the run of this thread
+        with multiprocessing.Pool(processes=workers) as pool:
+            for results, run in pool.imap_unordered(instrumentation.worker_task(_files_batch_features), batch_tasks):
+                instrumentation.merge(run)
+                yield from results
+        return
+
+    tasks = [(file_path, bins, resize, fast_histograms, fast_ingest) for file_path in file_paths]
+
+    if workers == 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield _file_features(task)
+        return
+
+    with multiprocessing.Pool(processes=workers) as pool:
+        for result, run in pool.imap_unordered(instrumentation.worker_task(_file_features), tasks, chunksize=chunksize):
+            instrumentation.merge(run)
+            yield result
+
+
 def compare_features(features_a, features_b):
     """
     Calculate absolute difference between 2 feature arrays
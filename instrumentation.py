@@ -0,0 +1,194 @@
+import contextlib
+import cProfile
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("image_comparison")
+
+
+class Instrumentation:
+    """
+    Collects timings (spans) and counters of a run. A run is one call of an entry point (see entry_point), calls of
+    other entry points inside it are part of the same run. At the end of a run its summary is logged and optionally
+    written to a json file, then a new run starts.
+    Every thread has its own run, so runs of different threads (eg. a GUI worker thread and the Tk thread) do not mix
+    their timings. Spans and counters of worker processes are only part of the run for tasks wrapped with worker_task.
+    Other worker processes (eg. the sharded comparison) are covered by the spans of the calling thread only
+    """
+
+    def __init__(self, summary_dir=None, profile_dir=None):
+        """
+        :param summary_dir: optional folder to write a json summary of every run to
+        :param profile_dir: optional folder to write a cProfile file of every run to
+        """
+        self.summary_dir = summary_dir
+        self.profile_dir = profile_dir
+
+        # Entry point depth and run of the current thread. Runs are {"spans": {span_name: [count, total_seconds,
+        # max_seconds], ...}, "counters": {counter_name: value, ...}}
+        self.local = threading.local()
+
+    def configure(self, summary_dir=None, profile_dir=None):
+        self.summary_dir = summary_dir
+        self.profile_dir = profile_dir
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Time a block of code: with instrumentation.span("io.write_save_file"): ...
+        :param name: name of the span. Spans with the same name are added up
+        """
+        timer_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - timer_start)
+
+    @property
+    def run(self):
+        if not hasattr(self.local, "run"):
+            self.local.run = {"spans": {}, "counters": {}}
+        return self.local.run
+
+    def add_time(self, name, seconds, count=1, max_seconds=None):
+        span = self.run["spans"].setdefault(name, [0, 0.0, 0.0])
+        span[0] += count
+        span[1] += seconds
+        span[2] = max(span[2], seconds if max_seconds is None else max_seconds)
+
+    def get_time(self, name):
+        """
+        :return: total seconds of a span in the current run of this thread
+        """
+        return self.run["spans"].get(name, [0, 0.0, 0.0])[1]
+
+    def count(self, name, value=1):
+        counters = self.run["counters"]
+        counters[name] = counters.get(name, 0) + value
+
+    def summary(self, run_name=None):
+        """
+        :return: dictionary of the spans and counters of the current run of this thread
+        """
+        return {"run": run_name,
+                "spans": {name: {"count": count, "seconds": total, "max_seconds": maximum}
+                          for name, (count, total, maximum) in sorted(self.run["spans"].items())},
+                "counters": dict(sorted(self.run["counters"].items()))}
+
+    def reset(self):
+        self.local.run = {"spans": {}, "counters": {}}
+
+    def merge(self, run):
+        """
+        Add the spans and counters of another run (eg. of a worker process, see worker_task) to the current run
+        :param run: run as returned by worker_task
+        """
+        for name, (count, total, maximum) in run["spans"].items():
+            self.add_time(name, total, count=count, max_seconds=maximum)
+        for name, value in run["counters"].items():
+            self.count(name, value)
+
+    def worker_task(self, function):
+        """
+        Wrap the task function of a worker process pool, so the spans and counters of its tasks can be merged into the
+        run of the calling thread. The wrapped function returns (result, run), the caller passes run to merge
+        :param function: module level task function
+        :return: picklable callable
+        """
+        return WorkerTask(function)
+
+    def export_summary(self, run_name):
+        """
+        Log the summary of the current run and write it to the summary folder if defined
+        :param run_name: name of the run (entry point)
+        :return: summary dictionary
+        """
+        run_summary = self.summary(run_name)
+        run_summary["finished"] = time.time()
+
+        # Summaries are only logged at debug level unless they were requested with a summary folder
+        logger.log(logging.INFO if self.summary_dir is not None else logging.DEBUG, "Run summary: %s",
+                   json.dumps(run_summary))
+
+        if self.summary_dir is not None:
+            try:
+                os.makedirs(self.summary_dir, exist_ok=True)
+                summary_path = os.path.join(self.summary_dir, f"{run_name}_{time.strftime('%Y%m%d_%H%M%S')}_"
+                                                              f"{os.getpid()}_{threading.get_ident()}.json")
+                with open(summary_path, "w") as json_file:
+                    json.dump(run_summary, json_file, indent=4)
+            except OSError as e:
+                logger.warning("Can not write run summary: %s", e)
+
+        return run_summary
+
+    def entry_point(self, name):
+        """
+        Decorator for entry points (eg. ImageCompare.compare_all_images). The call is timed as span name. The outermost
+        entry point call of a thread is a run: it is profiled if a profile folder is defined and its summary is exported
+        when it returns
+        :param name: name of the entry point
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                depth = getattr(self.local, "depth", 0)
+                if depth != 0:
+                    with self.span(name):
+                        return function(*args, **kwargs)
+
+                self.reset()
+                self.local.depth = 1
+                profiler = cProfile.Profile() if self.profile_dir is not None else None
+                try:
+                    with self.span(name):
+                        if profiler is None:
+                            return function(*args, **kwargs)
+                        return profiler.runcall(function, *args, **kwargs)
+                finally:
+                    self.local.depth = 0
+                    if profiler is not None:
+                        self._dump_profile(profiler, name)
+                    self.export_summary(name)
+
+            return wrapper
+
+        return decorator
+
+    def _dump_profile(self, profiler, name):
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}_"
+                                                               f"{os.getpid()}_{threading.get_ident()}.prof"))
+        except (OSError, ValueError) as e:
+            logger.warning("Can not write profile: %s", e)
+
+
+class WorkerTask:
+    """
+    Task function of a worker process pool that returns the spans and counters of the task (see
+    Instrumentation.worker_task)
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *args, **kwargs):
+        # The task gets a run of its own. The run of the thread is restored afterwards, so a task that runs in the
+        # calling process is not counted twice once its run is merged
+        saved_run = instrumentation.run
+        instrumentation.reset()
+        try:
+            return self.function(*args, **kwargs), instrumentation.run
+        finally:
+            instrumentation.local.run = saved_run
+
+
+# Shared instrumentation of this process. Summaries and profiles can be enabled without code changes with the
+# IMAGE_COMPARISON_SUMMARY_DIR and IMAGE_COMPARISON_PROFILE_DIR environment variables
+instrumentation = Instrumentation(summary_dir=os.environ.get("IMAGE_COMPARISON_SUMMARY_DIR"),
+                                  profile_dir=os.environ.get("IMAGE_COMPARISON_PROFILE_DIR"))
@@ -0,0 +1,292 @@
+import os
+import time
+import numpy as np
+from comparison_engine import FEATURE_SCALE, compare_all_pairs, compare_candidate_pairs, feature_weights
+
+
+class LSHIndex:
+    """
+    Locality-sensitive hashing index for all pairs matching in sub-quadratic time. Uses p-stable hashing for the metric
+    of SimilarityIndex (weighted L1 distance, the unrounded difference score of compare_two_images): every hash is
+    floor((a * x + b) / bucket_width) with a projection vector a of Cauchy distributed values, so close images are
+    likely to get the same hash. A table combines hashes_per_table hashes into one bucket key. Pairs that share a bucket
+    in at least one table are candidates, only candidates are scored.
+    More tables find more of the pairs above the threshold (recall) but give more candidates, more hashes per table or a
+    smaller bucket width give fewer candidates and a lower recall. The bucket width has to match the threshold of the
+    comparisons (see bucket_width_for), see recall_report to tune them
+    """
+
+    def __init__(self, feature_slices, num_tables=16, hashes_per_table=8, bucket_width=0.2, seed=0, growth=1.5):
+        """
+        :param feature_slices: column layout of the features: {feature_name: slice, ...}
+        :param num_tables: number of hash tables
+        :param hashes_per_table: number of hashes combined into the bucket key of a table
+        :param bucket_width: width of the hash buckets in units of the difference score (1 - similarity). Should be
+        many times the difference score of the threshold that is searched for (see bucket_width_for). The default is
+        the width for threshold 0.99
+        :param seed: seed of the random projections
+        :param growth: factor the key array grows by once it is full
+        """
+        self.feature_slices = dict(feature_slices)
+        self.num_tables = num_tables
+        self.hashes_per_table = hashes_per_table
+        self.bucket_width = bucket_width
+        self.seed = seed
+        self.growth = growth
+
+        # Weighted features have the L1 distance of the difference score. A Cauchy projection of their difference is
+        # Cauchy distributed with their L1 distance as scale
+        rng = np.random.default_rng(seed)
+        weights = feature_weights(self.feature_slices)
+        self.projections = rng.standard_cauchy((len(weights), num_tables * hashes_per_table)) * weights[:, None]
+        self.offsets = rng.uniform(0, bucket_width, num_tables * hashes_per_table)
+        self.key_multipliers = rng.integers(1, 2 ** 63, hashes_per_table, dtype=np.uint64) | np.uint64(1)
+
+        self.keys = np.empty((0, num_tables), dtype=np.uint64)  # Bucket key per row and table
+        self.paths = []  # Row index -> image path
+        self.rows = {}  # Image path -> row index
+        self.changed = False  # Set on every change. Used to decide if the index has to be saved
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, img_path):
+        return img_path in self.rows
+
+    def matches_layout(self, feature_slices, num_tables, hashes_per_table, bucket_width):
+        """
+        :return: True if the index was created with these parameters
+        """
+        return (self.feature_slices == dict(feature_slices) and self.num_tables == num_tables and
+                self.hashes_per_table == hashes_per_table and self.bucket_width == bucket_width)
+
+    def bucket_keys(self, matrix):
+        """
+        Calculate the bucket keys of feature rows
+        :param matrix: 2d feature matrix (quantized, see quantize_features, or float values)
+        :return: 2d uint64 array with one bucket key per row and table
+        """
+        values = np.asarray(matrix, dtype=np.float64).reshape(-1, len(self.projections))
+        if np.issubdtype(np.asarray(matrix).dtype, np.integer):
+            values = values / FEATURE_SCALE
+
+        hashes = np.floor((values @ self.projections + self.offsets) / self.bucket_width).astype(np.int64)
+        hashes = hashes.reshape(len(values), self.num_tables, self.hashes_per_table).view(np.uint64)
+
+        # Keys of different hashes can collide. That only adds candidates
+        return (hashes * self.key_multipliers).sum(axis=-1, dtype=np.uint64)
+
+    def insert(self, img_paths, matrix):
+        """
+        Add or replace images
+        :param img_paths: list of image paths
+        :param matrix: 2d feature matrix with one row per image (see bucket_keys)
+        """
+        if len(img_paths) == 0:
+            return
+
+        keys = self.bucket_keys(matrix)
+        self.changed = True
+
+        for img_path, img_keys in zip(img_paths, keys):
+            if img_path in self.rows:
+                self.keys[self.rows[img_path]] = img_keys
+                continue
+
+            if len(self.paths) == len(self.keys):
+                grown = np.empty((max(16, int(len(self.keys) * self.growth)), self.num_tables), dtype=np.uint64)
+                grown[:len(self.paths)] = self.keys[:len(self.paths)]
+                self.keys = grown
+
+            self.keys[len(self.paths)] = img_keys
+            self.rows[img_path] = len(self.paths)
+            self.paths.append(img_path)
+
+    def delete(self, img_path):
+        """
+        Remove an image. The last row takes its place, so the rows stay contiguous
+        :param img_path: path of the image
+        """
+        row = self.rows.pop(img_path, None)
+        if row is None:
+            return
+        self.changed = True
+
+        last_path = self.paths.pop()
+        if last_path != img_path:
+            self.keys[row] = self.keys[len(self.paths)]
+            self.paths[row] = last_path
+            self.rows[last_path] = row
+
+    def candidate_pairs(self, img_paths_a, img_paths_b=None, num_tables=None):
+        """
+        Find the pairs of images that share a bucket in at least one table
+        :param img_paths_a: list of image paths. All images have to be in the index
+        :param img_paths_b: optional second list of image paths. Pairs of img_paths_a with img_paths_b are returned
+        instead of the pairs within img_paths_a
+        :param num_tables: only use the first num_tables tables (all if not defined)
+        :return: tuple of (1d array of indices into img_paths_a, 1d array of indices into img_paths_b or img_paths_a).
+        Every pair is returned once, pairs within img_paths_a with the smaller index first
+        """
+        keys_a = self.keys[[self.rows[img_path] for img_path in img_paths_a]].reshape(-1, self.num_tables)
+        keys_b = None
+        if img_paths_b is not None:
+            keys_b = self.keys[[self.rows[img_path] for img_path in img_paths_b]].reshape(-1, self.num_tables)
+        num_b = max(len(keys_a) if keys_b is None else len(keys_b), 1)
+
+        pair_keys = [np.empty(0, dtype=np.int64)]
+        for table in range(self.num_tables if num_tables is None else num_tables):
+            if keys_b is None:
+                a, b = _bucket_pairs(keys_a[:, table])
+            else:
+                # Only pairs across both lists, pairs within img_paths_a or img_paths_b are never built
+                a, b = _cross_bucket_pairs(keys_a[:, table], keys_b[:, table])
+            pair_keys.append(a * num_b + b)
+
+        pair_keys = np.unique(np.concatenate(pair_keys))
+
+        return pair_keys // num_b, pair_keys % num_b
+
+    def save(self, index_file_path):
+        """
+        Save the index as a .npz file
+        :param index_file_path: path of the index file (see lsh_file_path_for)
+        """
+        with open(index_file_path + ".tmp", "wb") as index_file:
+            np.savez(index_file, keys=self.keys[:len(self.paths)], paths=np.array(self.paths, dtype=str),
+                     feature_names=np.array(list(self.feature_slices), dtype=str),
+                     feature_bounds=np.array([(s.start, s.stop) for s in self.feature_slices.values()],
+                                             dtype=np.int64).reshape(-1, 2),
+                     num_tables=self.num_tables, hashes_per_table=self.hashes_per_table,
+                     bucket_width=self.bucket_width, projections=self.projections, offsets=self.offsets,
+                     key_multipliers=self.key_multipliers)
+        os.replace(index_file_path + ".tmp", index_file_path)
+
+        self.changed = False
+
+    @classmethod
+    def load(cls, index_file_path, **kwargs):
+        """
+        Load an index saved with save()
+        :param index_file_path: path of the index file
+        :param kwargs: parameters passed to the constructor
+        :return: LSHIndex
+        """
+        with np.load(index_file_path) as data:
+            index = cls({str(name): slice(int(start), int(stop)) for name, (start, stop) in
+                         zip(data["feature_names"], data["feature_bounds"])}, num_tables=int(data["num_tables"]),
+                        hashes_per_table=int(data["hashes_per_table"]), bucket_width=float(data["bucket_width"]),
+                        **kwargs)
+
+            # Saved projections, so the keys of new images match the saved keys
+            index.projections = data["projections"]
+            index.offsets = data["offsets"]
+            index.key_multipliers = data["key_multipliers"]
+            index.keys = data["keys"]
+            index.paths = [str(img_path) for img_path in data["paths"]]
+
+        index.rows = {img_path: row for row, img_path in enumerate(index.paths)}
+
+        return index
+
+
+def _bucket_pairs(keys):
+    # All pairs (a < b) of rows with the same key
+    order = np.argsort(keys, kind="stable")  # Stable: rows are ascending within a bucket
+    sorted_keys = keys[order]
+    bucket_starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]]))
+    bucket_ends = np.concatenate([bucket_starts[1:], [len(keys)]])
+
+    # Every position is paired with all later positions of its bucket
+    num_partners = np.repeat(bucket_ends, bucket_ends - bucket_starts) - np.arange(len(keys)) - 1
+    first = np.repeat(np.arange(len(keys)), num_partners)
+    partner_starts = np.cumsum(num_partners) - num_partners
+    second = first + np.arange(len(first)) - np.repeat(partner_starts, num_partners) + 1
+
+    return order[first], order[second]
+
+
+def bucket_width_for(threshold, factor=20, min_bucket_width=0.001):
+    """
+    Get the bucket width that finds the matches of a threshold with the default 16 tables of 8 hashes. The chance of
+    two images to share a bucket depends on their difference score relative to the bucket width. With 20 times the
+    difference score of the threshold (1 - threshold), a pair at the threshold is a candidate with a probability of
+    about 0.998, closer pairs with a higher one. Pairs with 5 times the difference score of the threshold are still
+    candidates in about 30% of the cases, with 10 times in 3% and with 20 times in less than 0.1%.
+    A larger factor finds more matches but scores more candidates, a smaller factor scores fewer candidates but misses
+    matches (0.47 recall at the threshold with factor 5, see recall_report)
+    :param threshold: threshold for minimum similarity score of the comparisons
+    :param factor: bucket width in multiples of the difference score of the threshold
+    :param min_bucket_width: smallest bucket width (threshold 1)
+    :return: bucket width (see LSHIndex)
+    """
+    return max(factor * (1 - threshold), min_bucket_width)
+
+
+def _cross_bucket_pairs(keys_a, keys_b):
+    # All pairs of a row of keys_a and a row of keys_b with the same key
+    order = np.argsort(keys_b, kind="stable")
+    sorted_keys = keys_b[order]
+    starts = np.searchsorted(sorted_keys, keys_a, side="left")
+    counts = np.searchsorted(sorted_keys, keys_a, side="right") - starts
+
+    # Every row of keys_a is paired with all rows of its bucket in keys_b
+    first = np.repeat(np.arange(len(keys_a)), counts)
+    partner_starts = np.cumsum(counts) - counts
+    second = order[np.repeat(starts, counts) + np.arange(len(first)) - np.repeat(partner_starts, counts)]
+
+    return first, second
+
+
+def recall_report(matrix, feature_slices, threshold=0.99, table_counts=(1, 2, 4, 8, 16), hashes_per_table=8,
+                  bucket_width=None, seed=0):
+    """
+    Compare LSH candidate matching with the exhaustive comparison of all pairs. Use it to tune the number of tables,
+    hashes per table and bucket width for a library
+    :param matrix: 2d feature matrix (see build_feature_matrix)
+    :param feature_slices: column layout of the features: {feature_name: slice, ...}
+    :param threshold: threshold for minimum similarity score for the comparison to be saved
+    :param table_counts: numbers of tables to test
+    :param hashes_per_table: see LSHIndex
+    :param bucket_width: see LSHIndex. Derived from the threshold if not defined (see bucket_width_for)
+    :param seed: see LSHIndex
+    :return: list of dicts, one per table count: {"num_tables", "candidates", "candidate_ratio" (share of all pairs that
+    is scored), "matches", "recall" (share of the exhaustive matches that are found), "seconds", "speedup"}
+    """
+    num_pairs = len(matrix) * (len(matrix) - 1) // 2
+    if bucket_width is None:
+        bucket_width = bucket_width_for(threshold)
+
+    timer_start = time.perf_counter()
+    exact_rows, exact_cols, _ = compare_all_pairs(matrix, feature_slices, threshold=threshold)
+    exhaustive_seconds = time.perf_counter() - timer_start
+    exact_pairs = exact_rows.astype(np.int64) * len(matrix) + exact_cols  # Sorted, pairs are in nested loop order
+
+    paths = list(range(len(matrix)))
+    index = LSHIndex(feature_slices, num_tables=max(table_counts), hashes_per_table=hashes_per_table,
+                     bucket_width=bucket_width, seed=seed)
+    index.insert(paths, matrix)
+
+    report = []
+    for num_tables in table_counts:
+        # Tables are independent, the first tables of the largest index are an index with fewer tables
+        timer_start = time.perf_counter()
+        a, b = index.candidate_pairs(paths, num_tables=num_tables)
+        rows, cols, _ = compare_candidate_pairs(matrix, a, b, feature_slices, threshold=threshold)
+        seconds = time.perf_counter() - timer_start
+
+        found = np.count_nonzero(np.isin(rows * len(matrix) + cols, exact_pairs, assume_unique=True))
+        report.append({"num_tables": num_tables, "candidates": len(a), "candidate_ratio": len(a) / max(num_pairs, 1),
+                       "matches": len(rows), "recall": float(found / max(len(exact_pairs), 1)), "seconds": seconds,
+                       "speedup": exhaustive_seconds / max(seconds, 1e-9)})
+
+    return report
+
+
+def lsh_file_path_for(save_file_path):
+    """
+    Get the path of the LSH index file that belongs to a save file
+    :param save_file_path: path of the save file
+    :return: path of the index file (eg. savefile.json -> savefile.lsh.npz)
+    """
+    return os.path.splitext(save_file_path)[0] + ".lsh.npz"
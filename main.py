@@ -1,50 +1,257 @@
+import itertools
 import os
 from save_file_handling import SaveFileHandler
+from binary_save_file_handling import BinarySaveFileHandler
+from sqlite_save_file_handling import SQLiteSaveFileHandler
 from image_comparison import *
+from comparison_engine import compare_all_pairs_sharded, compare_candidate_pairs, compare_hash_candidates, \
+    restore_precision, select_top_k, top_k_pairs_sharded
+from lsh_index import LSHIndex, bucket_width_for, lsh_file_path_for, recall_report
+from similarity_index import SimilarityIndex, index_file_path_for
+from instrumentation import instrumentation, logger
+import logging
 import time
-from matplotlib import pyplot as plt
+import numpy as np
 
 
 class ImageCompare:
-    def __init__(self, savefile_path="savefile.json", bins=6, resize=250):
-        self.save_file_handler = SaveFileHandler(save_file_path=savefile_path)
+    save_file_backends = {"json": SaveFileHandler, "binary": BinarySaveFileHandler, "sqlite": SQLiteSaveFileHandler}
+    # Used instead of a .json ending (eg. the default save file path)
+    save_file_extensions = {"binary": ".bin", "sqlite": ".db"}
+
+    @instrumentation.entry_point("ImageCompare.__init__")
+    def __init__(self, savefile_path="savefile.json", bins=6, resize=250, save_file_backend="json",
+                 extraction_workers=1, extraction_chunksize=16, max_hash_distance=None, fast_histograms=False,
+                 extraction_batch_size=None, comparison_workers=1, fast_ingest=False, lazy=False, lsh_tables=None,
+                 lsh_hashes_per_table=8, lsh_bucket_width=None):
+        """
+        :param savefile_path: path of the save file
+        :param bins: number of features per feature type
+        :param resize: image size the features are computed on
+        :param save_file_backend: "json" (single json file), "binary" (directory with a memory mapped feature matrix,
+        migrates the json save file with the same name once) or "sqlite" (SQLite database with row level updates).
+        A .json save file path is changed to the ending of the backend (savefile.json -> savefile.bin / savefile.db)
+        :param extraction_workers: number of processes for feature extraction. 1 runs in this process, None uses all
+        cpu cores
+        :param extraction_chunksize: number of images sent to a feature extraction process at once
+        :param max_hash_distance: None or int. If set, only images whose dhash differs in at most this many bits are
+        compared by their features (finds exact and near-exact duplicates only, but in near linear time)
+        :param fast_histograms: compute the features with the fast histogram kernels (same feature values)
+        :param extraction_batch_size: None or int. Decode this many images at once and compute their features as one
+        stack (same feature values)
+        :param comparison_workers: number of processes for compare_all_images. 1 runs in this process, None uses all
+        cpu cores. Not used for hash prefiltered comparisons
+        :param fast_ingest: compute the features of JPEG images from their EXIF thumbnail if they have one, without
+        decoding the image (see decode_img). Much faster for camera photos, features differ slightly from the decoded
+        image
+        :param lazy: only set the parameters. The save file is loaded and the features are updated by load() (eg. on a
+        background thread)
+        :param lsh_tables: None or int. If set, compare_all_images only compares pairs that share a bucket in one of
+        this many tables of a locality-sensitive hashing index (see LSHIndex). Sub-quadratic, but some matches can be
+        missed (see lsh_recall_report, recall depends on the images). The hashes do not change, so a missed pair is
+        missed by every comparison with the same LSH parameters. Images are not marked as compared after an LSH
+        comparison, so a comparison without LSH still finds these pairs. Not used for top_k and hash prefiltered
+        comparisons
+        :param lsh_hashes_per_table: number of hashes combined into the bucket key of an LSH table
+        :param lsh_bucket_width: width of the LSH hash buckets in units of the difference score (1 - similarity). If not
+        defined, it is derived from the threshold of each comparison (see bucket_width_for), so pairs at the threshold
+        are found with a probability of about 0.998. The index is rebuilt once the threshold changes. Narrower buckets
+        score fewer candidates but miss more matches
+        """
+        if save_file_backend in ImageCompare.save_file_extensions and \
+                os.path.splitext(savefile_path)[1].lower() == ".json":
+            savefile_path = os.path.splitext(savefile_path)[0] + ImageCompare.save_file_extensions[save_file_backend]
+        self.savefile_path = savefile_path
+        self.save_file_backend = save_file_backend
+        self.save_file_handler = None  # Set by load()
 
         """PARAMETERS"""
 
         # Feature computation parameters
         self.bins = bins
         self.resize = resize
+        self.extraction_workers = extraction_workers
+        self.extraction_chunksize = extraction_chunksize
+        self.fast_histograms = fast_histograms
+        self.extraction_batch_size = extraction_batch_size
+        self.fast_ingest = fast_ingest
+
+        # Comparison parameters
+        self.max_hash_distance = max_hash_distance
+        self.comparison_workers = comparison_workers
+        self.lsh_tables = lsh_tables
+        self.lsh_hashes_per_table = lsh_hashes_per_table
+        self.lsh_bucket_width = lsh_bucket_width
+
+        # Similarity index over all image features. Used to find matches for new images without a full scan
+        self.similarity_index_path = index_file_path_for(savefile_path)
+        self.similarity_index = None  # Set by load()
+
+        # LSH bucket keys of the feature table rows. Kept up to date by update_features if lsh_tables is set
+        self.lsh_index_path = lsh_file_path_for(savefile_path)
+        self.lsh_index = None  # Set by load()
 
         """INITIAL CALLS"""
 
-        # Update image features
-        self.update_features()
+        if not lazy:
+            self.load()
+
+    @property
+    def loaded(self):
+        return self.similarity_index is not None
+
+    @property
+    def feature_table(self):
+        # Quantized features of all images in one array (see FeatureTable). Owned by the save file handler, saved next
+        # to the save file and memory mapped, so processes with the same save file share it
+        return self.save_file_handler.feature_table if self.save_file_handler is not None else None
+
+    @instrumentation.entry_point("ImageCompare.load")
+    def load(self, status_callback=None, progress_callback=None, cancel_event=None):
+        """
+        Load the save file, update it with the root folder content, load the similarity index and feature table and
+        update the features. Called by the constructor unless it is lazy
+        :param status_callback: optional function, called with a short description of every stage when it starts and
+        while files are hashed (see update_features)
+        :param progress_callback: optional function, called while the features are updated (see update_features)
+        :param cancel_event: optional threading.Event. If set, no more files are hashed and no more features are
+        computed (see update_features)
+        """
+        def report_status(status):
+            logger.debug("Startup stage: %s", status)
+            if status_callback is not None:
+                status_callback(status)
+
+        report_status("Loading save file")
+        self.save_file_handler = ImageCompare.save_file_backends[self.save_file_backend](
+            save_file_path=self.savefile_path, update_on_init=False)
+
+        report_status("Scanning root folder")
+        self.save_file_handler.update_save_file()
+
+        report_status("Loading index")
+        self.similarity_index = self.load_similarity_index()
+        self.lsh_index = self.load_lsh_index()
+
+        self.update_features(progress_callback=progress_callback, cancel_event=cancel_event,
+                             status_callback=report_status)
 
-    def update_features(self, write_to_file=True):
+    @instrumentation.entry_point("update_features")
+    def update_features(self, write_to_file=True, progress_callback=None, cancel_event=None, status_callback=None):
         """
         Add features to all save file entries that do not have features yet
         :param write_to_file: Update savefile if changes occur (can be time intensive)
+        :param progress_callback: optional function, called after every image with (completed_images, total_images)
+        :param cancel_event: optional threading.Event. If set, no more files are hashed and no more features are
+        computed. Hashes and features computed so far are kept and saved
+        :param status_callback: optional function, called with a short description of the current step ("Hashing files
+        (3/10)", "Updating features")
         """
+        def report_status(status):
+            if status_callback is not None:
+                status_callback(status)
+
         updates = 0
         skipped = 0  # Skipped images due to errors
 
-        all_images_features = self.save_file_handler.get_all_images_features(split_compared=False)
-
-        # Iterate through every save file entry
-        for file_path, features in all_images_features.items():
-            if features == {}:
-                # If the image does not have features, calculate them
+        # Features are read from the feature table where needed, the save file only lists the images
+        all_images_compared = self.save_file_handler.get_all_images_compared()
+        feature_table = self.feature_table
+        all_images_hashes = self.save_file_handler.get_all_images_hashes()
+
+        failed_paths = []  # Images whose features could not be computed
+        computed_features = {}
+        decode_path_counts = {decode_path: 0 for decode_path in DECODE_PATHS}  # How the images were loaded
+
+        # Content hashes of files with the same size. Used to find byte identical copies without comparing features
+        updates += self.update_content_hashes(
+            progress_callback=lambda hashed_files, total_files: report_status(
+                f"Hashing files ({hashed_files}/{total_files})"), cancel_event=cancel_event)
+        report_status("Updating features")
+
+        # Calculate features for every save file entry that does not have features yet. Results are added to the save
+        # file as soon as they are computed. With the hash prefilter, images without hash (save files created before
+        # hashes were added) are loaded once more to add their hash
+        new_file_paths = [file_path for file_path in all_images_compared if file_path not in feature_table or
+                          (self.max_hash_distance is not None and all_images_hashes.get(file_path) is None)]
+        extraction_start = time.perf_counter()
+        files_features = get_files_features(new_file_paths, bins=self.bins, resize=self.resize,
+                                            workers=self.extraction_workers, chunksize=self.extraction_chunksize,
+                                            fast_histograms=self.fast_histograms, batch_size=self.extraction_batch_size,
+                                            fast_ingest=self.fast_ingest)
+        for num_completed, (file_path, new_features, new_hash, decode_path) in enumerate(files_features):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            if progress_callback is not None:
+                progress_callback(num_completed + 1, len(new_file_paths))
+
+            if decode_path is not None:
+                decode_path_counts[decode_path] += 1
+                logger.debug("Loaded %s (%s)", file_path, decode_path)
+
+            if new_hash is not None:
+                self.save_file_handler.edit_image_hash(file_path, new_hash)
+                all_images_hashes[file_path] = new_hash
+                updates += 1
+
+            if file_path in feature_table:
+                # Only the hash was missing
+                if new_hash is not None and file_path in self.similarity_index:
+                    self.similarity_index.set_hash(file_path, new_hash)
+                continue
+
+            if new_features is None:
+                skipped += 1
+                failed_paths.append(file_path)
+                continue
+
+            for feature in new_features:
+                # Fast histograms are float32. Store the rounded float64 values of the default kernels
+                new_features[feature] = restore_precision(new_features[feature])
+
+            self.save_file_handler.edit_image_features(file_path, new_features)
+            computed_features[file_path] = new_features
+            updates += 1
+        files_features.close()  # Stops the worker processes if the update was cancelled
+        # Wall time of decoding and feature extraction, including worker processes
+        instrumentation.add_time("extract_files", time.perf_counter() - extraction_start)
+        instrumentation.count("images_extracted", len(computed_features))
+        instrumentation.count("images_failed", skipped)
+        for decode_path, count in decode_path_counts.items():
+            instrumentation.count(f"decode.{decode_path}", count)
+        if sum(decode_path_counts.values()) != 0:
+            logger.info("Loaded %s", " | ".join(f"{count} {decode_path.replace('_', ' ')}"
+                                                for decode_path, count in decode_path_counts.items()))
+
+        # Add new features to the similarity index. In save file order, so results keep the order of a full scan
+        for file_path in all_images_compared:
+            if file_path in computed_features:
+                try:
+                    self.similarity_index.insert(file_path, computed_features[file_path],
+                                                 all_images_hashes.get(file_path))
+                except ValueError:
+                    # Feature layout of the index is outdated (eg. different bins). Start a new index
+                    self.similarity_index = SimilarityIndex()
+                    self.similarity_index.insert(file_path, computed_features[file_path],
+                                                 all_images_hashes.get(file_path))
+
+            elif file_path in feature_table and file_path not in self.similarity_index:
+                # Image has features, but is missing in the index (eg. index file was deleted)
                 try:
-                    new_features = get_img_features(load_img(file_path), bins=self.bins, resize=self.resize)
+                    self.similarity_index.insert(file_path, feature_table.get_features(file_path),
+                                                 all_images_hashes.get(file_path))
+                except ValueError:
+                    pass
 
-                    for feature in new_features:
-                        new_features[feature] = new_features[feature].tolist()
+        # Remove images from the index that are no longer in the save file or have no features anymore
+        removed_paths = [file_path for file_path in self.similarity_index.rows if file_path not in all_images_compared]
+        for file_path in failed_paths + removed_paths:
+            self.similarity_index.delete(file_path)
 
-                    self.save_file_handler.edit_image_features(file_path, new_features)
-                    updates += 1
+        if self.similarity_index.changed:
+            self.save_similarity_index()
 
-                except Exception as e:
-                    skipped += 1
+        self.update_lsh_index(updated_paths=computed_features)
 
         if skipped != 0:
             print(f"(!) Skipped computing features for {skipped} image{'s' if skipped != 1 else ''} "
@@ -53,123 +260,434 @@ class ImageCompare:
         if updates != 0 and write_to_file:
             self.save_file_handler.write_to_save_file()
 
-    def compare_new_image(self, new_image_path, threshold=0.99):
+    def update_content_hashes(self, progress_callback=None, cancel_event=None):
+        """
+        Add file sizes to all save file entries that do not have one yet and content hashes (see content_hash) to all
+        entries that have the same file size as another entry. Files with a unique size can not have a byte identical
+        copy, so they are not read
+        :param progress_callback: optional function, called before the first and after every hashed file with
+        (hashed_files, total_files)
+        :param cancel_event: optional threading.Event. If set, no more files are hashed. The remaining files are hashed
+        by the next call
+        :return: number of changed save file entries
+        """
+        timer_start = time.perf_counter()
+        updates = 0
+        num_hashed = 0
+
+        all_images_content_hashes = self.save_file_handler.get_all_images_content_hashes()
+        paths_by_size = {}  # {file_size: [file_path, ...], ...}
+        for file_path, (file_size, image_content_hash) in all_images_content_hashes.items():
+            if file_size is None:
+                try:
+                    file_size = os.path.getsize(file_path)
+                except OSError:
+                    continue
+                self.save_file_handler.edit_image_content_hash(file_path, file_size)
+                all_images_content_hashes[file_path] = (file_size, None)
+                updates += 1
+
+            paths_by_size.setdefault(file_size, []).append(file_path)
+
+        unhashed_paths = [file_path for same_size_paths in paths_by_size.values() if len(same_size_paths) > 1
+                          for file_path in same_size_paths if all_images_content_hashes[file_path][1] is None]
+        if progress_callback is not None and unhashed_paths:
+            progress_callback(0, len(unhashed_paths))
+
+        for i, file_path in enumerate(unhashed_paths):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+
+            try:
+                self.save_file_handler.edit_image_content_hash(file_path, all_images_content_hashes[file_path][0],
+                                                               content_hash(file_path))
+                num_hashed += 1
+                updates += 1
+            except OSError as e:
+                print(f"(!) Can not hash {file_path}:", e)
+
+            if progress_callback is not None:
+                progress_callback(i + 1, len(unhashed_paths))
+
+        instrumentation.add_time("content_hash", time.perf_counter() - timer_start)
+        instrumentation.count("files_hashed", num_hashed)
+
+        return updates
+
+    @staticmethod
+    def group_copies(img_paths, all_images_content_hashes):
+        """
+        Group byte identical copies by their content hash
+        :param img_paths: list of image paths
+        :param all_images_content_hashes: dictionary {image_path: (file_size, content_hash), ...} (see
+        get_all_images_content_hashes)
+        :return: dictionary {group key: [image_path, ...], ...} in the order of img_paths. The key is the content hash,
+        images without content hash are a group of their own with their path as key
+        """
+        groups = {}
+        for img_path in img_paths:
+            image_content_hash = all_images_content_hashes.get(img_path, (None, None))[1]
+            groups.setdefault(img_path if image_content_hash is None else image_content_hash, []).append(img_path)
+
+        return groups
+
+    def update_lsh_index(self, updated_paths=(), threshold=None):
+        """
+        Sync the LSH index with the feature table and save it if it changed. Rebuilds the index if its parameters or
+        feature layout are outdated. Does nothing if lsh_tables is not set
+        :param updated_paths: paths of images whose features changed since the last sync
+        :param threshold: threshold of the comparison the index is used for. Sets the bucket width if lsh_bucket_width
+        is not defined. Without threshold, the bucket width of the current index is kept
+        """
+        feature_slices = self.feature_table.feature_slices
+        if self.lsh_tables is None or feature_slices is None:
+            return
+
+        bucket_width = self.lsh_bucket_width
+        if bucket_width is None:
+            if threshold is not None:
+                bucket_width = bucket_width_for(threshold)
+            elif self.lsh_index is not None:
+                bucket_width = self.lsh_index.bucket_width
+            else:
+                bucket_width = bucket_width_for(0.99)
+
+        if self.lsh_index is None or not self.lsh_index.matches_layout(feature_slices, self.lsh_tables,
+                                                                       self.lsh_hashes_per_table, bucket_width):
+            self.lsh_index = LSHIndex(feature_slices, num_tables=self.lsh_tables,
+                                      hashes_per_table=self.lsh_hashes_per_table, bucket_width=bucket_width)
+            self.lsh_index.changed = True
+
+        for file_path in [file_path for file_path in self.lsh_index.paths if file_path not in self.feature_table]:
+            self.lsh_index.delete(file_path)
+        updated_paths = set(updated_paths)
+        with instrumentation.span("lsh.insert"):
+            self.lsh_index.insert(*self.feature_table.matrix_for(file_path for file_path in self.feature_table.paths
+                                                                 if file_path not in self.lsh_index or
+                                                                 file_path in updated_paths))
+
+        if self.lsh_index.changed:
+            self.save_lsh_index()
+
+    def load_lsh_index(self):
+        """
+        Load the LSH index file that belongs to the save file
+        :return: LSHIndex or None if lsh_tables is not set or it can not be loaded (built by update_lsh_index)
+        """
+        if self.lsh_tables is not None and os.path.exists(self.lsh_index_path):
+            try:
+                with instrumentation.span("io.load_lsh_index"):
+                    return LSHIndex.load(self.lsh_index_path)
+            except Exception as e:
+                print("(!) Can not load LSH index, rebuilding it:", e)
+
+        return None
+
+    def save_lsh_index(self):
+        try:
+            with instrumentation.span("io.save_lsh_index"):
+                self.lsh_index.save(self.lsh_index_path)
+        except Exception as e:
+            print("(!) Can not save LSH index:", e)
+
+    def lsh_recall_report(self, threshold=0.99, table_counts=(1, 2, 4, 8, 16)):
+        """
+        Compare LSH matching of all images in the feature table with the exhaustive comparison (see recall_report)
+        :param threshold: threshold for minimum similarity score for the comparison to be saved
+        :param table_counts: numbers of LSH tables to test
+        :return: list of dicts, one per table count (see recall_report)
+        """
+        _, matrix = self.feature_table.matrix_for(self.feature_table.paths)
+        report = recall_report(matrix, self.feature_table.feature_slices, threshold=threshold,
+                               table_counts=table_counts, hashes_per_table=self.lsh_hashes_per_table,
+                               bucket_width=self.lsh_bucket_width)
+
+        for entry in report:
+            logger.info(f"LSH with {entry['num_tables']} table{'s' if entry['num_tables'] != 1 else ''}: "
+                        f"{entry['candidates']} candidates ({round(entry['candidate_ratio'] * 100, 2)}% of all pairs), "
+                        f"recall {round(entry['recall'], 4)}, {round(entry['seconds'], 2)}s "
+                        f"(exhaustive search takes {round(entry['speedup'], 1)}x as long)")
+
+        return report
+
+    def load_similarity_index(self):
+        """
+        Load the similarity index file that belongs to the save file. Creates an empty index if it can not be loaded
+        :return: SimilarityIndex
+        """
+        if os.path.exists(self.similarity_index_path):
+            try:
+                with instrumentation.span("io.load_similarity_index"):
+                    return SimilarityIndex.load(self.similarity_index_path)
+            except Exception as e:
+                print("(!) Can not load similarity index, rebuilding it:", e)
+
+        return SimilarityIndex()
+
+    def save_similarity_index(self):
+        try:
+            with instrumentation.span("io.save_similarity_index"):
+                self.similarity_index.save(self.similarity_index_path)
+        except Exception as e:
+            print("(!) Can not save similarity index:", e)
+
+    @instrumentation.entry_point("compare_new_image")
+    def compare_new_image(self, new_image_path, threshold=0.99, top_k=None):
         """
         Compare a new image to the existing images in the save file
         :param new_image_path: Path of the new image to be compared
         :param threshold: threshold for minimum similarity score for the comparison to be saved
+        :param top_k: None or int. Only return the top_k most similar images above the threshold
         :return: Array of tuples with the results of the comparison: [(other_image_path, similarity), ...]
         """
 
-        timer_start = time.time()
-        num_comparisons = 0
+        timer_start = time.perf_counter()
 
         # Load new image and compute features
-        new_img_data = load_img(new_image_path)
-        new_img_features = get_img_features(new_img_data, bins=self.bins, resize=self.resize)
-
-        # Get all features from existing images in the save file
-        all_imgs_features = self.save_file_handler.get_all_images_features(split_compared=False)
-
-        # Compare the new image to every other image and save the results in an array
-        results = []
-        for img_path, img_features in all_imgs_features.items():
-            if new_image_path != img_path:
-                similarity = compare_two_images(img_features, new_img_features)
-                num_comparisons += 1
-
-                # Only save comparison result if above the defined threshold
-                if similarity >= threshold:
-                    results.append((img_path, similarity))
+        with instrumentation.span("decode"):
+            new_img_data, _ = decode_img(new_image_path, fast_ingest=self.fast_ingest)
+        with instrumentation.span("extract"):
+            new_img_features = get_img_features(new_img_data, bins=self.bins, resize=self.resize,
+                                                fast_histograms=self.fast_histograms)
+            new_img_hash = dhash(new_img_data) if self.max_hash_distance is not None else None
+
+        # Find all images above the threshold with the similarity index instead of comparing to every image
+        with instrumentation.span("compare"):
+            results, num_scored = self.similarity_index.query(new_img_features, threshold=threshold,
+                                                              exclude_path=new_image_path, img_hash=new_img_hash,
+                                                              max_hash_distance=self.max_hash_distance, top_k=top_k)
+        num_comparisons = len(self.similarity_index) - (1 if new_image_path in self.similarity_index else 0)
 
         # Sort results
         results = sorted(results, key=lambda x: x[1], reverse=True)
         self.save_file_handler.add_to_lifetime_stats(matches=len(results), comparisons=num_comparisons)
-        final_time = time.time()-timer_start
-        print(f"(i) Comparison with {os.path.basename(new_image_path)} finished. "
-              f"Found {len(results)} match{'es' if len(results) != 1 else ''} above threshold {threshold} "
-              f"({round(final_time, 2)}s total | "
-              f"{round((final_time / len(all_imgs_features))*10000, 2)}s per 10k comparisons)")
+        instrumentation.count("pairs_compared", num_scored)
+        instrumentation.count("matches", len(results))
+        final_time = time.perf_counter() - timer_start
+        logger.info(f"Comparison with {os.path.basename(new_image_path)} finished. "
+                    f"Found {len(results)} match{'es' if len(results) != 1 else ''} above threshold {threshold}"
+                    f"{f' (top {top_k})' if top_k is not None else ''} ({round(final_time, 2)}s total | "
+                    f"{num_scored} of {num_comparisons} image{'s' if num_comparisons != 1 else ''} scored)")
 
         return results
 
-    def compare_all_images(self, threshold=0.99, skip_compared=True):
+    @instrumentation.entry_point("compare_all_images")
+    def compare_all_images(self, threshold=0.99, skip_compared=True, top_k=None, progress_callback=None,
+                           cancel_event=None):
         """
         Compare all images in the save file with each other
         :param threshold: threshold for minimum similarity score for the comparison to be saved
         :param skip_compared: skip images that have already been compared with every other image
+        :param top_k: None or int. Only return the top_k most similar pairs above the threshold, sorted by similarity
+        (highest first). Memory stays bounded by top_k instead of the number of matches. If top_k matches are returned,
+        more matches can exist, so images are not marked as compared then
+        :param progress_callback: optional function, called from the comparing thread while the comparison runs with
+        (new_results, completed_pairs, total_pairs). new_results are the matches found since the last call (unsorted,
+        same format as the returned results). With top_k, they are matches that are among the best matches so far and
+        can be replaced by later matches. With the hash prefilter or LSH index, progress is reported once per comparison
+        step
+        :param cancel_event: optional threading.Event. If set, the comparison stops and the matches found so far are
+        returned. Images are not marked as compared then
         :return: Array of tuples with the results of the comparison: [(image_a_path, image_b_path, similarity), ...]
         """
 
-        timer_start = time.time()
-        num_comparisons = 0
-        results = []
+        timer_start = time.perf_counter()
 
-        # Get all features from existing images in the save file
+        # Get all images in the save file. Their features are only read from the feature table
+        all_images_compared = self.save_file_handler.get_all_images_compared()
         if skip_compared:
             # If previous compared images are skipped, get 2 lists for already compared and uncompared images
-            compared_imgs_features, uncompared_imgs_features = self.save_file_handler.get_all_images_features()
+            compared_imgs = [img_path for img_path, compared in all_images_compared.items() if compared]
+            uncompared_imgs = [img_path for img_path, compared in all_images_compared.items() if not compared]
         else:
-            uncompared_imgs_features = self.save_file_handler.get_all_images_features(split_compared=False)
-            compared_imgs_features = []  # Define so the IDE doesnt act up + for printing results
-
-        # Compare all uncompared images with each other and save the results in an array
-        for img_a_index, (img_a_path, img_a_features) in enumerate(uncompared_imgs_features.items()):
-            for img_b_path, img_b_features in list(uncompared_imgs_features.items())[img_a_index + 1:]:
-
-                try:
-                    similarity = compare_two_images(img_a_features, img_b_features)
+            uncompared_imgs = list(all_images_compared)
+            compared_imgs = []  # Define so the IDE doesnt act up + for printing results
+
+        # Quantized feature matrices from the feature table. Images without features are left out
+        # Byte identical copies are matches with similarity 1.0 without comparing their features. Only the first copy of
+        # a group takes part in the comparisons below, its matches are repeated for the other copies
+        all_images_content_hashes = self.save_file_handler.get_all_images_content_hashes()
+        uncompared_groups = self.group_copies([img_path for img_path in uncompared_imgs
+                                               if img_path in self.feature_table], all_images_content_hashes)
+        compared_groups = self.group_copies([img_path for img_path in compared_imgs
+                                             if img_path in self.feature_table], all_images_content_hashes)
+        identical_results = [(a, b, 1.0) for copies in uncompared_groups.values()
+                             for a, b in itertools.combinations(copies, 2)]
+        identical_results += [(a, b, 1.0) for key, copies in uncompared_groups.items()
+                              for a in copies for b in compared_groups.get(key, [])]
+        if threshold > 1:
+            identical_results = []
+        copies_of = {copies[0]: copies for groups in (uncompared_groups, compared_groups) for copies in groups.values()}
+
+        uncompared_paths, uncompared_matrix = self.feature_table.matrix_for(copies[0] for copies in
+                                                                            uncompared_groups.values())
+        compared_paths, compared_matrix = self.feature_table.matrix_for(copies[0] for copies in
+                                                                        compared_groups.values())
+        feature_slices = self.feature_table.feature_slices
+
+        uncompared_positions = {img_path: position for position, img_path in enumerate(uncompared_imgs)}
+
+        def expand_copies(a, b, similarity):
+            # Matches of all copies of two compared images. Copies of the same image are already identical results
+            if all_images_content_hashes[a][1] is not None and \
+                    all_images_content_hashes[a][1] == all_images_content_hashes[b][1]:
+                return []
+            if b not in uncompared_positions:
+                # Uncompared image first, like the other matches with compared images
+                return [(copy_a, copy_b, similarity) for copy_a in copies_of[a] for copy_b in copies_of[b]]
+            # Pairs of uncompared images in save file order, like the pairs without copies
+            return [(copy_a, copy_b, similarity) if uncompared_positions[copy_a] < uncompared_positions[copy_b] else
+                    (copy_b, copy_a, similarity) for copy_a in copies_of[a] for copy_b in copies_of[b]]
+
+        # With the LSH index, only pairs that share an LSH bucket are compared by their features
+        use_lsh = self.lsh_tables is not None and top_k is None and self.max_hash_distance is None
+        if use_lsh:
+            self.update_lsh_index(threshold=threshold)
+            use_lsh = self.lsh_index is not None
+
+        # With the hash prefilter, only pairs with similar hashes are compared by their features
+        if self.max_hash_distance is not None:
+            all_images_hashes = self.save_file_handler.get_all_images_hashes()
+            uncompared_hashes = [all_images_hashes.get(img_path) for img_path in uncompared_paths]
+            compared_hashes = [all_images_hashes.get(img_path) for img_path in compared_paths]
+
+        compare_start = time.perf_counter()
+        instrumentation.add_time("load_features", compare_start - timer_start)
+
+        # Progress is counted in compared pairs of images with features
+        total_pairs = len(uncompared_paths) * (len(uncompared_paths) - 1) // 2
+        if skip_compared:
+            total_pairs += len(uncompared_paths) * len(compared_paths)
+        completed_pairs = 0
+        cancelled = False
 
-                    # Only save comparison result if above the defined threshold
-                    if similarity >= threshold:
-                        results.append((img_a_path, img_b_path, similarity))
+        def engine_progress(other_paths):
+            # Progress callback for the comparison engine. Translates the matches of a step to image paths
+            if progress_callback is None and cancel_event is None:
+                return None
 
-                except Exception as e:
-                    pass
+            def on_progress(rows, cols, similarities, num_pairs):
+                nonlocal completed_pairs, cancelled
+                completed_pairs += num_pairs
+                if progress_callback is not None:
+                    progress_callback([result for a, b, similarity in zip(rows, cols, similarities)
+                                       for result in expand_copies(uncompared_paths[a], other_paths[b], similarity)],
+                                      completed_pairs, total_pairs)
 
-                num_comparisons += 1
-
-        # Compare all uncompared images to all compared images. Only when compared images are skipped
-        if skip_compared:
-            for img_a_path, img_a_features in uncompared_imgs_features.items():
-                for img_b_path, img_b_features in compared_imgs_features.items():
+                cancelled = cancel_event is not None and cancel_event.is_set()
+                return cancelled
 
-                    try:
-                        similarity = compare_two_images(img_a_features, img_b_features)
+            return on_progress
 
-                        # Only save comparison result if above the defined threshold
-                        if similarity >= threshold:
-                            results.append((img_a_path, img_b_path, similarity))
+        if progress_callback is not None and identical_results:
+            progress_callback(identical_results, 0, total_pairs)
 
-                    except Exception as e:
-                        pass
+        # Compare all uncompared images with each other and save the results in an array
+        progress = engine_progress(uncompared_paths)
+        if top_k is not None and self.max_hash_distance is None:
+            rows, cols, similarities = top_k_pairs_sharded(uncompared_matrix, feature_slices, top_k,
+                                                           threshold=threshold, workers=self.comparison_workers,
+                                                           progress=progress)
+        elif self.max_hash_distance is not None:
+            rows, cols, similarities = compare_hash_candidates(uncompared_matrix, uncompared_hashes, feature_slices,
+                                                               threshold=threshold,
+                                                               max_hash_distance=self.max_hash_distance)
+            if progress is not None:
+                progress(rows, cols, similarities, len(uncompared_paths) * (len(uncompared_paths) - 1) // 2)
+        elif use_lsh:
+            with instrumentation.span("lsh.candidates"):
+                a, b = self.lsh_index.candidate_pairs(uncompared_paths)
+            instrumentation.count("lsh_candidates", len(a))
+            rows, cols, similarities = compare_candidate_pairs(uncompared_matrix, a, b, feature_slices,
+                                                               threshold=threshold)
+            if progress is not None:
+                progress(rows, cols, similarities, len(uncompared_paths) * (len(uncompared_paths) - 1) // 2)
+        else:
+            rows, cols, similarities = compare_all_pairs_sharded(uncompared_matrix, feature_slices, threshold=threshold,
+                                                                 workers=self.comparison_workers, progress=progress)
+        results = identical_results + [result for a, b, similarity in zip(rows, cols, similarities) for result in
+                                       expand_copies(uncompared_paths[a], uncompared_paths[b], similarity)]
+        num_comparisons = len(uncompared_imgs) * (len(uncompared_imgs) - 1) // 2
 
-                    num_comparisons += 1
+        # Compare all uncompared images to all compared images. Only when compared images are skipped
+        if skip_compared and not cancelled:
+            progress = engine_progress(compared_paths)
+            if top_k is not None and self.max_hash_distance is None:
+                rows, cols, similarities = top_k_pairs_sharded(uncompared_matrix, feature_slices, top_k,
+                                                               threshold=threshold, matrix_b=compared_matrix,
+                                                               workers=self.comparison_workers, progress=progress)
+            elif self.max_hash_distance is not None:
+                rows, cols, similarities = compare_hash_candidates(uncompared_matrix, uncompared_hashes, feature_slices,
+                                                                   threshold=threshold,
+                                                                   max_hash_distance=self.max_hash_distance,
+                                                                   matrix_b=compared_matrix, hashes_b=compared_hashes)
+                if progress is not None:
+                    progress(rows, cols, similarities, len(uncompared_paths) * len(compared_paths))
+            elif use_lsh:
+                with instrumentation.span("lsh.candidates"):
+                    a, b = self.lsh_index.candidate_pairs(uncompared_paths, compared_paths)
+                instrumentation.count("lsh_candidates", len(a))
+                rows, cols, similarities = compare_candidate_pairs(uncompared_matrix, a, b, feature_slices,
+                                                                   threshold=threshold, matrix_b=compared_matrix)
+                if progress is not None:
+                    progress(rows, cols, similarities, len(uncompared_paths) * len(compared_paths))
+            else:
+                rows, cols, similarities = compare_all_pairs_sharded(uncompared_matrix, feature_slices,
+                                                                     threshold=threshold, matrix_b=compared_matrix,
+                                                                     workers=self.comparison_workers,
+                                                                     progress=progress)
+            results += [result for a, b, similarity in zip(rows, cols, similarities)
+                        for result in expand_copies(uncompared_paths[a], compared_paths[b], similarity)]
+            num_comparisons += len(uncompared_imgs) * len(compared_imgs)
+
+        if cancelled:
+            num_comparisons = completed_pairs
+        elif progress_callback is not None:
+            # Top k comparisons skip pairs that can not be among the best pairs
+            progress_callback([], total_pairs, total_pairs)
+
+        instrumentation.add_time("compare", time.perf_counter() - compare_start)
+        instrumentation.count("pairs_compared", completed_pairs if cancelled else total_pairs)
+        instrumentation.count("identical_pairs", len(identical_results))
 
         # Sort results
-        results = sorted(results, key=lambda x: x[1], reverse=True)
+        if top_k is not None:
+            # Best pairs of both comparisons. Ties keep the order of the comparisons
+            selected = select_top_k(np.array([similarity for _, _, similarity in results]), top_k,
+                                    np.arange(len(results)))
+            results = [results[i] for i in selected]
+        else:
+            results = sorted(results, key=lambda x: x[1], reverse=True)
 
-        final_time = time.time() - timer_start
-        num_of_imgs = len(compared_imgs_features) + len(uncompared_imgs_features)
+        instrumentation.count("matches", len(results))
+        final_time = time.perf_counter() - timer_start
+        num_of_imgs = len(compared_imgs) + len(uncompared_imgs)
 
         if num_comparisons != 0:
             self.save_file_handler.add_to_lifetime_stats(matches=len(results), comparisons=num_comparisons)
 
-            print(f"(i) Comparison of {num_of_imgs} image{'s' if num_of_imgs != 1 else ''} finished. "
-                  f"{num_comparisons} total comparison{'s' if num_comparisons != 1 else ''}. "
-                  f"Found {len(results)} match{'es' if len(results) != 1 else ''} above threshold {threshold} "
-                  f"({round(final_time, 2)}s total | "
-                  f"{round((final_time / num_comparisons)*10000, 2)}s per 10k comparisons)")
+            logger.info(f"Comparison of {num_of_imgs} image{'s' if num_of_imgs != 1 else ''} "
+                        f"{'cancelled' if cancelled else 'finished'}. "
+                        f"{num_comparisons} total comparison{'s' if num_comparisons != 1 else ''}. "
+                        f"Found {len(results)} match{'es' if len(results) != 1 else ''} above threshold {threshold}"
+                        f"{f' (top {top_k})' if top_k is not None else ''} ({round(final_time, 2)}s total | "
+                        f"{round((final_time / num_comparisons)*10000, 2)}s per 10k comparisons | "
+                        f"{round(num_comparisons / max(final_time, 1e-9))} pairs/s)")
         else:
-            print(f"(i) Comparison finished. No images could be compared (Reason could be that all images have been "
-                  f"compared with each other already).")
+            logger.info(f"Comparison {'cancelled' if cancelled else 'finished'}. No images could be compared (Reason "
+                        f"could be that all images have been compared with each other already).")
 
-        _ = self.save_file_handler.mark_all_as_compared()
+        # Only mark images as compared if every pair was compared and every match was returned. Matches ranked below the
+        # top k and pairs missed by LSH would never be found again by later comparisons that skip compared images
+        truncated = top_k is not None and len(results) >= top_k
+        if not cancelled and not truncated and not use_lsh:
+            _ = self.save_file_handler.mark_all_as_compared()
 
         return results
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="(i) %(message)s")
     img_comp = ImageCompare()
     img = r"./imgs/test (49).jpg"
 
@@ -181,6 +699,8 @@ if __name__ == '__main__':
     res_all = img_comp.compare_all_images(threshold=.99)
 
     """
+    from matplotlib import pyplot as plt
+
     for match in res_all:
         f, axarr = plt.subplots(1, 2)
         axarr[0].imshow(load_img(match[0]))
@@ -1,9 +1,23 @@
-from feature_extraction import get_folder_content_features
-from image_comparison import compare_all_images
+from feature_extraction import get_folder_content_features, stream_folder_features
+from feature_cache import FeatureCache
+from image_comparison import compare_all_images, stream_matches
 
 
-def compare_images(folder_path, threshold=0.99, include_subfolders=False):
-    image_features = get_folder_content_features(folder_path, include_subfolders)
+def compare_images(folder_path, threshold=0.99, include_subfolders=False, workers=None, stream=False, queue_size=64,
+                   use_cache=True):
+    if stream:
+        # Print every match as soon as it is found, while the rest of the folder is still being processed
+        image_features = stream_folder_features(folder_path, include_subfolders, workers=workers, queue_size=queue_size)
+        for match in stream_matches(image_features, threshold):
+            print(match)
+        return
+
+    feature_cache = FeatureCache() if use_cache else None
+    image_features = get_folder_content_features(folder_path, include_subfolders, workers=workers,
+                                                 feature_cache=feature_cache)
+    if feature_cache is not None:
+        feature_cache.close()
+
     comparison_results = compare_all_images(image_features, threshold)
     print(comparison_results)
 
@@ -0,0 +1,115 @@
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+
+
+def default_cache_path():
+    cache_dir = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "ImageComparison", "quick_compare_features.db")
+
+
+class FeatureCache:
+    """
+    On-disk cache of image features. Entries are keyed by (path, size, mtime, bins, resize), so a changed file or
+    other feature parameters never return stale features. Least recently used entries are evicted once the cache holds
+    more than max_entries entries.
+    The cache is a SQLite database in WAL mode. Concurrent runs can read and write it at the same time, writes of one
+    run are a single transaction
+    """
+
+    def __init__(self, cache_path=None, max_entries=100000):
+        """
+        :param cache_path: path of the cache database. Uses a file in the user cache folder if not defined
+        :param max_entries: max number of cached images
+        """
+        self.cache_path = cache_path or default_cache_path()
+        self.max_entries = max_entries
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.cache_path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS features (
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                bins INTEGER NOT NULL,
+                resize INTEGER NOT NULL,
+                features TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (path, size, mtime_ns, bins, resize)
+            );
+            CREATE INDEX IF NOT EXISTS features_last_used ON features (last_used);
+        """)
+        self.connection.commit()
+
+    @staticmethod
+    def file_key(file_path):
+        """
+        Get the size and modification time of a file
+        :param file_path: path of the file
+        :return: tuple of (size, mtime_ns) or None if the file can not be accessed
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+
+        return stat.st_size, stat.st_mtime_ns
+
+    def get_many(self, file_keys, bins=8, resize=False):
+        """
+        Get the cached features of many files. Marks the found entries as recently used
+        :param file_keys: dictionary {file_path: (size, mtime_ns), ...}, see file_key
+        :param bins: number of features per feature type the features were computed with
+        :param resize: resize the features were computed with
+        :return: dictionary of features: {file_path: {feature_name: feature_values, ...}, ...} of the cached files
+        """
+        cached_features = {}
+        for file_path, (size, mtime_ns) in file_keys.items():
+            row = self.connection.execute("SELECT features FROM features WHERE path = ? AND size = ? AND mtime_ns = ? "
+                                          "AND bins = ? AND resize = ?",
+                                          (file_path, size, mtime_ns, bins, int(resize))).fetchone()
+            if row is not None:
+                cached_features[file_path] = {feature: np.array(values)
+                                              for feature, values in json.loads(row[0]).items()}
+
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("UPDATE features SET last_used = ? WHERE path = ? AND size = ? AND "
+                                        "mtime_ns = ? AND bins = ? AND resize = ?",
+                                        [(now, file_path, *file_keys[file_path], bins, int(resize))
+                                         for file_path in cached_features])
+
+        return cached_features
+
+    def put_many(self, all_imgs_features, file_keys, bins=8, resize=False):
+        """
+        Add the features of many files to the cache and evict the least recently used entries if the cache is full
+        :param all_imgs_features: dictionary of features: {file_path: {feature_name: feature_values, ...}, ...}
+        :param file_keys: dictionary {file_path: (size, mtime_ns), ...} of the files when they were loaded
+        :param bins: number of features per feature type the features were computed with
+        :param resize: resize the features were computed with
+        """
+        now = time.time()
+        entries = [(file_path, *file_keys[file_path], bins, int(resize),
+                    json.dumps({feature: list(map(float, values)) for feature, values in img_features.items()}), now)
+                   for file_path, img_features in all_imgs_features.items() if file_keys.get(file_path) is not None]
+
+        with self.connection:
+            # Entries of older versions of the files can never be used again
+            self.connection.executemany("DELETE FROM features WHERE path = ? AND (size != ? OR mtime_ns != ?)",
+                                        [entry[:3] for entry in entries])
+            self.connection.executemany("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?, ?)", entries)
+
+            num_entries = self.connection.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+            if num_entries > self.max_entries:
+                self.connection.execute("DELETE FROM features WHERE rowid IN "
+                                        "(SELECT rowid FROM features ORDER BY last_used LIMIT ?)",
+                                        (num_entries - self.max_entries,))
+
+    def close(self):
+        self.connection.close()
@@ -7,6 +7,14 @@ from PIL import Image
 from typing import Union
 import base64
 import io
+import multiprocessing
+import multiprocessing.pool
+import functools
+import queue
+import threading
+
+EDGE_BLOCK_SIZE = 8  # Images per block in edge_histograms
+
 
 def load_img(path, load_size=250):
     pil_img = Image.open(path)
@@ -62,6 +70,122 @@ def edge_histogram(img_data, bins=8):
     return hist_data_norm
 
 
+@functools.lru_cache(maxsize=None)
+def _orientation_bins(bins):
+    # np.gradient of an uint8 image only has multiples of 0.5 between -255 and 255. Bin the orientation of every
+    # possible (gx, gy) pair once, with the same bin edges as the histogram in edge_histogram
+    gradient_values = np.arange(-2 * 255, 2 * 255 + 1) / 2
+    eo = np.arctan2(gradient_values[None, :], gradient_values[:, None])  # [gx, gy]
+    bin_edges = np.linspace(-np.pi, np.pi, bins + 1)
+    orientation_bins = np.clip(np.searchsorted(bin_edges, eo.ravel(), side="right") - 1, 0, bins - 1)
+
+    return orientation_bins.astype(np.min_scalar_type(bins - 1))
+
+
+def color_histograms(img_stack, bins=8):
+    """
+    Batched color_histogram. Calculate the color features of a stack of equally sized images
+    :param img_stack: 4d uint8 array of shape (number of images, height, width, 3)
+    :param bins: number of bins (features) per color
+    :return: 2d float32 array of shape (number of images, bins * 3)
+    """
+    num_images, height, width, _ = img_stack.shape
+
+    # Value counts of every channel of every image. Rows are (image, channel) pairs
+    value_counts = np.empty((num_images * 3, 256), dtype=np.int64)
+    for i, img_data in enumerate(img_stack):
+        for channel in range(3):
+            value_counts[i * 3 + channel] = cv2.calcHist([img_data], [channel], None, [256], [0, 256]).ravel()
+
+    # Same bin edges as np.histogram: range from the darkest to the brightest value of the channel, widened by 0.5 on
+    # both sides if all values are equal
+    present = value_counts > 0
+    first_edges = np.argmax(present, axis=1).astype(np.float64)
+    last_edges = 255 - np.argmax(present[:, ::-1], axis=1).astype(np.float64)
+    equal = first_edges == last_edges
+    first_edges[equal] -= 0.5
+    last_edges[equal] += 0.5
+    bin_edges = np.linspace(first_edges, last_edges, bins + 1, axis=1)
+
+    # A value belongs to the bin of the last inner edge that is not above it (the last bin includes its upper edge)
+    value_bins = np.sum(np.arange(256)[None, :, None] >= bin_edges[:, None, 1:-1], axis=2)
+    row_offsets = np.arange(num_images * 3)[:, None] * bins
+    hist_data = np.bincount((value_bins + row_offsets).ravel(), weights=value_counts.ravel(),
+                            minlength=num_images * 3 * bins)
+
+    return np.round(hist_data / (height * width), 4).astype(np.float32).reshape(num_images, 3 * bins)
+
+
+def edge_histograms(img_stack, bins=8):
+    """
+    Batched edge_histogram. Calculate the edge orientation features of a stack of equally sized images
+    :param img_stack: 4d uint8 array of shape (number of images, height, width, 3)
+    :param bins: number of bins (features)
+    :return: 2d float32 array of shape (number of images, bins)
+    """
+    num_images, height, width, _ = img_stack.shape
+    hist_data = np.empty((num_images, bins), dtype=np.int64)
+
+    # Work on blocks of a few images. Keeps the temporary arrays small enough to stay in the cpu cache
+    for block_start in range(0, num_images, EDGE_BLOCK_SIZE):
+        block = np.ascontiguousarray(img_stack[block_start:block_start + EDGE_BLOCK_SIZE])
+        block_size = len(block)
+
+        # Convert all images of the block at once by treating them as one tall image
+        grey = cv2.cvtColor(block.reshape(block_size * height, width, 3), cv2.COLOR_BGR2GRAY)
+        grey = grey.reshape(block_size, height, width).astype(np.int16)
+
+        # Doubled gradients of np.gradient (central differences inside, one sided differences at the borders)
+        gx2 = np.empty_like(grey)
+        gx2[:, 1:-1] = grey[:, 2:] - grey[:, :-2]
+        gx2[:, 0] = 2 * (grey[:, 1] - grey[:, 0])
+        gx2[:, -1] = 2 * (grey[:, -1] - grey[:, -2])
+        gy2 = np.empty_like(grey)
+        gy2[:, :, 1:-1] = grey[:, :, 2:] - grey[:, :, :-2]
+        gy2[:, :, 0] = 2 * (grey[:, :, 1] - grey[:, :, 0])
+        gy2[:, :, -1] = 2 * (grey[:, :, -1] - grey[:, :, -2])
+
+        # Look up the orientation bins of all images of the block at once
+        lookup_index = gx2.astype(np.int32)
+        lookup_index *= 4 * 255 + 1
+        lookup_index += gy2
+        lookup_index += 2 * 255 * (4 * 255 + 1) + 2 * 255
+        orientation_bins = _orientation_bins(bins)[lookup_index]
+
+        # Counting per image is faster than one bincount over offset bins of the whole block
+        for i, img_bins in enumerate(orientation_bins):
+            hist_data[block_start + i] = np.bincount(img_bins.ravel(), minlength=bins)
+
+    return np.round(hist_data / (height * width), 4).astype(np.float32)
+
+
+def get_batch_features(img_stack, bins=8):
+    """
+    Calculate the image features for a stack of equally sized images. Same values as get_img_features, as float32
+    :param img_stack: 4d uint8 array of shape (number of images, height, width, 3)
+    :param bins: number of features per feature type (eg. color green or edge orientation)
+    :return: 2d float32 feature matrix of shape (number of images, bins * 4). Columns are laid out as described by
+    batch_feature_slices
+    """
+    if len(img_stack.shape) != 4 or img_stack.shape[3] != 3 or img_stack.dtype != np.uint8:
+        raise Exception(f"Image stack has wrong shape (Needs to be N x H x W x 3 uint8, is {img_stack.shape} "
+                        f"{img_stack.dtype}).")
+
+    if min(img_stack.shape[1:3]) < 2:
+        raise Exception(f"Images are too small ({img_stack.shape[2]}x{img_stack.shape[1]}px).")
+
+    return np.hstack([color_histograms(img_stack, bins=bins), edge_histograms(img_stack, bins=bins)])
+
+
+def batch_feature_slices(bins=8):
+    """
+    Column layout of the matrix returned by get_batch_features
+    :param bins: number of features per feature type
+    :return: dictionary {feature_name: slice, ...}
+    """
+    return {"color": slice(0, 3 * bins), "edge_orientation": slice(3 * bins, 4 * bins)}
+
+
 def get_img_features(img_data, bins=8, resize: Union[bool, int] = False):
     """
     Calculate the image features for one image
@@ -91,12 +215,79 @@ def get_img_features(img_data, bins=8, resize: Union[bool, int] = False):
     return return_data
 
 
-def get_folder_content_features(folder_path, include_subfolders=False):
-    valid_file_types = ("jpg", "jpeg", "png", "webp", "jfif")
-    timer_start = time.time()
+def _file_features(file_path):
+    try:
+        return file_path, get_img_features(load_img(file_path)), None
+    except Exception as e:
+        return file_path, None, e
+
+
+def _compute_features(file_paths, workers=1, chunksize=16):
+    # Yields results in order of completion when running on more than one worker
+    if workers == 1 or len(file_paths) <= 1:
+        yield from map(_file_features, file_paths)
+        return
+
+    with multiprocessing.Pool(processes=workers) as pool:
+        yield from pool.imap_unordered(_file_features, file_paths, chunksize=chunksize)
 
-    # Get all valid file paths
-    valid_files = []
+
+def _batch_features(file_paths):
+    results = {}
+    batches = {}  # {image shape: [(file_path, img_data), ...]}
+
+    # Decode all images. Images of the same shape are stacked and computed at once
+    for file_path in file_paths:
+        try:
+            img_data = load_img(file_path)
+        except Exception as e:
+            results[file_path] = (file_path, None, e)
+            continue
+
+        if img_data.dtype == np.uint8 and len(img_data.shape) == 3 and img_data.shape[2] in (3, 4) and \
+                min(img_data.shape[:2]) >= 2:
+            batches.setdefault(img_data.shape, []).append((file_path, img_data[:, :, :3]))
+        else:
+            # Image can not be stacked (eg. greyscale images). Fails the same way as in get_img_features
+            try:
+                results[file_path] = (file_path, get_img_features(img_data), None)
+            except Exception as e:
+                results[file_path] = (file_path, None, e)
+
+    feature_slices = batch_feature_slices()
+    for batch in batches.values():
+        # Back to the rounded float64 values of get_img_features, compare_two_images uses them directly
+        feature_matrix = get_batch_features(np.stack([img_data for _, img_data in batch]))
+        feature_matrix = np.round(feature_matrix.astype(np.float64), 4)
+        for (file_path, _), img_features in zip(batch, feature_matrix):
+            results[file_path] = (file_path, {feature: img_features[feature_slice]
+                                              for feature, feature_slice in feature_slices.items()}, None)
+
+    return [results[file_path] for file_path in file_paths]
+
+
+def _compute_batch_features(file_paths, batch_size, workers=1):
+    # Yields results in order of completion when running on more than one worker
+    batches = [file_paths[i:i + batch_size] for i in range(0, len(file_paths), batch_size)]
+
+    if workers == 1 or len(batches) <= 1:
+        for batch in batches:
+            yield from _batch_features(batch)
+        return
+
+    with multiprocessing.Pool(processes=workers) as pool:
+        for results in pool.imap_unordered(_batch_features, batches):
+            yield from results
+
+
+def iter_folder_files(folder_path, include_subfolders=False):
+    """
+    Find all image files in a folder
+    :param folder_path: path of the folder
+    :param include_subfolders: also include images in subfolders
+    :return: generator of image file paths, in os.walk order
+    """
+    valid_file_types = ("jpg", "jpeg", "png", "webp", "jfif")
 
     for path, sub_folders, file_names in os.walk(folder_path):
 
@@ -104,26 +295,121 @@ def get_folder_content_features(folder_path, include_subfolders=False):
         if not include_subfolders:
             sub_folders.clear()
 
-        # Add every file to the valid files list if its ending matches a valid file type
+        # Yield every file if its ending matches a valid file type
         for file_name in file_names:
             file_ending = file_name.split(".")[-1].lower()
 
             if file_ending in valid_file_types:
-                refactored_path = os.path.join(path, file_name).replace("\\", "/")
-                valid_files.append(refactored_path)
+                yield os.path.join(path, file_name).replace("\\", "/")
 
-    # Calculate features for all valid files
-    all_imgs_features = {}
 
-    for file_path in valid_files:
+def stream_folder_features(folder_path, include_subfolders=False, workers=1, queue_size=64):
+    """
+    Calculate the image features for all images in a folder as a pipeline: a discovery thread walks the folder and
+    hands the files to the extraction workers, the results are yielded as soon as they are ready. At most queue_size
+    files are between discovery and the consumer of this generator, so memory stays bounded for any folder size
+    :param folder_path: path of the folder
+    :param include_subfolders: also include images in subfolders
+    :param workers: number of worker processes. 1 computes the features on one worker thread
+    :param queue_size: max number of files that are being computed or wait to be consumed
+    :return: generator of tuples (file_path, dictionary of features, error). Features are None and error is the
+    exception if the features could not be computed. Yielded in order of completion
+    """
+    results = queue.Queue()  # Bounded by the slots semaphore
+    slots = threading.BoundedSemaphore(queue_size)
+    stop_event = threading.Event()
+    pool = multiprocessing.pool.ThreadPool(1) if workers == 1 else multiprocessing.Pool(processes=workers)
+
+    def discover():
+        num_files = 0
         try:
-            img_data = load_img(file_path)
-            img_features = get_img_features(img_data)
-            all_imgs_features[file_path] = img_features
-        except Exception as e:
-            print(f"WARNING: Could not compute features for {os.path.basename(file_path)}:", e)
+            for file_path in iter_folder_files(folder_path, include_subfolders):
+                # Wait for a free slot. Checks regularly if the consumer stopped
+                while not slots.acquire(timeout=0.1):
+                    if stop_event.is_set():
+                        return
+                if stop_event.is_set():
+                    return
+
+                pool.apply_async(_file_features, (file_path,), callback=results.put,
+                                 error_callback=lambda e, file_path=file_path: results.put((file_path, None, e)))
+                num_files += 1
+        finally:
+            results.put(num_files)  # End of discovery, number of files to expect
+
+    discovery_thread = threading.Thread(target=discover, daemon=True)
+    discovery_thread.start()
+
+    try:
+        num_files, num_received = None, 0
+        while num_files is None or num_received < num_files:
+            result = results.get()
+            if isinstance(result, int):
+                num_files = result
+                continue
+
+            num_received += 1
+            slots.release()
+            yield result
+
+    finally:
+        stop_event.set()
+        pool.terminate()
+
+
+def get_folder_content_features(folder_path, include_subfolders=False, workers=1, chunksize=16, batch_size=None,
+                                feature_cache=None):
+    """
+    Calculate the image features for all images in a folder
+    :param folder_path: path of the folder
+    :param include_subfolders: also include images in subfolders
+    :param workers: number of worker processes. 1 computes the features in this process, None uses all cpu cores
+    :param chunksize: number of files sent to a worker at once
+    :param batch_size: None computes the features image by image. Otherwise the images are decoded in chunks of this
+    many files and images of the same size are computed at once with get_batch_features (same feature values)
+    :param feature_cache: None or FeatureCache. Cached features of unchanged files are used instead of loading the
+    files, new features are added to the cache
+    :return: dictionary of features: {file_path: {feature_name: feature_values, ...}, ...}
+    """
+    timer_start = time.time()
+
+    # Get all valid file paths
+    valid_files = list(iter_folder_files(folder_path, include_subfolders))
+
+    # Take the features of unchanged files from the cache. Features are computed with the get_img_features defaults
+    all_imgs_features = {}
+    file_keys = {}
+
+    if feature_cache is not None:
+        file_keys = {file_path: feature_cache.file_key(file_path) for file_path in valid_files}
+        all_imgs_features = feature_cache.get_many({file_path: file_key for file_path, file_key in file_keys.items()
+                                                    if file_key is not None})
+
+    # Calculate features for all other valid files
+    new_files = [file_path for file_path in valid_files if file_path not in all_imgs_features]
+    new_features = {}
+
+    if batch_size:
+        computed_features = _compute_batch_features(new_files, batch_size, workers)
+    else:
+        computed_features = _compute_features(new_files, workers, chunksize)
+
+    for file_path, img_features, error in computed_features:
+        if error is None:
+            new_features[file_path] = img_features
+        else:
+            print(f"WARNING: Could not compute features for {os.path.basename(file_path)}:", error)
+
+    all_imgs_features.update(new_features)
+    if feature_cache is not None and new_features:
+        feature_cache.put_many(new_features, file_keys)
+
+    # Keep the file order of a sequential run
+    all_imgs_features = {file_path: all_imgs_features[file_path] for file_path in valid_files
+                         if file_path in all_imgs_features}
 
     final_time = time.time() - timer_start
-    print(f"Calculated features for {len(all_imgs_features)} files ({round(final_time, 2)}s).")
+    print(f"Calculated features for {len(all_imgs_features)} files ({len(all_imgs_features) - len(new_features)} "
+          f"from cache) ({round(final_time, 2)}s).")
 
     return all_imgs_features
@@ -46,8 +46,9 @@ def compare_all_images(all_imgs_features, threshold=0.99):
 
         # Compare all images with each other and save the results in an array
         results = []
-        for img_a_index, (img_a_path, img_a_features) in enumerate(all_imgs_features.items()):
-            for img_b_path, img_b_features in list(all_imgs_features.items())[img_a_index + 1:]:
+        all_imgs_items = list(all_imgs_features.items())
+        for img_a_index, (img_a_path, img_a_features) in enumerate(all_imgs_items):
+            for img_b_path, img_b_features in all_imgs_items[img_a_index + 1:]:
 
                 try:
                     similarity = compare_two_images(img_a_features, img_b_features)
@@ -77,3 +78,64 @@ def compare_all_images(all_imgs_features, threshold=0.99):
     else:
         print("Not enough images to compare!")
         return []
+
+
+def stream_matches(features_stream, threshold=0.99):
+    """
+    Compare every image with all images before it as soon as its features arrive. Same similarity scores as
+    compare_two_images, computed for all earlier images at once
+    :param features_stream: iterable of tuples (image_path, dictionary of features, error), eg. from
+    stream_folder_features. Images with an error are skipped
+    :param threshold: threshold for minimum similarity score for a match
+    :return: generator of tuples (image_a_path, image_b_path, similarity). Image a arrived before image b
+    """
+    timer_start = time.time()
+    num_comparisons, num_matches = 0, 0
+
+    paths = []
+    feature_slices = None
+    matrix = None  # Features of all earlier images, one row per image. Grows by doubling
+
+    for img_path, img_features, error in features_stream:
+        if error is not None:
+            print(f"WARNING: Could not compute features for {img_path}:", error)
+            continue
+
+        # Take the column layout from the first image
+        if feature_slices is None:
+            feature_slices, num_columns = {}, 0
+            for feature, values in img_features.items():
+                feature_slices[feature] = slice(num_columns, num_columns + len(values))
+                num_columns += len(values)
+            matrix = np.empty((1024, num_columns))
+
+        if img_features.keys() != feature_slices.keys() or \
+                any(len(img_features[feature]) != s.stop - s.start for feature, s in feature_slices.items()):
+            continue
+
+        img_row = np.concatenate([np.asarray(img_features[feature], dtype=np.float64) for feature in feature_slices])
+        num_rows = len(paths)
+
+        if num_rows != 0:
+            # Same rounding steps as compare_features and compare_two_images
+            features_diffs = 0
+            for feature_slice in feature_slices.values():
+                diff = np.absolute(matrix[:num_rows, feature_slice] - img_row[feature_slice])
+                features_diffs = features_diffs + np.round(np.mean(diff, axis=1), 4)
+            similarities = 1 - np.round(features_diffs / len(feature_slices), 4)
+
+            num_comparisons += num_rows
+            for row in np.flatnonzero(similarities >= threshold):
+                num_matches += 1
+                yield paths[row], img_path, similarities[row]
+
+        if num_rows == len(matrix):
+            matrix = np.concatenate([matrix, np.empty_like(matrix)])
+        matrix[num_rows] = img_row
+        paths.append(img_path)
+
+    final_time = time.time() - timer_start
+    print(f"Comparison of {len(paths)} image{'s' if len(paths) != 1 else ''} finished. "
+          f"{num_comparisons} total comparison{'s' if num_comparisons != 1 else ''}. "
+          f"Found {num_matches} match{'es' if num_matches != 1 else ''} above threshold {threshold} "
+          f"({round(final_time, 2)}s total)")
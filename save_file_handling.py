@@ -1,17 +1,36 @@
 import json
 import os
-import jsbeautifier
 import time
+from directory_scanner import DirectoryScanner
+from feature_table import FeatureTable, table_file_path_for
+from instrumentation import instrumentation, logger
 
 
 class SaveFileHandler:
+    """
+    Save file as one json file. Image features are not part of the save file, they are kept in a FeatureTable (quantized
+    rows, 2 bytes per value) that is saved next to it (see table_file_path_for). Features of older save files are moved
+    into the table when the save file is read
+    """
     valid_file_types = ("jpg", "jpeg", "png", "webp", "jfif")
     base_save_file_structure = {"meta": {"root": "", "created": 0, "lifetime_matches": 0, "lifetime_comparisons": 0},
                                 "data": {}}
 
-    def __init__(self, save_file_path="savefile.json"):
+    def __init__(self, save_file_path="savefile.json", incremental_scan=True, update_on_init=True):
+        """
+        :param save_file_path: path of the save file
+        :param incremental_scan: only list directories that changed since the last update_save_file call (see
+        DirectoryScanner). If False, every file is listed and checked on every update
+        :param update_on_init: update the save file with the root folder content right away. Otherwise
+        update_save_file has to be called before the save file is used
+        """
         self.save_file_path = save_file_path
         self.data_dict = {}  # stores the json data of the save file as dict
+        self.incremental_scan = incremental_scan
+
+        # Features of all images. Loaded before the save file, so features of older save files can be moved into it
+        self.feature_table_path = table_file_path_for(save_file_path)
+        self.feature_table = self.load_feature_table()
 
         # Check if savefile exists. If yes load its data
         try:
@@ -21,21 +40,40 @@ class SaveFileHandler:
             print("FAILED. Can not load save file:", e)
             self.create_save_file()
 
+        # Drop features of images that are not in the save file (eg. the save file was replaced)
+        saved_paths = self.get_all_images_compared()
+        for file_path in [file_path for file_path in self.feature_table.paths if file_path not in saved_paths]:
+            self.feature_table.delete(file_path)
+
+        # Save moved features of an older save file right away, so they are not moved again on every start
+        if self.feature_table.changed:
+            self.write_to_save_file()
+
+        self.scanner = DirectoryScanner(self.root_path, SaveFileHandler.is_valid_file_name)
+
         # Update savefile with current root directory content
-        self.update_save_file()
+        if update_on_init:
+            self.update_save_file()
 
     def read_from_save_file(self):
-        timer_start = time.time()
-        print("(i) Reading save file...", end="")
+        timer_start = time.perf_counter()
 
         with open(self.save_file_path, 'r') as json_file:
             data = json.load(json_file)
 
-        print(f"DONE ({round(time.time() - timer_start, 2)}s)")
+        # Save files written before the feature table hold the features of every image as lists of floats
+        for file_path, value in data["data"].items():
+            features = value.pop("features", None)
+            if features:
+                self.set_table_features(file_path, features)
+
+        seconds = time.perf_counter() - timer_start
+        instrumentation.add_time("io.read_save_file", seconds)
+        logger.info("Read save file (%.2fs)", seconds)
         return data
 
     def create_save_file(self):
-        print("(i) Creating new savefile.")
+        logger.info("Creating new savefile.")
 
         # Create new data structure
         self.data_dict = SaveFileHandler.base_save_file_structure
@@ -45,87 +83,186 @@ class SaveFileHandler:
         self.write_to_save_file()
 
     def write_to_save_file(self):
-        timer_start = time.time()
-        print("(i) Writing to save file...", end="")
+        import jsbeautifier  # Slow import, only needed once the save file is written
+
+        timer_start = time.perf_counter()
+        self.save_feature_table()
 
         with open(self.save_file_path, 'w') as json_file:
             options = jsbeautifier.default_options()
             options.indent_size = 4
             json_file.write(jsbeautifier.beautify(json.dumps(self.data_dict), options))
 
-        print(f"DONE ({round(time.time()-timer_start, 2)}s)")
+        seconds = time.perf_counter() - timer_start
+        instrumentation.add_time("io.write_save_file", seconds)
+        logger.info("Wrote save file (%.2fs)", seconds)
 
     def update_save_file(self, write_to_file=True):
-        timer_start = time.time()
-        deletions_missing_file, deletions_modified_file, additions = [], [], []
-        print("(i) Updating saved image paths...", end="")
-
-        # Get current files of root folder
-        all_file_paths = self.get_root_folder_files()
-        # Remove deleted files from dict
-        to_be_deleted = []
-        for file_path in self.data_dict["data"]:
-            # Delete savefile entry if file no longer exists
-            if file_path not in all_file_paths:
-                to_be_deleted.append(file_path)
-                deletions_missing_file.append(file_path)
-            # Delete savefile entry if file was modified
-            elif self.data_dict["data"][file_path]["info"]["last_modified"] != os.path.getmtime(file_path):
-                to_be_deleted.append(file_path)
-                deletions_modified_file.append(file_path)
+        timer_start = time.perf_counter()
+
+        deletions_missing_file, deletions_modified_file, additions = self.find_file_changes(
+            lambda: {file_path: value["info"]["last_modified"] for file_path, value in self.data_dict["data"].items()})
 
-        for file_path in to_be_deleted:
-            del self.data_dict["data"][file_path]
+        # Remove deleted and modified files from dict
+        for file_path in deletions_missing_file + deletions_modified_file:
+            self.data_dict["data"].pop(file_path, None)
+            self.feature_table.delete(file_path)
 
         # Add new files to dict
-        for file_path in all_file_paths:
+        for file_path, last_modified in additions.items():
             if file_path not in self.data_dict["data"]:
-                self.data_dict["data"][file_path] = {"features": {},
-                                             "info": {"compared": False, "last_modified": os.path.getmtime(file_path)}}
-                additions.append(file_path)
+                self.data_dict["data"][file_path] = {"info": {"compared": False, "last_modified": last_modified}}
 
-        print(f"DONE (Removed: {len(deletions_missing_file + deletions_modified_file)} "
-              f"({len(deletions_missing_file)} missing files, {len(deletions_modified_file)} modified files) | "
-              f"Added: {len(additions)}) ({round(time.time()-timer_start, 2)}s)")
+        seconds = time.perf_counter() - timer_start
+        instrumentation.add_time("io.update_save_file", seconds)
+        instrumentation.count("files_added", len(additions))
+        instrumentation.count("files_removed", len(deletions_missing_file + deletions_modified_file))
+        logger.info("Updated saved image paths. Removed: %d (%d missing files, %d modified files) | Added: %d (%.2fs)",
+                    len(deletions_missing_file + deletions_modified_file), len(deletions_missing_file),
+                    len(deletions_modified_file), len(additions), seconds)
 
         # Update savefile with new dict data
         if (len(deletions_missing_file + deletions_modified_file) != 0 or len(additions) != 0) and write_to_file:
             self.write_to_save_file()
 
-        return {"additions": additions, "deletions": deletions_missing_file + deletions_modified_file}
+        return {"additions": list(additions), "deletions": deletions_missing_file + deletions_modified_file}
+
+    def find_file_changes(self, get_saved_files):
+        """
+        Find files of the root folder that were deleted, modified or added since the last update
+        :param get_saved_files: function that returns the saved files as dict {file_path: last_modified, ...}. Only
+        called if the root folder has to be compared to the whole save file (first or non-incremental scan)
+        :return: tuple of (deleted file paths, modified file paths, added files {file_path: last_modified}). Modified
+        files are part of the added files again
+        """
+        if self.incremental_scan and self.scanner.has_snapshot:
+            # The snapshot matches the save file after the first update. Only its changes have to be applied
+            added, removed, modified = self.scanner.scan()
+            return removed, list(modified), {**modified, **added}
+
+        if self.incremental_scan:
+            self.scanner.scan()
+            current_files = self.scanner.get_files()
+        else:
+            current_files = {file_path: os.path.getmtime(file_path) for file_path in self.get_root_folder_files()}
+
+        deletions_missing_file, deletions_modified_file = [], []
+        saved_files = get_saved_files()
+        for file_path, last_modified in saved_files.items():
+            # Delete savefile entry if file no longer exists
+            if file_path not in current_files:
+                deletions_missing_file.append(file_path)
+            # Delete savefile entry if file was modified
+            elif last_modified != current_files[file_path]:
+                deletions_modified_file.append(file_path)
+
+        modified_files = set(deletions_modified_file)
+        additions = {file_path: last_modified for file_path, last_modified in current_files.items()
+                     if file_path not in saved_files or file_path in modified_files}
+
+        return deletions_missing_file, deletions_modified_file, additions
+
+    def load_feature_table(self):
+        """
+        Load the feature table file that belongs to the save file. Creates an empty table if it can not be loaded
+        :return: FeatureTable
+        """
+        if os.path.exists(self.feature_table_path):
+            try:
+                with instrumentation.span("io.load_feature_table"):
+                    return FeatureTable.load(self.feature_table_path)
+            except Exception as e:
+                print("(!) Can not load feature table, features are computed again:", e)
+
+        return FeatureTable()
+
+    def save_feature_table(self):
+        # Written before the save file, so a save file never refers to features that were not saved
+        if not self.feature_table.changed:
+            return
+
+        try:
+            with instrumentation.span("io.save_feature_table"):
+                self.feature_table.save(self.feature_table_path)
+        except Exception as e:
+            print("(!) Can not save feature table:", e)
+
+    def set_table_features(self, file_path, new_features_dict):
+        try:
+            self.feature_table.set(file_path, new_features_dict)
+        except ValueError:
+            # Feature layout changed (eg. different bins). Features of the old layout can not be compared anymore
+            print("(!) Feature layout changed. Resetting all saved features.")
+            self.feature_table = FeatureTable()
+            self.feature_table.set(file_path, new_features_dict)
 
     def edit_image_features(self, file_path, new_features_dict):
         if file_path in self.data_dict["data"]:
-            self.data_dict["data"][file_path]["features"] = new_features_dict
+            self.set_table_features(file_path, new_features_dict)
         else:
             print(f"(!) Can not update features for {file_path}. File path not in save file.")
 
+    def edit_image_hash(self, file_path, image_hash):
+        if file_path in self.data_dict["data"]:
+            self.data_dict["data"][file_path]["info"]["dhash"] = image_hash
+        else:
+            print(f"(!) Can not update hash for {file_path}. File path not in save file.")
+
+    def edit_image_content_hash(self, file_path, file_size, image_content_hash=None):
+        if file_path in self.data_dict["data"]:
+            self.data_dict["data"][file_path]["info"]["file_size"] = file_size
+            self.data_dict["data"][file_path]["info"]["content_hash"] = image_content_hash
+        else:
+            print(f"(!) Can not update content hash for {file_path}. File path not in save file.")
+
+    def get_all_images_content_hashes(self):
+        # Tuples of (file size, content hash). Files that were not checked yet are returned with (None, None), files
+        # that were never hashed (no other file has the same size) with (file size, None)
+        return {key: (value["info"].get("file_size"), value["info"].get("content_hash"))
+                for key, value in self.data_dict["data"].items()}
+
+    def get_all_images_hashes(self):
+        # Images without a hash (eg. save files created before hashes were added) are returned with None
+        return {key: value["info"].get("dhash") for key, value in self.data_dict["data"].items()}
+
+    def get_all_images_compared(self):
+        # Compared flag of every image in save file order
+        return {key: value["info"]["compared"] for key, value in self.data_dict["data"].items()}
+
+    def get_image_features(self, file_path):
+        # Features from the feature table. Images without features are returned with an empty dict
+        return self.feature_table.get_features(file_path) if file_path in self.feature_table else {}
+
     def get_all_images_features(self, split_compared=True):
+        all_images_compared = self.get_all_images_compared()
+
         if split_compared:
             # Return separate lists for previously compared and uncompared images
-            uncompared_features_dict = {key: value['features'] for key, value in self.data_dict["data"].items() if
-                                        not value["info"]["compared"]}
-            compared_features_dict = {key: value['features'] for key, value in self.data_dict["data"].items() if
-                                      value["info"]["compared"]}
+            uncompared_features_dict = {key: self.get_image_features(key) for key, compared in
+                                        all_images_compared.items() if not compared}
+            compared_features_dict = {key: self.get_image_features(key) for key, compared in
+                                      all_images_compared.items() if compared}
 
             return compared_features_dict, uncompared_features_dict
 
         else:
             # Return one List of all features
-            only_features_dict = {key: value['features'] for key, value in self.data_dict["data"].items()}
+            only_features_dict = {key: self.get_image_features(key) for key in all_images_compared}
             return only_features_dict
 
+    @staticmethod
+    def is_valid_file_name(file_name):
+        return file_name.lower().endswith(SaveFileHandler.valid_file_types)
+
     def get_root_folder_files(self):
         valid_files = []
 
         for path, sub_folders, file_names in os.walk(self.root_path):
 
             for file_name in file_names:
-                for file_type in SaveFileHandler.valid_file_types:
-                    if file_name.lower().endswith(file_type):
-                        refactored_path = os.path.join(path, file_name).replace("\\", "/")
-                        valid_files.append(refactored_path)
-                        break
+                if SaveFileHandler.is_valid_file_name(file_name):
+                    refactored_path = os.path.join(path, file_name).replace("\\", "/")
+                    valid_files.append(refactored_path)
 
         return valid_files
 
@@ -1,10 +1,14 @@
 import os.path
+import queue
+import threading
 import tkinter as tk
 from main import ImageCompare
+from save_file_handling import SaveFileHandler
+from file_watcher import create_watcher
 
 
 class GUI(tk.Tk):
-    def __init__(self, root_path):
+    def __init__(self, root_path, watch_mode="auto"):
         super().__init__()
         self.img_comp = ImageCompare(root_path)
 
@@ -19,28 +23,86 @@ class GUI(tk.Tk):
         self.new_changes_label = tk.Label(self.body, textvariable=self.new_changes_var)
         self.new_changes_label.pack()
 
-        self.listen_for_changes()
-
         self.matches_frame = tk.Frame(self.body, bg="yellow")
         self.matches_frame.pack(fill="x", expand=True)
 
-    def listen_for_changes(self):
-        self.status_message_var.set("Listening for changes...")
+        """CHANGE PROCESSING"""
+
+        # Watcher thread -> change queue -> worker thread (features + matching) -> result queue -> Tk main thread
+        self.change_queue = queue.Queue()
+        self.result_queue = queue.Queue()
+        self.worker_thread = threading.Thread(target=self.process_changes, daemon=True)
+        self.worker_thread.start()
+
+        # Wake up the Tk main loop through a pipe if possible. Otherwise check the result queue periodically
+        self.notify_pipe = None
+        if hasattr(self.tk, "createfilehandler"):
+            self.notify_pipe = os.pipe()
+            self.tk.createfilehandler(self.notify_pipe[0], tk.READABLE, self._on_results_notification)
+        else:
+            self.after(100, self._poll_results)
+
+        self.watcher = create_watcher(self.img_comp.save_file_handler.root_path, self.change_queue.put,
+                                      file_filter=SaveFileHandler.is_valid_file_name, mode=watch_mode)
+        self.watcher.start()
+        self.status_message_var.set(f"Listening for changes ({self.watcher.name})...")
+
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def process_changes(self):
+        # Runs on the worker thread. The Tk widgets are only changed from the main thread (see show_results)
+        while True:
+            changed_dirs = self.change_queue.get()
+
+            # Merge changes that arrived while the last batch was processed
+            while not self.change_queue.empty():
+                changed_dirs |= self.change_queue.get_nowait()
+
+            # Changed files in these folders may have kept the folder mtime (modified in place)
+            for changed_dir in changed_dirs:
+                self.img_comp.save_file_handler.scanner.invalidate(changed_dir)
 
-        additions = self.img_comp.save_file_handler.update_save_file(write_to_file=False)["additions"]
-        self.update_new_changes(additions)
+            additions = self.img_comp.save_file_handler.update_save_file(write_to_file=False)["additions"]
+            if len(additions) == 0:
+                continue
 
-        if len(additions) != 0:
             self.img_comp.update_features(write_to_file=False)
 
+            matches = []
+            for addition in additions:
+                try:
+                    matches.append((addition, self.img_comp.compare_new_image(addition)))
+                except Exception as e:
+                    print(f"(!) Can not compare {os.path.basename(addition)}:", e)
+
+            self.result_queue.put((additions, matches))
+            if self.notify_pipe is not None:
+                os.write(self.notify_pipe[1], b"x")
+
+    def _on_results_notification(self, fd, mask):
+        os.read(fd, 4096)
+        self.show_results()
+
+    def _poll_results(self):
+        self.show_results()
+        self.after(100, self._poll_results)
+
+    def show_results(self):
+        while not self.result_queue.empty():
+            additions, matches = self.result_queue.get_nowait()
+            self.update_new_changes(additions)
+
             for widgets in self.matches_frame.winfo_children():
                 widgets.destroy()
 
-            for addition in additions:
-                matches = self.img_comp.compare_new_image(addition)
-                self.add_matches_panel(addition, matches)
+            for addition, addition_matches in matches:
+                self.add_matches_panel(addition, addition_matches)
 
-        self.after(3000, self.listen_for_changes)
+    def on_close(self):
+        self.watcher.stop()
+        if self.notify_pipe is not None:
+            self.tk.deletefilehandler(self.notify_pipe[0])
+        self.destroy()
 
     def update_new_changes(self, changes):
         self.new_changes_var.set(f"Added {len(changes)} image"
@@ -0,0 +1,412 @@
+import os
+import numpy as np
+from comparison_engine import FEATURE_DECIMALS, QUANTIZED_DTYPE, SCORE_ROUNDING_SLACK, block_similarities, \
+    feature_weights, hamming_distances, quantize_features, restore_precision, select_top_k
+
+
+class SimilarityIndex:
+    """
+    Vantage point tree over the concatenated image features under a weighted L1 metric. The metric is the unrounded
+    version of the difference score of compare_two_images (mean absolute difference per feature, averaged over all
+    features), so every image above a similarity threshold lies within a fixed radius of the query.
+    New images are kept in a pending block that is scanned linearly, deleted images are only marked. The tree is rebuilt
+    once pending and deleted images make up a large part of the index.
+    Features are stored quantized (see quantize_features, 2 bytes per value) and scaled back for every distance
+    """
+
+    def __init__(self, feature_slices=None, leaf_size=32, rebuild_ratio=0.25, min_rebuild_size=256):
+        """
+        :param feature_slices: column layout of the features: {feature_name: slice, ...}. Taken from the first inserted
+        image if not defined
+        :param leaf_size: max number of images per tree leaf. Leaves are scored in one vectorized call
+        :param rebuild_ratio: rebuild the tree once pending + deleted images exceed this share of the index
+        :param min_rebuild_size: do not rebuild for less pending + deleted images than this
+        """
+        self.leaf_size = leaf_size
+        self.rebuild_ratio = rebuild_ratio
+        self.min_rebuild_size = min_rebuild_size
+
+        self.feature_slices = None
+        self.weights = None
+        self.matrix = np.empty((0, 0), dtype=QUANTIZED_DTYPE)
+        self.alive = np.empty(0, dtype=bool)
+        self.hashes = np.empty(0, dtype=np.uint64)  # dhash per row (see image_comparison.dhash)
+        self.has_hash = np.empty(0, dtype=bool)
+        self.paths = []  # Row index -> image path. Rows are kept in insertion order
+        self.rows = {}  # Image path -> row index
+        self.num_rows = 0  # Rows in use. The matrix grows in chunks, so it can be larger
+        self.num_deleted = 0
+        self.changed = False  # Set on every insert or delete. Used to decide if the index has to be saved
+
+        # Flattened tree. Inner nodes hold a vantage point row and a median distance, leaves a range of leaf_rows
+        self.tree_size = 0  # Rows [0, tree_size) are in the tree, all later rows are pending
+        self.node_vantage = np.empty(0, dtype=np.int64)
+        self.node_radius = np.empty(0, dtype=np.float64)
+        self.node_inside = np.empty(0, dtype=np.int64)
+        self.node_outside = np.empty(0, dtype=np.int64)
+        self.node_leaf_start = np.empty(0, dtype=np.int64)
+        self.node_leaf_end = np.empty(0, dtype=np.int64)
+        self.leaf_rows = np.empty(0, dtype=np.int64)
+
+        if feature_slices is not None:
+            self._set_feature_slices(feature_slices)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, img_path):
+        return img_path in self.rows
+
+    def _set_feature_slices(self, feature_slices):
+        self.feature_slices = dict(feature_slices)
+        num_columns = sum(s.stop - s.start for s in self.feature_slices.values())
+
+        # Column weights that turn the L1 distance into the average of the per-feature mean absolute differences
+        self.weights = feature_weights(self.feature_slices)
+
+        self.matrix = np.empty((0, num_columns), dtype=QUANTIZED_DTYPE)
+
+    def _features_to_row(self, img_features):
+        if self.feature_slices is None:
+            feature_slices, start = {}, 0
+            for feature, values in img_features.items():
+                feature_slices[feature] = slice(start, start + len(values))
+                start += len(values)
+            self._set_feature_slices(feature_slices)
+
+        if img_features.keys() != self.feature_slices.keys():
+            raise ValueError(f"Feature names do not match the index ({list(self.feature_slices)}).")
+
+        row = np.concatenate([np.asarray(img_features[feature], dtype=np.float64).ravel()
+                              for feature in self.feature_slices])
+        if len(row) != len(self.weights):
+            raise ValueError(f"Feature length {len(row)} does not match the index ({len(self.weights)}).")
+
+        return np.round(row, FEATURE_DECIMALS)
+
+    def _distances(self, query_row, rows):
+        return np.absolute(restore_precision(self.matrix[rows]) - query_row) @ self.weights
+
+    def insert(self, img_path, img_features, img_hash=None):
+        """
+        Add an image to the index. An image that is already in the index is replaced
+        :param img_path: path of the image
+        :param img_features: dictionary of features: {feature_name: feature_values, ...}
+        :param img_hash: optional dhash of the image. Used to prefilter queries (see query)
+        """
+        row = self._features_to_row(img_features)
+
+        if img_path in self.rows:
+            self.delete(img_path)
+
+        # Grow matrix in chunks to avoid copying it on every insert
+        if self.num_rows == len(self.matrix):
+            grown_matrix = np.empty((max(2 * len(self.matrix), 64), self.matrix.shape[1]), dtype=QUANTIZED_DTYPE)
+            grown_matrix[:self.num_rows] = self.matrix[:self.num_rows]
+            grown_alive = np.zeros(len(grown_matrix), dtype=bool)
+            grown_alive[:self.num_rows] = self.alive[:self.num_rows]
+            grown_hashes = np.zeros(len(grown_matrix), dtype=np.uint64)
+            grown_hashes[:self.num_rows] = self.hashes[:self.num_rows]
+            grown_has_hash = np.zeros(len(grown_matrix), dtype=bool)
+            grown_has_hash[:self.num_rows] = self.has_hash[:self.num_rows]
+            self.matrix, self.alive = grown_matrix, grown_alive
+            self.hashes, self.has_hash = grown_hashes, grown_has_hash
+
+        self.matrix[self.num_rows] = quantize_features(row)
+        self.alive[self.num_rows] = True
+        self.hashes[self.num_rows] = img_hash if img_hash is not None else 0
+        self.has_hash[self.num_rows] = img_hash is not None
+        self.paths.append(img_path)
+        self.rows[img_path] = self.num_rows
+        self.num_rows += 1
+        self.changed = True
+
+        self._rebuild_if_needed()
+
+    def set_hash(self, img_path, img_hash):
+        """
+        Set the dhash of an image that is already in the index. Keeps its position in the insertion order
+        :param img_path: path of the image
+        :param img_hash: dhash of the image
+        """
+        row = self.rows[img_path]
+        self.hashes[row] = img_hash
+        self.has_hash[row] = True
+        self.changed = True
+
+    def delete(self, img_path):
+        """
+        Remove an image from the index. Unknown paths are ignored
+        :param img_path: path of the image
+        """
+        row = self.rows.pop(img_path, None)
+        if row is None:
+            return
+
+        self.alive[row] = False
+        self.num_deleted += 1
+        self.changed = True
+
+        self._rebuild_if_needed()
+
+    def _rebuild_if_needed(self):
+        outdated = self.num_deleted + self.num_rows - self.tree_size
+        if outdated >= self.min_rebuild_size and outdated > self.rebuild_ratio * self.num_rows:
+            self.rebuild()
+
+    def rebuild(self):
+        """
+        Drop deleted images and build a new tree over all images. Keeps the insertion order of the images
+        """
+        keep = np.flatnonzero(self.alive[:self.num_rows])
+
+        self.matrix = self.matrix[keep]
+        self.alive = np.ones(len(keep), dtype=bool)
+        self.hashes = self.hashes[keep]
+        self.has_hash = self.has_hash[keep]
+        self.paths = [self.paths[row] for row in keep]
+        self.rows = {img_path: row for row, img_path in enumerate(self.paths)}
+        self.num_rows = len(keep)
+        self.num_deleted = 0
+        self.tree_size = self.num_rows
+
+        nodes = {"vantage": [], "radius": [], "inside": [], "outside": [], "leaf_start": [], "leaf_end": []}
+        leaf_rows = []
+        rng = np.random.default_rng(0)  # Fixed seed so rebuilding the same data results in the same tree
+
+        def new_node():
+            for values in nodes.values():
+                values.append(-1)
+            nodes["radius"][-1] = 0.0
+            return len(nodes["vantage"]) - 1
+
+        # Build iteratively, duplicate images can make the tree too deep for recursion
+        stack = [(new_node(), np.arange(self.num_rows))] if self.num_rows != 0 else []
+        while stack:
+            node, rows = stack.pop()
+
+            if len(rows) > self.leaf_size:
+                # Split remaining rows at the median distance to a random vantage point
+                vantage_index = rng.integers(len(rows))
+                other_rows = np.delete(rows, vantage_index)
+                distances = self._distances(restore_precision(self.matrix[rows[vantage_index]]), other_rows)
+                radius = float(np.median(distances))
+                inside, outside = other_rows[distances <= radius], other_rows[distances > radius]
+
+                # Only split if it separates anything. Otherwise (eg. all images identical) keep one large leaf
+                if len(outside) != 0:
+                    nodes["vantage"][node] = rows[vantage_index]
+                    nodes["radius"][node] = radius
+                    nodes["inside"][node] = new_node()
+                    stack.append((nodes["inside"][node], inside))
+                    nodes["outside"][node] = new_node()
+                    stack.append((nodes["outside"][node], outside))
+                    continue
+
+            nodes["leaf_start"][node] = len(leaf_rows)
+            leaf_rows.extend(rows.tolist())
+            nodes["leaf_end"][node] = len(leaf_rows)
+
+        self.node_vantage = np.array(nodes["vantage"], dtype=np.int64)
+        self.node_radius = np.array(nodes["radius"], dtype=np.float64)
+        self.node_inside = np.array(nodes["inside"], dtype=np.int64)
+        self.node_outside = np.array(nodes["outside"], dtype=np.int64)
+        self.node_leaf_start = np.array(nodes["leaf_start"], dtype=np.int64)
+        self.node_leaf_end = np.array(nodes["leaf_end"], dtype=np.int64)
+        self.leaf_rows = np.array(leaf_rows, dtype=np.int64)
+
+    def _candidate_rows(self, query_row, radius):
+        candidates = [np.arange(self.tree_size, self.num_rows)]  # Pending rows are always scanned
+
+        stack = [0] if len(self.node_vantage) != 0 else []
+        while stack:
+            node = stack.pop()
+
+            if self.node_leaf_start[node] != -1:
+                candidates.append(self.leaf_rows[self.node_leaf_start[node]:self.node_leaf_end[node]])
+                continue
+
+            vantage = self.node_vantage[node]
+            distance = self._distances(query_row, vantage)
+            if distance <= radius:
+                candidates.append(np.array([vantage]))
+
+            # Triangle inequality: only visit children that can contain rows within the radius
+            if distance - radius <= self.node_radius[node]:
+                stack.append(self.node_inside[node])
+            if distance + radius > self.node_radius[node]:
+                stack.append(self.node_outside[node])
+
+        candidates = np.concatenate(candidates)
+        return candidates[self.alive[candidates]]
+
+    def _top_k_rows(self, query_row, k, threshold, exclude_row):
+        # Best first search: the search radius shrinks to the k-th best score found so far, so subtrees that can not
+        # contain a better image are skipped
+        best_rows, best_similarities = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        num_scored = 0
+
+        def score(rows):
+            nonlocal best_rows, best_similarities, num_scored
+            rows = rows[self.alive[rows] & (rows != exclude_row)]
+            if len(rows) == 0:
+                return
+
+            similarities = block_similarities(restore_precision(self.matrix[rows]), query_row[None, :],
+                                              self.feature_slices)[:, 0]
+            num_scored += len(rows)
+
+            cutoff = best_similarities[-1] if len(best_similarities) == k else threshold
+            above_cutoff = similarities >= max(cutoff, threshold)
+            best_rows = np.concatenate([best_rows, rows[above_cutoff]])
+            best_similarities = np.concatenate([best_similarities, similarities[above_cutoff]])
+
+            selected = select_top_k(best_similarities, k, best_rows)  # Ties in insertion order
+            best_rows, best_similarities = best_rows[selected], best_similarities[selected]
+
+        def radius():
+            cutoff = best_similarities[-1] if len(best_similarities) == k else threshold
+            return 1 - max(cutoff, threshold) + SCORE_ROUNDING_SLACK
+
+        score(np.arange(self.tree_size, self.num_rows))  # Pending rows are always scanned
+
+        stack = [0] if len(self.node_vantage) != 0 else []
+        while stack:
+            node = stack.pop()
+
+            if self.node_leaf_start[node] != -1:
+                score(self.leaf_rows[self.node_leaf_start[node]:self.node_leaf_end[node]])
+                continue
+
+            vantage = self.node_vantage[node]
+            distance = self._distances(query_row, vantage)
+            if distance <= radius():
+                score(np.array([vantage]))
+
+            # Visit the child on the side of the query first. It most likely holds the best images
+            children = [(self.node_outside[node], distance + radius() > self.node_radius[node]),
+                        (self.node_inside[node], distance - radius() <= self.node_radius[node])]
+            if distance > self.node_radius[node]:
+                children.reverse()
+            stack.extend(child for child, reachable in children if reachable)
+
+        return best_rows, best_similarities, num_scored
+
+    def query(self, img_features, threshold=0.99, exclude_path=None, img_hash=None, max_hash_distance=None,
+              top_k=None):
+        """
+        Find all images in the index with a similarity score of at least threshold. Scores are identical to
+        compare_two_images
+        :param img_features: dictionary of features of the query image: {feature_name: feature_values, ...}
+        :param threshold: threshold for minimum similarity score
+        :param exclude_path: optional image path to leave out of the results (eg. the query image itself)
+        :param img_hash: optional dhash of the query image
+        :param max_hash_distance: if set (and img_hash is set), only images whose dhash differs in at most this many
+        bits are scored. Images without a hash are always scored. Finds (near) duplicates only
+        :param top_k: None or int. Only return the top_k most similar images above the threshold
+        :return: tuple of (array of tuples [(image_path, similarity), ...] in insertion order (with top_k: highest
+        similarity first, ties in insertion order), number of images scored)
+        """
+        if self.num_rows == 0 or (top_k is not None and top_k <= 0):
+            return [], 0
+
+        query_row = self._features_to_row(img_features)
+
+        if top_k is not None and (img_hash is None or max_hash_distance is None):
+            exclude_row = self.rows.get(exclude_path, -1)
+            rows, similarities, num_scored = self._top_k_rows(query_row, top_k, threshold, exclude_row)
+            return [(self.paths[row], similarity) for row, similarity in zip(rows, similarities)], num_scored
+
+        if img_hash is not None and max_hash_distance is not None:
+            # Popcount prefilter over all hashes instead of the tree search
+            distances = hamming_distances(self.hashes[:self.num_rows], np.uint64(img_hash))
+            candidates = np.flatnonzero(self.alive[:self.num_rows] &
+                                        (~self.has_hash[:self.num_rows] | (distances <= max_hash_distance)))
+        else:
+            candidates = self._candidate_rows(query_row, radius=1 - threshold + SCORE_ROUNDING_SLACK)
+            candidates.sort()  # Insertion order
+
+        if exclude_path in self.rows:
+            candidates = candidates[candidates != self.rows[exclude_path]]
+
+        similarities = block_similarities(restore_precision(self.matrix[candidates]), query_row[None, :],
+                                          self.feature_slices)[:, 0]
+
+        above_threshold = similarities >= threshold
+        candidates, similarities = candidates[above_threshold], similarities[above_threshold]
+        if top_k is not None:
+            selected = select_top_k(similarities, top_k, candidates)
+            candidates, similarities = candidates[selected], similarities[selected]
+
+        results = [(self.paths[row], similarity) for row, similarity in zip(candidates, similarities)]
+
+        return results, len(above_threshold)
+
+    def save(self, index_file_path):
+        """
+        Save the index as a .npz file. Pending and deleted images are saved as they are, the tree is only rebuilt by
+        insert and delete
+        :param index_file_path: path of the index file
+        """
+        feature_names = list(self.feature_slices) if self.feature_slices else []
+        feature_bounds = [(s.start, s.stop) for s in self.feature_slices.values()] if self.feature_slices else []
+
+        with open(index_file_path, "wb") as index_file:
+            np.savez(index_file, matrix=self.matrix[:self.num_rows], paths=np.array(self.paths, dtype=str),
+                     hashes=self.hashes[:self.num_rows], has_hash=self.has_hash[:self.num_rows],
+                     alive=self.alive[:self.num_rows], tree_size=self.tree_size,
+                     feature_names=np.array(feature_names, dtype=str),
+                     feature_bounds=np.array(feature_bounds, dtype=np.int64).reshape(-1, 2),
+                     node_vantage=self.node_vantage, node_radius=self.node_radius, node_inside=self.node_inside,
+                     node_outside=self.node_outside, node_leaf_start=self.node_leaf_start,
+                     node_leaf_end=self.node_leaf_end, leaf_rows=self.leaf_rows)
+
+        self.changed = False
+
+    @classmethod
+    def load(cls, index_file_path, **kwargs):
+        """
+        Load an index saved with save()
+        :param index_file_path: path of the index file
+        :param kwargs: parameters passed to the constructor
+        :return: SimilarityIndex
+        """
+        index = cls(**kwargs)
+
+        with np.load(index_file_path) as data:
+            if len(data["feature_names"]) != 0:
+                index._set_feature_slices({str(name): slice(int(start), int(stop)) for name, (start, stop) in
+                                           zip(data["feature_names"], data["feature_bounds"])})
+
+            # Older index files hold float64 features
+            index.matrix = data["matrix"] if data["matrix"].dtype == QUANTIZED_DTYPE else \
+                quantize_features(data["matrix"])
+            index.paths = [str(img_path) for img_path in data["paths"]]
+            index.hashes = data["hashes"] if "hashes" in data else np.zeros(len(index.paths), dtype=np.uint64)
+            index.has_hash = data["has_hash"] if "has_hash" in data else np.zeros(len(index.paths), dtype=bool)
+            index.node_vantage = data["node_vantage"]
+            index.node_radius = data["node_radius"]
+            index.node_inside = data["node_inside"]
+            index.node_outside = data["node_outside"]
+            index.node_leaf_start = data["node_leaf_start"]
+            index.node_leaf_end = data["node_leaf_end"]
+            index.leaf_rows = data["leaf_rows"]
+
+            # Older index files only hold rows that are in the tree
+            index.alive = data["alive"] if "alive" in data else np.ones(len(index.paths), dtype=bool)
+            index.tree_size = int(data["tree_size"]) if "tree_size" in data else len(index.paths)
+
+        index.num_rows = len(index.paths)
+        index.num_deleted = index.num_rows - int(np.count_nonzero(index.alive))
+        index.rows = {img_path: row for row, img_path in enumerate(index.paths) if index.alive[row]}
+
+        return index
+
+
+def index_file_path_for(save_file_path):
+    """
+    Get the path of the similarity index file that belongs to a save file
+    :param save_file_path: path of the save file
+    :return: path of the index file (eg. savefile.json -> savefile.index.npz)
+    """
+    return os.path.splitext(save_file_path)[0] + ".index.npz"
@@ -0,0 +1,177 @@
+import json
+import os
+import sqlite3
+import time
+from instrumentation import instrumentation, logger
+from save_file_handling import SaveFileHandler
+
+
+class SQLiteSaveFileHandler(SaveFileHandler):
+    """
+    Save file handler that stores the save file in a SQLite database. Every change is a row level update inside an open
+    transaction. write_to_save_file commits the transaction instead of rewriting the whole save file, so a crash only
+    loses the changes since the last write and never the whole save file.
+    Features are kept in the feature table next to the save file like with the json save file (see SaveFileHandler).
+    The features column only holds features of save files written before the feature table, they are moved into the
+    table when the save file is read
+    """
+
+    def __init__(self, save_file_path="savefile.db", incremental_scan=True, update_on_init=True):
+        # Connection is shared with the analysis thread of the GUI. Access is never concurrent
+        self.connection = sqlite3.connect(save_file_path, check_same_thread=False)
+        try:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.DatabaseError as e:
+            self.connection.close()
+            raise ValueError(f"Save file {save_file_path} is not a SQLite database ({e}).")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        super().__init__(save_file_path=save_file_path, incremental_scan=incremental_scan,
+                         update_on_init=update_on_init)
+
+    def read_from_save_file(self):
+        timer_start = time.perf_counter()
+
+        meta = {key: json.loads(value) for key, value in self.connection.execute("SELECT key, value FROM meta")}
+        if "root" not in meta:
+            raise Exception("Save file has no root path.")
+
+        # Save files created before hashes were added have no hash columns
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(images)")]
+        for column, column_type in (("dhash", "INTEGER"), ("file_size", "INTEGER"), ("content_hash", "TEXT")):
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE images ADD COLUMN {column} {column_type}")
+        self.connection.commit()
+
+        # Move the features of an older save file into the feature table. Cleared in the same transaction as the next
+        # write, which saves the table first
+        for path, features in self.connection.execute("SELECT path, features FROM images WHERE features != '{}'"):
+            self.set_table_features(path, json.loads(features))
+        self.connection.execute("UPDATE images SET features = '{}' WHERE features != '{}'")
+
+        seconds = time.perf_counter() - timer_start
+        instrumentation.add_time("io.read_save_file", seconds)
+        logger.info("Read save file (%.2fs)", seconds)
+        return {"meta": meta}
+
+    def create_save_file(self):
+        logger.info("Creating new savefile.")
+
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS images (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT NOT NULL UNIQUE,
+                last_modified REAL NOT NULL,
+                compared INTEGER NOT NULL DEFAULT 0,
+                features TEXT NOT NULL DEFAULT '{}',
+                dhash INTEGER,
+                file_size INTEGER,
+                content_hash TEXT
+            );
+            CREATE INDEX IF NOT EXISTS images_compared ON images (compared);
+        """)
+
+        # Create new data structure
+        self.data_dict = {"meta": dict(SaveFileHandler.base_save_file_structure["meta"])}
+        self.data_dict["meta"]["root"] = os.path.dirname(os.path.abspath(__file__))
+        self.data_dict["meta"]["created"] = int(time.time())
+        self.root_path = self.data_dict["meta"]["root"]
+
+        self.connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                    [(key, json.dumps(value)) for key, value in self.data_dict["meta"].items()])
+        self.write_to_save_file()
+
+    def write_to_save_file(self):
+        # All changes are already in the database. Only the open transaction has to be committed
+        self.save_feature_table()
+        with instrumentation.span("io.write_save_file"):
+            self.connection.commit()
+
+    def update_save_file(self, write_to_file=True):
+        timer_start = time.perf_counter()
+
+        deletions_missing_file, deletions_modified_file, additions = self.find_file_changes(
+            lambda: dict(self.connection.execute("SELECT path, last_modified FROM images ORDER BY id")))
+
+        # Remove deleted and modified files. Modified files are added again as new rows
+        self.connection.executemany("DELETE FROM images WHERE path = ?",
+                                    [(file_path,) for file_path in deletions_missing_file + deletions_modified_file])
+        for file_path in deletions_missing_file + deletions_modified_file:
+            self.feature_table.delete(file_path)
+        self.connection.executemany("INSERT OR IGNORE INTO images (path, last_modified) VALUES (?, ?)",
+                                    list(additions.items()))
+
+        seconds = time.perf_counter() - timer_start
+        instrumentation.add_time("io.update_save_file", seconds)
+        instrumentation.count("files_added", len(additions))
+        instrumentation.count("files_removed", len(deletions_missing_file + deletions_modified_file))
+        logger.info("Updated saved image paths. Removed: %d (%d missing files, %d modified files) | Added: %d (%.2fs)",
+                    len(deletions_missing_file + deletions_modified_file), len(deletions_missing_file),
+                    len(deletions_modified_file), len(additions), seconds)
+
+        if (len(deletions_missing_file + deletions_modified_file) != 0 or len(additions) != 0) and write_to_file:
+            self.write_to_save_file()
+
+        return {"additions": list(additions), "deletions": deletions_missing_file + deletions_modified_file}
+
+    def edit_image_features(self, file_path, new_features_dict):
+        if self.connection.execute("SELECT 1 FROM images WHERE path = ?", (file_path,)).fetchone() is not None:
+            self.set_table_features(file_path, new_features_dict)
+        else:
+            print(f"(!) Can not update features for {file_path}. File path not in save file.")
+
+    def edit_image_hash(self, file_path, image_hash):
+        # SQLite integers are signed 64 bit. Store the upper half of the unsigned hash range as negative numbers
+        if image_hash is not None and image_hash >= 2 ** 63:
+            image_hash -= 2 ** 64
+        cursor = self.connection.execute("UPDATE images SET dhash = ? WHERE path = ?", (image_hash, file_path))
+
+        if cursor.rowcount == 0:
+            print(f"(!) Can not update hash for {file_path}. File path not in save file.")
+
+    def get_all_images_hashes(self):
+        return {path: image_hash if image_hash is None or image_hash >= 0 else image_hash + 2 ** 64
+                for path, image_hash in self.connection.execute("SELECT path, dhash FROM images ORDER BY id")}
+
+    def edit_image_content_hash(self, file_path, file_size, image_content_hash=None):
+        cursor = self.connection.execute("UPDATE images SET file_size = ?, content_hash = ? WHERE path = ?",
+                                         (file_size, image_content_hash, file_path))
+
+        if cursor.rowcount == 0:
+            print(f"(!) Can not update content hash for {file_path}. File path not in save file.")
+
+    def get_all_images_content_hashes(self):
+        return {path: (file_size, image_content_hash) for path, file_size, image_content_hash in
+                self.connection.execute("SELECT path, file_size, content_hash FROM images ORDER BY id")}
+
+    def get_all_images_compared(self):
+        return {path: bool(compared) for path, compared in
+                self.connection.execute("SELECT path, compared FROM images ORDER BY id")}
+
+    def mark_all_as_compared(self, write_to_file=True, unmark_all=False):
+        cursor = self.connection.execute("UPDATE images SET compared = ? WHERE compared = ?",
+                                         (int(not unmark_all), int(unmark_all)))
+        new_completions = cursor.rowcount
+
+        if new_completions != 0 and write_to_file:
+            self.write_to_save_file()
+
+        return new_completions
+
+    def get_number_of_files(self):
+        return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def add_to_lifetime_stats(self, matches=0, comparisons=0, write_to_file=True):
+
+        self.data_dict["meta"]["lifetime_matches"] += matches
+        self.data_dict["meta"]["lifetime_comparisons"] += comparisons
+
+        # Two row updates instead of a rewrite of the save file
+        self.connection.executemany("UPDATE meta SET value = ? WHERE key = ?",
+                                    [(json.dumps(self.data_dict["meta"]["lifetime_matches"]), "lifetime_matches"),
+                                     (json.dumps(self.data_dict["meta"]["lifetime_comparisons"]),
+                                      "lifetime_comparisons")])
+
+        if write_to_file:
+            self.write_to_save_file()
@@ -0,0 +1,129 @@
+import collections
+import hashlib
+import multiprocessing.pool
+import os
+import threading
+from PIL import Image
+
+
+class ThumbnailLoader:
+    """
+    Loads image thumbnails on background threads. Images are decoded with shrink-on-load (see load_img), so large
+    photos are not decoded at full resolution. Loaded thumbnails are kept in memory (least recently used are dropped)
+    and optionally saved to a cache folder, so they are only decoded once
+    """
+
+    def __init__(self, size=(300, 300), workers=2, max_cached=256, cache_dir=None):
+        """
+        :param size: thumbnail size in pixels (width, height)
+        :param workers: number of loading threads
+        :param max_cached: max number of thumbnails kept in memory
+        :param cache_dir: optional folder to save thumbnails in. Thumbnails are not saved if not defined
+        """
+        self.size = tuple(size)
+        self.max_cached = max_cached
+        self.cache_dir = cache_dir
+
+        self.thumbnails = collections.OrderedDict()  # {img_path: PIL image, ...}, least recently used first
+        self.pending = {}  # {img_path: [callback, ...], ...} of thumbnails that are being loaded
+        self.lock = threading.Lock()
+        self.pool = multiprocessing.pool.ThreadPool(workers)
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, img_path, callback=None):
+        """
+        Get a thumbnail. If it is not loaded yet, it is loaded in the background
+        :param img_path: path of the image
+        :param callback: optional function, called with (img_path, PIL image or None on errors) once the thumbnail is
+        loaded. Called from a loading thread, not if the thumbnail is returned right away
+        :return: PIL image of the thumbnail if it is already loaded, else None
+        """
+        with self.lock:
+            if img_path in self.thumbnails:
+                self.thumbnails.move_to_end(img_path)
+                return self.thumbnails[img_path]
+
+            if img_path in self.pending:
+                if callback is not None:
+                    self.pending[img_path].append(callback)
+                return None
+
+            self.pending[img_path] = [] if callback is None else [callback]
+
+        self.pool.apply_async(self._load, (img_path,))
+
+        return None
+
+    def prefetch(self, img_paths):
+        """
+        Load thumbnails in the background so they are ready when they are needed
+        :param img_paths: list of image paths
+        """
+        for img_path in img_paths:
+            self.get(img_path)
+
+    def close(self):
+        self.pool.terminate()
+
+    def _load(self, img_path):
+        try:
+            thumbnail = self._load_cached(img_path)
+            if thumbnail is None:
+                thumbnail = self._load_image(img_path)
+                self._save_cached(img_path, thumbnail)
+        except Exception as e:
+            print(f"(!) Can not load thumbnail of {img_path}:", e)
+            thumbnail = None
+
+        with self.lock:
+            callbacks = self.pending.pop(img_path, [])
+            if thumbnail is not None:
+                self.thumbnails[img_path] = thumbnail
+                while len(self.thumbnails) > self.max_cached:
+                    self.thumbnails.popitem(last=False)
+
+        for callback in callbacks:
+            callback(img_path, thumbnail)
+
+    def _load_image(self, img_path):
+        pil_img = Image.open(img_path)
+        pil_img.draft("RGB", self.size)  # Using shrink-on-load to speed up image load times significantly
+
+        return pil_img.resize(self.size)
+
+    def _cache_path(self, img_path):
+        # Cached thumbnails are invalid once the image file changes
+        stat = os.stat(img_path)
+        key = f"{os.path.abspath(img_path)}|{stat.st_size}|{stat.st_mtime_ns}|{self.size[0]}x{self.size[1]}"
+
+        return os.path.join(self.cache_dir, hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest() + ".png")
+
+    def _load_cached(self, img_path):
+        if self.cache_dir is None:
+            return None
+
+        cache_path = self._cache_path(img_path)
+        if not os.path.exists(cache_path):
+            return None
+
+        try:
+            with Image.open(cache_path) as cached_img:
+                cached_img.load()
+                return cached_img.copy()
+        except OSError:
+            return None  # Broken cache file, loaded from the image again
+
+    def _save_cached(self, img_path, thumbnail):
+        if self.cache_dir is None:
+            return
+
+        try:
+            # Save under a temporary name first, so other threads never read a partly written file
+            cache_path = self._cache_path(img_path)
+            temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+            thumbnail.save(temp_path, format="PNG")
+            os.replace(temp_path, cache_path)
+        except (OSError, ValueError) as e:
+            print(f"(!) Can not save thumbnail of {img_path}:", e)